@@ -0,0 +1,50 @@
+import array
+
+
+def square_wave(frequency, sample_rate, volume=0.25, channels=1, duration=0.02):
+    """
+    Signed 16-bit samples of a square wave, a whole number of periods
+    lasting about duration seconds so that it can be looped without clicks
+    """
+    period = max(int(round(float(sample_rate) / frequency)), 2)
+    amplitude = int(volume * 32767)
+    half = period // 2
+    one_period = [amplitude]*half + [-amplitude]*(period - half)
+    periods = max(int(duration * sample_rate) // period, 1)
+    return array.array('h', [sample for sample in one_period*periods for _ in range(channels)])
+
+
+class NullAudio:
+    """
+    Silent backend for headless runs, remembering whether the tone is on
+    """
+    def __init__(self):
+        self.active = False
+
+    def update(self, active):
+        self.active = active
+
+
+class ToneAudio:
+    """
+    Square-wave tone looped on a pygame mixer channel.
+
+    The samples are synthesized once for the mixer format, then update(),
+    called every frame, starts the loop when the sound timer becomes
+    non-zero and stops it when it runs out. Initialize the mixer with a
+    small buffer (pygame.mixer.pre_init) to keep the latency near one frame.
+    """
+    def __init__(self, frequency=440, volume=0.25):
+        import pygame
+        sample_rate, _, channels = pygame.mixer.get_init()
+        self.sound = pygame.mixer.Sound(buffer=square_wave(frequency, sample_rate, volume, channels))
+        self.active = False
+
+    def update(self, active):
+        if active == self.active:
+            return
+        if active:
+            self.sound.play(loops=-1)
+        else:
+            self.sound.stop()
+        self.active = active
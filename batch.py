@@ -0,0 +1,130 @@
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+from ConfigParser import ConfigParser
+from timeit import default_timer
+
+from headless import create_cpu
+
+config = None
+
+
+def load_config(config_path):
+    global config
+    config = ConfigParser()
+    config.read(config_path)
+
+
+def read_input_script(path):
+    """
+    Input script: one '<frame> <key>' line per key change, where key is a
+    hexadecimal keypad digit, or '-' to release the key.
+    Return a dict frame -> key (None for a release).
+    """
+    events = {}
+    with open(path) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            frame, key = line.split()
+            events[int(frame)] = None if key == '-' else int(key, 16)
+    return events
+
+
+def run_job(job):
+    """
+    Run one ROM headlessly for the job's budget and return its result record
+    """
+    rom, seed, script, frames, cycles = job
+    record = {'rom': rom, 'seed': seed, 'script': script}
+    start = default_timer()
+    cpu = None
+    try:
+        cpu = create_cpu(config, rom, seed)
+        events = read_input_script(script) if script else {}
+        frame = 0
+        while (frames is None or frame < frames) and (cycles is None or cpu.cycles < cycles):
+            if frame in events:
+                cpu.keyboard.key_down = events[frame]
+            n_instructions = cpu.cycles_per_frame
+            if cycles is not None:
+                n_instructions = min(n_instructions, cycles - cpu.cycles)
+            cpu.run(n_instructions)
+            if n_instructions == cpu.cycles_per_frame:
+                cpu.tick_timers()
+                frame += 1
+    except Exception as e:
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+    else:
+        record.update({
+            'frames': frame,
+            'frame_sha1': hashlib.sha1(cpu.screen.to_bytes()).hexdigest(),
+            'V': ''.join('%02X' % v for v in cpu.V_register),
+            'I': cpu.I,
+            'pc': cpu.program_counter,
+            'sp': cpu.stack_pointer,
+            'dt': cpu.delay_timer,
+            'st': cpu.sound_timer,
+        })
+    record['cycles'] = cpu.cycles if cpu is not None else 0
+    record['wall_time'] = round(default_timer() - start, 6)
+    return record
+
+
+def find_roms(paths):
+    roms = []
+    for path in paths:
+        if os.path.isdir(path):
+            roms += sorted(os.path.join(path, name) for name in os.listdir(path)
+                           if os.path.isfile(os.path.join(path, name)))
+        else:
+            roms.append(path)
+    return roms
+
+
+def run_batch(jobs, config_path='config.cfg', processes=None):
+    """
+    Run jobs (rom, seed, script, frames, cycles) across a process pool,
+    yielding their records in order
+    """
+    pool = multiprocessing.Pool(processes, load_config, (config_path,))
+    try:
+        for record in pool.imap(run_job, jobs):
+            yield record
+    finally:
+        pool.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run many ROMs headlessly across all cores')
+    parser.add_argument('roms', nargs='+', help='ROM files or directories of ROMs')
+    parser.add_argument('--config', default='config.cfg')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[56])
+    parser.add_argument('--scripts', nargs='+', default=[None], help='input scripts, each run with every ROM')
+    parser.add_argument('--frames', type=int, help='frames to run each job for')
+    parser.add_argument('--cycles', type=int, help='instructions to run each job for')
+    parser.add_argument('--jobs', type=int, help='worker processes, all cores by default')
+    parser.add_argument('--output', help='JSON lines file, stdout by default')
+    args = parser.parse_args()
+    if args.frames is None and args.cycles is None:
+        parser.error('one of --frames or --cycles is required')
+
+    jobs = [(rom, seed, script, args.frames, args.cycles)
+            for rom in find_roms(args.roms) for seed in args.seeds for script in args.scripts]
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for record in run_batch(jobs, args.config, args.jobs):
+            output.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import timeit
+from ConfigParser import ConfigParser
+from timeit import default_timer
+
+from headless import create_cpu
+from scheduler import Scheduler
+from translator import BlockTranslator
+
+
+def assemble(*opcodes):
+    return bytearray(b for op in opcodes for b in (op >> 8, op & 0xFF))
+
+
+# Synthetic programs, each looping forever over one kind of work
+ROMS = {
+    'alu': assemble(0x6105,  # 0x200: LD V1, 5
+                    0x8014,  # 0x202: ADD V0, V1
+                    0x8125,  # 0x204: SUB V1, V2
+                    0x8203,  # 0x206: XOR V2, V0
+                    0x8306,  # 0x208: SHR V3
+                    0x7401,  # 0x20A: ADD V4, 1
+                    0x8412,  # 0x20C: AND V4, V1
+                    0x850E,  # 0x20E: SHL V5
+                    0x8537,  # 0x210: SUBN V5, V3
+                    0x1202),  # 0x212: JP 0x202
+    'calls': assemble(0x2208,  # 0x200: CALL 0x208
+                      0x3000,  # 0x202: SE V0, 0
+                      0x7101,  # 0x204: ADD V1, 1
+                      0x1200,  # 0x206: JP 0x200
+                      0x7001,  # 0x208: ADD V0, 1
+                      0x5010,  # 0x20A: SE V0, V1
+                      0x00EE,  # 0x20C: RET
+                      0x00EE),  # 0x20E: RET
+    'draw': assemble(0xA000,  # 0x200: LD I, 0
+                     0xD015,  # 0x202: DRW V0, V1, 5
+                     0x7003,  # 0x204: ADD V0, 3
+                     0x7105,  # 0x206: ADD V1, 5
+                     0xD10F,  # 0x208: DRW V1, V0, 15
+                     0x1202),  # 0x20A: JP 0x202
+    'memory': assemble(0xA300,  # 0x200: LD I, 0x300
+                       0xF033,  # 0x202: LD B, V0
+                       0xF355,  # 0x204: LD [I], V3
+                       0xF365,  # 0x206: LD V3, [I]
+                       0x7407,  # 0x208: ADD V4, 7
+                       0x8040,  # 0x20A: LD V0, V4
+                       0x1202),  # 0x20C: JP 0x202
+    'idle': assemble(0x6078,  # 0x200: LD V0, 120
+                     0xF015,  # 0x202: LD DT, V0
+                     0xF107,  # 0x204: LD V1, DT
+                     0x3100,  # 0x206: SE V1, 0
+                     0x1204,  # 0x208: JP 0x204
+                     0x1200),  # 0x20A: JP 0x200
+}
+
+
+class StepEngine:
+    """
+    One CPU.execute_instruction call per instruction, the reference interpreter
+    """
+    def __init__(self, cpu):
+        self.cpu = cpu
+
+    def run(self, n_instructions):
+        execute_instruction = self.cpu.execute_instruction
+        for _ in range(n_instructions):
+            execute_instruction()
+
+
+ENGINES = {
+    'step': StepEngine,
+    'run': lambda cpu: cpu,
+    'translator': BlockTranslator,
+}
+
+
+def load_program(config, program):
+    cpu = create_cpu(config, seed=1)
+    cpu.memory[cpu.memory_start:cpu.memory_start+len(program)] = program
+    cpu.invalidate_decode_cache()
+    return cpu
+
+
+def bench_rom(config, program, engine, frames, cycles_per_frame, repeat=3):
+    """
+    Best of repeat runs of frames frames on a fresh machine
+    """
+    best = None
+    for _ in range(repeat):
+        cpu = load_program(config, program)
+        scheduler = Scheduler(cpu, cycles_per_frame, engine=ENGINES[engine](cpu))
+        start = default_timer()
+        for _ in range(frames):
+            scheduler.run_frame()
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return {
+        'frames': frames,
+        'instructions': frames*cycles_per_frame,
+        'seconds': best,
+        'frames_per_second': frames/best,
+        'instructions_per_second': frames*cycles_per_frame/best,
+    }
+
+
+def bench_calls(function, number, repeat=3):
+    best = min(timeit.repeat(function, number=number, repeat=repeat))
+    return {'calls': number, 'seconds': best, 'calls_per_second': number/best}
+
+
+def bench_micro(config, number):
+    results = {}
+    cpu = load_program(config, bytearray())
+    cpu.I = 0
+    cpu.opcode = 0xD12F
+    cpu.V_register[1] = 61
+    cpu.V_register[2] = 20
+    results['display_sprite'] = bench_calls(cpu.display_sprite, number)
+    results['Screen.clear'] = bench_calls(cpu.screen.clear, number)
+    state = cpu.snapshot()
+    results['CPU.snapshot'] = bench_calls(cpu.snapshot, number)
+    results['CPU.restore'] = bench_calls(lambda: cpu.restore(state), number)
+    results['CPU.clone'] = bench_calls(cpu.clone, number)
+    try:
+        import pygame
+        from screen import Screen
+    except ImportError:
+        return results
+    screen = Screen(64, 32, config.getint('SCREEN', 'scale_factor'))
+    screen.rows = list(cpu.screen.rows)
+    background = pygame.Surface((64*screen.scale, 32*screen.scale))
+
+    def redraw():
+        screen.dirty_rows = (1 << screen.height) - 1
+        screen.redraw(background)
+    results['Screen.redraw'] = bench_calls(redraw, max(number//100, 1))
+    return results
+
+
+def run_benchmarks(config, roms=None, engines=None, frames=200, cycles_per_frame=500, micro_calls=20000):
+    """
+    Time every engine on every synthetic ROM, then the drawing micro-benchmarks
+    """
+    results = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'cycles_per_frame': cycles_per_frame,
+        'roms': {},
+        'micro': {},
+    }
+    for rom in roms or sorted(ROMS):
+        results['roms'][rom] = dict((engine, bench_rom(config, ROMS[rom], engine, frames, cycles_per_frame))
+                                    for engine in engines or sorted(ENGINES))
+    if micro_calls:
+        results['micro'] = bench_micro(config, micro_calls)
+    return results
+
+
+def rates(results):
+    """
+    Flatten results into {name: rate}, the higher the better
+    """
+    flat = {}
+    for rom, engines in results['roms'].items():
+        for engine, result in engines.items():
+            flat['%s/%s' % (rom, engine)] = result['instructions_per_second']
+    for name, result in results['micro'].items():
+        flat[name] = result['calls_per_second']
+    return flat
+
+
+def report(results, baseline=None):
+    current = rates(results)
+    previous = rates(baseline) if baseline is not None else {}
+    lines = []
+    for name in sorted(current):
+        if name in results['micro']:
+            line = '{:<24} {:>14,.0f} calls/s'.format(name, current[name])
+        else:
+            rom, engine = name.split('/')
+            line = '{:<24} {:>14,.0f} instructions/s {:>10,.0f} frames/s'.format(
+                name, current[name], results['roms'][rom][engine]['frames_per_second'])
+        if name in previous:
+            line += '  {:+.1f}%'.format(100.0*(current[name]/previous[name] - 1))
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure interpreter, drawing and rendering throughput')
+    parser.add_argument('--config', default='config.cfg')
+    parser.add_argument('--roms', nargs='+', choices=sorted(ROMS))
+    parser.add_argument('--engines', nargs='+', choices=sorted(ENGINES))
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--cycles-per-frame', type=int, default=500)
+    parser.add_argument('--micro-calls', type=int, default=20000, help='0 to skip the micro-benchmarks')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.read(args.config)
+    results = run_benchmarks(config, args.roms, args.engines, args.frames, args.cycles_per_frame, args.micro_calls)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(report(results, baseline))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,63 @@
 from __future__ import division
 
-from random import randint, seed
 import array
+import struct
+
+# Reasons for CPU.run and CPU.run_until to return, also usable as a stop_on mask
+STOP_BUDGET = 0
+STOP_DRAW = 1
+STOP_KEY_WAIT = 2
+STOP_SOUND = 4
+STOP_PREDICATE = 8
+
+SNAPSHOT_MAGIC = b'C8SS'
+SNAPSHOT_VERSION = 2
+# magic, version, memory size, stack size, I, program counter, stack pointer,
+# delay timer, sound timer, opcode, cycles, pressed keys mask, RNG state, framebuffer size
+SNAPSHOT_HEADER = struct.Struct('>4sBHBHHhBBHQHIH')
+
+
+def xorshift_seed(s):
+    """
+    Spread any integer seed over a non-zero 32-bit xorshift state
+    """
+    return (s * 0x9E3779B1 + 0x7F4A7C15) & 0xFFFFFFFF or 1
+
+
+def xorshift32(state):
+    state ^= (state << 13) & 0xFFFFFFFF
+    state ^= state >> 17
+    state ^= (state << 5) & 0xFFFFFFFF
+    return state
+
+
+class CPU(object):
+    sprites = [
+        0xF0, 0x90, 0x90, 0x90, 0xF0,
+        0x20, 0x60, 0x20, 0x20, 0x70,
+        0xF0, 0x10, 0xF0, 0x80, 0xF0,
+        0xF0, 0x10, 0xF0, 0x10, 0xF0,
+        0x90, 0x90, 0xF0, 0x10, 0x10,
+        0xF0, 0x80, 0xF0, 0x10, 0xF0,
+        0xF0, 0x80, 0xF0, 0x90, 0xF0,
+        0xF0, 0x10, 0x20, 0x40, 0x40,
+        0xF0, 0x90, 0xF0, 0x90, 0xF0,
+        0xF0, 0x90, 0xF0, 0x10, 0xF0,
+        0xF0, 0x90, 0xF0, 0x90, 0x90,
+        0xE0, 0x90, 0xE0, 0x90, 0xE0,
+        0xF0, 0x80, 0x80, 0x80, 0xF0,
+        0xE0, 0x90, 0x90, 0x90, 0xE0,
+        0xF0, 0x80, 0xF0, 0x80, 0xF0,
+        0xF0, 0x80, 0xF0, 0x80, 0x80
+    ]
 
-
-class CPU:
     def __init__(self, config, _screen, _keyboard, _sound):
         self.memory_size = config.getint('CPU', 'memory_size')
         self.memory_start = config.getint('CPU', 'memory_start')
         self.register_size = config.getint('CPU', 'register_size')
         self.stack_size = config.getint('CPU', 'stack_size')
         self.sp_size = config.getint('CPU', 'sp_size')
-        self.clock_freq = config.getint('CPU', 'clock_freq')
+        self.cycles_per_frame = config.getint('CPU', 'cycles_per_frame')
         self.screen = _screen
         self.keyboard = _keyboard
         self.memory = bytearray(self.memory_size)  # 4096 * 8-bits
@@ -21,77 +67,49 @@ class CPU:
         self.stack_pointer = 0  # 1 * 8-bits
         self.program_counter = self.memory_start  # 1 * 16-bits
         self.opcode = 0x0000
+        self.cycles = 0
+        self.idle_cycles = 0  # cycles skipped by run in idle loops
+        self.decode_cache = [None]*self.memory_size
+        self.decode_cache_owned = True  # False while the decode cache is shared with a clone
+        self.invalidation_hooks = []
         self.delay_timer = 0
         self.sound_timer = 0
-        self.sprites = [
-            0xF0, 0x90, 0x90, 0x90, 0xF0,
-            0x20, 0x60, 0x20, 0x20, 0x70,
-            0xF0, 0x10, 0xF0, 0x80, 0xF0,
-            0xF0, 0x10, 0xF0, 0x10, 0xF0,
-            0x90, 0x90, 0xF0, 0x10, 0x10,
-            0xF0, 0x80, 0xF0, 0x10, 0xF0,
-            0xF0, 0x80, 0xF0, 0x90, 0xF0,
-            0xF0, 0x10, 0x20, 0x40, 0x40,
-            0xF0, 0x90, 0xF0, 0x90, 0xF0,
-            0xF0, 0x90, 0xF0, 0x10, 0xF0,
-            0xF0, 0x90, 0xF0, 0x90, 0x90,
-            0xE0, 0x90, 0xE0, 0x90, 0xE0,
-            0xF0, 0x80, 0x80, 0x80, 0xF0,
-            0xE0, 0x90, 0x90, 0x90, 0xE0,
-            0xF0, 0x80, 0xF0, 0x80, 0xF0,
-            0xF0, 0x80, 0xF0, 0x80, 0x80
-        ]
-        self.zero_functions = {
-            0x00E0: self.clear_display,
-            0x00EE: self.return_from_subroutine
-        }
-        self.eight_functions = {
-            0x0: self.set_vx_to_vy,
-            0x1: self.set_vx_to_vx_or_vy,
-            0x2: self.set_vx_to_vx_and_vy,
-            0x3: self.set_vx_to_vx_xor_vy,
-            0x4: self.set_vx_to_vx_plus_vy,
-            0x5: self.set_vx_to_vx_minus_vy,
-            0x6: self.set_vx_to_vx_shr,
-            0x7: self.set_vx_to_vy_minus_vx,
-            0xE: self.set_vx_to_vx_shl
-        }
-        self.main_functions = {
-            0x1: self.jump_to_location,
-            0x2: self.call_subroutine_at,
-            0x3: self.skip_next_if_vx_equals_kk,
-            0x4: self.skip_next_if_vx_not_equals_kk,
-            0x5: self.skip_next_if_vx_equals_vy,
-            0x6: self.set_vx_to_kk,
-            0x7: self.add_to_vx,
-            0x9: self.skip_next_if_vx_not_equals_vy,
-            0xA: self.set_i_register,
-            0xB: self.jump_to_location_shift,
-            0xC: self.set_vx_random,
-            0xD: self.display_sprite
-        }
-        self.e_functions = {
-            0x9E: self.skip_next_if_key_pressed,
-            0xA1: self.skip_next_if_key_not_pressed
-        }
-        self.f_functions = {
-            0x07: self.set_vx_dt_value,
-            0x0A: self.wait_for_key_pressed,
-            0x15: self.set_dt_to_vx,
-            0x18: self.set_st_to_vx,
-            0x1E: self.add_to_i,
-            0x29: self.set_i_to_vx_sprite,
-            0x33: self.store_vx_in_i,
-            0x55: self.write_vx_in_memory,
-            0x65: self.read_vx_from_memory
-        }
         self.load_sprites()
         self.sound = _sound
         self.set_seed(56)
 
-    @staticmethod
-    def set_seed(s):
-        seed(s)
+    def set_seed(self, s):
+        self.rng_state = xorshift_seed(s)
+
+    def clone(self):
+        """
+        Independent copy of the machine made without going through __init__.
+        The configuration, handler tables and sound are shared, and so is the
+        decode cache until either machine needs to change it; memory,
+        registers, stack, display and keyboard are copied. Blocks compiled
+        for this CPU are not carried over, and neither are handler tables
+        shadowed on this instance, such as a Debugger's: the clone decodes
+        through the class tables from an empty decode cache instead.
+        """
+        other = object.__new__(type(self))
+        other.__dict__.update(self.__dict__)
+        other.memory = bytearray(self.memory)
+        other.V_register = bytearray(self.V_register)
+        other.stack = array.array('H', self.stack)
+        other.invalidation_hooks = []
+        shadowed = [name for name in self.dispatch_tables if name in vars(self)]
+        if shadowed:
+            for name in shadowed:
+                del other.__dict__[name]
+            other.decode_cache = [None]*self.memory_size
+            other.decode_cache_owned = True
+        else:
+            self.decode_cache_owned = other.decode_cache_owned = False
+        if self.screen is not None:
+            other.screen = self.screen.copy()
+        if self.keyboard is not None:
+            other.keyboard = self.keyboard.copy()
+        return other
 
     def clear_display(self):
         """
@@ -178,27 +196,17 @@ class CPU:
         """
         0xCxkk - RND Vx, byte
         """
-        self.V_register[(self.opcode >> 8) & 0xF] = (self.opcode & 0x00FF) & randint(0, 0xFF)
+        self.rng_state = xorshift32(self.rng_state)
+        self.V_register[(self.opcode >> 8) & 0xF] = (self.opcode & 0x00FF) & (self.rng_state >> 24)
 
     def display_sprite(self):
         """
         0xDxyn - DRW Vx , Vy , nibble
         """
-        x_pos_init = self.V_register[(self.opcode >> 8) & 0xF]
-        y_pos_init = self.V_register[(self.opcode >> 4) & 0xF]
-        self.V_register[0xF] = 0
-        for y_shift in range(self.opcode & 0xF):
-            byte = self.memory[self.I+y_shift]
-            byte = '{0:0{1}b}'.format(byte, 8)
-            y_pos = (y_pos_init + y_shift) % self.screen.height
-            for x_shift, bit in enumerate(byte):
-                x_pos = (x_pos_init + x_shift) % self.screen.width
-                color = int(bit)
-                curr_color = self.screen.pixels_matrix[x_pos, y_pos]
-                if not (color == 0 and curr_color == 0):
-                    self.V_register[0xF] = not((color == 1) and (curr_color == 1))
-                    self.screen.to_redraw.append((x_pos, y_pos))
-                    self.screen.pixels_matrix[x_pos, y_pos] = color ^ curr_color
+        x_pos = self.V_register[(self.opcode >> 8) & 0xF]
+        y_pos = self.V_register[(self.opcode >> 4) & 0xF]
+        sprite = self.memory[self.I:self.I+(self.opcode & 0xF)]
+        self.V_register[0xF] = self.screen.draw_sprite(x_pos, y_pos, sprite)
 
     def set_vx_to_vy(self):
         """
@@ -273,14 +281,14 @@ class CPU:
         """
         0xEx9E - SKP Vx
         """
-        if self.keyboard.key_down == self.V_register[(self.opcode >> 8) & 0xF]:
+        if (self.keyboard.keys >> self.V_register[(self.opcode >> 8) & 0xF]) & 1:
             self.program_counter += 2
 
     def skip_next_if_key_not_pressed(self):
         """
         0xExA1 - SKNP Vx
         """
-        if self.keyboard.key_down != self.V_register[(self.opcode >> 8) & 0xF]:
+        if not (self.keyboard.keys >> self.V_register[(self.opcode >> 8) & 0xF]) & 1:
             self.program_counter += 2
 
     def set_vx_dt_value(self):
@@ -293,10 +301,11 @@ class CPU:
         """
         0xFx0A - LD Vx, K
         """
-        if self.keyboard.key_down is None:
+        keys = self.keyboard.keys
+        if not keys:
             self.program_counter -= 2
         else:
-            self.V_register[(self.opcode >> 8) & 0xF] = self.keyboard.key_down
+            self.V_register[(self.opcode >> 8) & 0xF] = (keys & -keys).bit_length() - 1
 
     def set_dt_to_vx(self):
         """
@@ -333,6 +342,7 @@ class CPU:
         self.memory[self.I] = x_val // 100
         self.memory[self.I+1] = (x_val // 10) % 10
         self.memory[self.I+2] = x_val % 10
+        self.invalidate_decode_cache(self.I, self.I+3)
 
     def write_vx_in_memory(self):
         """
@@ -341,6 +351,7 @@ class CPU:
         x_address = (self.opcode >> 8) & 0xF
         for v in range(0, x_address+1):
             self.memory[self.I+v] = self.V_register[v]
+        self.invalidate_decode_cache(self.I, self.I+x_address+1)
 
     def read_vx_from_memory(self):
         """
@@ -350,6 +361,53 @@ class CPU:
         for v in range(0, x_address+1):
             self.V_register[v] = self.memory[self.I+v]
 
+    # Handlers by opcode, shared by all instances and called with the CPU as argument
+    zero_functions = {
+        0x00E0: clear_display,
+        0x00EE: return_from_subroutine
+    }
+    eight_functions = {
+        0x0: set_vx_to_vy,
+        0x1: set_vx_to_vx_or_vy,
+        0x2: set_vx_to_vx_and_vy,
+        0x3: set_vx_to_vx_xor_vy,
+        0x4: set_vx_to_vx_plus_vy,
+        0x5: set_vx_to_vx_minus_vy,
+        0x6: set_vx_to_vx_shr,
+        0x7: set_vx_to_vy_minus_vx,
+        0xE: set_vx_to_vx_shl
+    }
+    main_functions = {
+        0x1: jump_to_location,
+        0x2: call_subroutine_at,
+        0x3: skip_next_if_vx_equals_kk,
+        0x4: skip_next_if_vx_not_equals_kk,
+        0x5: skip_next_if_vx_equals_vy,
+        0x6: set_vx_to_kk,
+        0x7: add_to_vx,
+        0x9: skip_next_if_vx_not_equals_vy,
+        0xA: set_i_register,
+        0xB: jump_to_location_shift,
+        0xC: set_vx_random,
+        0xD: display_sprite
+    }
+    e_functions = {
+        0x9E: skip_next_if_key_pressed,
+        0xA1: skip_next_if_key_not_pressed
+    }
+    f_functions = {
+        0x07: set_vx_dt_value,
+        0x0A: wait_for_key_pressed,
+        0x15: set_dt_to_vx,
+        0x18: set_st_to_vx,
+        0x1E: add_to_i,
+        0x29: set_i_to_vx_sprite,
+        0x33: store_vx_in_i,
+        0x55: write_vx_in_memory,
+        0x65: read_vx_from_memory
+    }
+    dispatch_tables = ('zero_functions', 'eight_functions', 'main_functions', 'e_functions', 'f_functions')
+
     def get_opcode_function(self):
         opcode_class = (self.opcode >> 12) & 0xf
         if opcode_class == 0:
@@ -367,8 +425,42 @@ class CPU:
             opcode_type = (self.opcode & 0xf000) >> 12
             return self.main_functions[opcode_type]
 
+    def decode_instruction(self, address):
+        """
+        Decode the instruction at address and remember it in the decode cache
+        """
+        self.opcode = self.memory[address] << 8 | self.memory[address+1]
+        entry = (self.opcode, self.get_opcode_function())
+        if not self.decode_cache_owned:
+            self.own_decode_cache()
+        self.decode_cache[address] = entry
+        return entry
+
+    def invalidate_decode_cache(self, start=0, end=None):
+        """
+        Forget the decoded instructions overlapping memory[start:end].
+        Must be called after any write into memory that may hold code.
+        """
+        if end is None:
+            end = self.memory_size
+        for hook in self.invalidation_hooks:
+            hook(start, end)
+        start = max(start-1, 0)
+        end = min(end, self.memory_size)
+        if not self.decode_cache_owned:
+            self.own_decode_cache()
+        self.decode_cache[start:end] = [None]*(end-start)
+
+    def own_decode_cache(self):
+        """
+        Stop sharing the decode cache with clones before writing to it
+        """
+        self.decode_cache = self.decode_cache[:]
+        self.decode_cache_owned = True
+
     def load_sprites(self):
-        self.memory[0:0xF*5] = self.sprites
+        self.memory[0:len(self.sprites)] = self.sprites
+        self.invalidate_decode_cache(0, len(self.sprites))
 
     def load_rom_into_memory(self, filename):
         with open(filename, 'rb') as f:
@@ -377,15 +469,282 @@ class CPU:
         assert (rom_size <= self.memory_size - self.memory_start), \
             'ROM {} is too big to fit in memory ({} bytes)'.format(filename, rom_size)
         self.memory[self.memory_start:self.memory_start+rom_size] = program_binaries
+        self.invalidate_decode_cache(self.memory_start, self.memory_start+rom_size)
+
+    def snapshot(self):
+        """
+        Machine state as a compact binary blob: header, memory, V registers,
+        stack, then the packed framebuffer
+        """
+        keys = self.keyboard.keys if self.keyboard is not None else 0
+        framebuffer = self.screen.to_bytes() if self.screen is not None else b''
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.memory_size, self.stack_size,
+                                      self.I, self.program_counter, self.stack_pointer,
+                                      self.delay_timer, self.sound_timer, self.opcode, self.cycles,
+                                      keys, self.rng_state, len(framebuffer))
+        return b''.join((header, bytes(self.memory), bytes(self.V_register),
+                         struct.pack('>%dH' % self.stack_size, *self.stack), framebuffer))
+
+    def restore(self, data):
+        """
+        Load a state produced by snapshot. Key events still queued belong
+        to the timeline left behind and are dropped.
+        """
+        (magic, version, memory_size, stack_size, self.I, self.program_counter, self.stack_pointer,
+         self.delay_timer, self.sound_timer, self.opcode, self.cycles,
+         keys, self.rng_state, framebuffer_size) = SNAPSHOT_HEADER.unpack_from(data)
+        assert (magic == SNAPSHOT_MAGIC and version == SNAPSHOT_VERSION), \
+            'Not a version {} snapshot'.format(SNAPSHOT_VERSION)
+        assert (memory_size == self.memory_size and stack_size == self.stack_size), \
+            'Snapshot of a machine with {} bytes of memory and {} stack entries'.format(memory_size, stack_size)
+        offset = SNAPSHOT_HEADER.size
+        memory = data[offset:offset+memory_size]
+        if self.memory != memory:
+            self.memory[:] = memory
+            self.invalidate_decode_cache()
+        offset += memory_size
+        self.V_register[:] = data[offset:offset+self.register_size]
+        offset += self.register_size
+        self.stack[:] = array.array('H', struct.unpack_from('>%dH' % stack_size, data, offset))
+        offset += 2*stack_size
+        if self.keyboard is not None:
+            self.keyboard.keys = keys
+            self.keyboard.events.clear()
+        if self.screen is not None and framebuffer_size:
+            self.screen.load_bytes(data[offset:offset+framebuffer_size])
+
+    def save_snapshot(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.snapshot())
+
+    def load_snapshot(self, filename):
+        with open(filename, 'rb') as f:
+            self.restore(f.read())
 
     def execute_instruction(self):
-        self.opcode = self.memory[self.program_counter] << 8 | self.memory[self.program_counter+1]
-        fun = self.get_opcode_function()
-        fun()
+        entry = self.decode_cache[self.program_counter]
+        if entry is None:
+            entry = self.decode_instruction(self.program_counter)
+        self.opcode, fun = entry
+        fun(self)
         self.program_counter += 2
+        self.cycles += 1
+
+    def run(self, n_instructions, stop_on=STOP_BUDGET):
+        """
+        Execute up to n_instructions with the hot state held in local variables.
+        stop_on is a mask of STOP_DRAW, STOP_KEY_WAIT and STOP_SOUND events
+        that end the batch right after the instruction causing them.
+        Return the reason for stopping.
+
+        Key events queued on the keyboard split the batch so that each one
+        is applied exactly at its cycle.
+        """
+        keyboard = self.keyboard
+        if keyboard is None or not keyboard.events:
+            return self.run_batch(n_instructions, stop_on)
+        end = self.cycles + n_instructions
+        while True:
+            keyboard.apply_events(self.cycles)
+            next_cycle = keyboard.next_event_cycle()
+            budget = end if next_cycle is None else min(end, next_cycle)
+            reason = self.run_batch(budget - self.cycles, stop_on)
+            if reason != STOP_BUDGET or self.cycles >= end:
+                return reason
+
+    def run_batch(self, n_instructions, stop_on):
+        """
+        Body of run for a batch during which the keys do not change.
+
+        Timers and keys cannot change before the batch ends, so a loop that
+        comes back to its backward jump in the same state, having only read
+        them in between, is spinning: the remaining whole iterations are
+        counted as executed without running them. The same goes for LD Vx, K
+        while no key is down.
+        """
+        memory = self.memory
+        V = self.V_register
+        stack = self.stack
+        cache = self.decode_cache
+        decode_instruction = self.decode_instruction
+        pc = self.program_counter
+        I = self.I
+        opcode = self.opcode
+        keys = self.keyboard.keys if self.keyboard is not None else 0
+        reason = STOP_BUDGET
+        executed = 0
+        loop_pc = None  # last backward jump, with the state and cycle it was reached at
+        loop_state = None
+        loop_executed = 0
+        touched = False  # instructions other than timer and key reads since the last backward jump
+        try:
+            while executed < n_instructions:
+                entry = cache[pc]
+                if entry is None:
+                    entry = decode_instruction(pc)
+                    cache = self.decode_cache
+                opcode, fun = entry
+                executed += 1
+                kind = opcode >> 12
+                x = (opcode >> 8) & 0xF
+                if kind == 6:
+                    V[x] = opcode & 0xFF
+                elif kind == 7:
+                    V[x] = (V[x] + (opcode & 0xFF)) & 0xFF
+                elif kind == 1:
+                    target = opcode & 0xFFF
+                    if target <= pc:
+                        sp = self.stack_pointer
+                        state = (bytes(V), I, sp, stack[:sp+1], self.delay_timer, self.sound_timer)
+                        if pc == loop_pc and not touched and state == loop_state:
+                            period = executed - loop_executed
+                            skipped = (n_instructions - executed) // period * period
+                            executed += skipped
+                            self.idle_cycles += skipped
+                        loop_pc = pc
+                        loop_state = state
+                        loop_executed = executed
+                        touched = False
+                    pc = target
+                    continue
+                elif kind == 3:
+                    if V[x] == opcode & 0xFF:
+                        pc += 2
+                elif kind == 4:
+                    if V[x] != opcode & 0xFF:
+                        pc += 2
+                elif kind == 8:
+                    y = (opcode >> 4) & 0xF
+                    operation = opcode & 0xF
+                    if operation == 0:
+                        V[x] = V[y]
+                    elif operation == 1:
+                        V[x] |= V[y]
+                    elif operation == 2:
+                        V[x] &= V[y]
+                    elif operation == 3:
+                        V[x] ^= V[y]
+                    elif operation == 4:
+                        value = V[x] + V[y]
+                        V[x] = value & 0xFF
+                        V[0xF] = value > 0xFF
+                    elif operation == 5:
+                        value = V[x] - V[y]
+                        V[0xF] = value > 0
+                        V[x] = value & 0xFF
+                    elif operation == 6:
+                        V[0xF] = V[x] & 0x1
+                        V[x] >>= 1
+                    elif operation == 7:
+                        value = V[y] - V[x]
+                        V[0xF] = value > 0
+                        V[x] = value & 0xFF
+                    else:
+                        V[0xF] = V[x] >> 7
+                        V[x] = (V[x] << 1) & 0xFF
+                elif kind == 0xA:
+                    I = opcode & 0xFFF
+                elif kind == 2:
+                    self.stack_pointer += 1
+                    stack[self.stack_pointer] = pc
+                    pc = opcode & 0xFFF
+                    continue
+                elif opcode == 0x00EE:
+                    pc = stack[self.stack_pointer] + 2
+                    self.stack_pointer -= 1
+                    continue
+                elif kind == 5:
+                    if V[x] == V[(opcode >> 4) & 0xF]:
+                        pc += 2
+                elif kind == 9:
+                    if V[x] != V[(opcode >> 4) & 0xF]:
+                        pc += 2
+                elif kind == 0xB:
+                    pc = V[0] + (opcode & 0xFFF)
+                    continue
+                elif kind == 0xC:
+                    r = self.rng_state
+                    r ^= (r << 13) & 0xFFFFFFFF
+                    r ^= r >> 17
+                    r ^= (r << 5) & 0xFFFFFFFF
+                    self.rng_state = r
+                    V[x] = (opcode & 0xFF) & (r >> 24)
+                    touched = True
+                elif kind == 0xE:
+                    pressed = (keys >> V[x]) & 1
+                    if pressed if opcode & 0xFF == 0x9E else not pressed:
+                        pc += 2
+                elif kind == 0xF and opcode & 0xFF not in (0x0A, 0x33, 0x55):
+                    operation = opcode & 0xFF
+                    if operation == 0x07:
+                        V[x] = self.delay_timer
+                    elif operation == 0x15:
+                        self.delay_timer = V[x]
+                    elif operation == 0x18:
+                        self.sound_timer = V[x]
+                        if stop_on & STOP_SOUND and V[x]:
+                            reason = STOP_SOUND
+                            pc += 2
+                            break
+                    elif operation == 0x1E:
+                        I = (I + V[x]) & 0xFFF
+                    elif operation == 0x29:
+                        I = 5*V[x]
+                    else:
+                        for v in range(0, x+1):
+                            V[v] = memory[I+v]
+                else:
+                    # Screen, key waits and memory writes go through the handlers
+                    address = pc
+                    self.program_counter = pc
+                    self.opcode = opcode
+                    self.I = I
+                    fun(self)
+                    cache = self.decode_cache
+                    pc = self.program_counter + 2
+                    if kind == 0xF and pc == address:
+                        if stop_on & STOP_KEY_WAIT:
+                            reason = STOP_KEY_WAIT
+                        else:
+                            self.idle_cycles += n_instructions - executed
+                            executed = n_instructions
+                        break
+                    touched = True
+                    if kind == 0xD and stop_on & STOP_DRAW:
+                        reason = STOP_DRAW
+                        break
+                    continue
+                pc += 2
+        finally:
+            self.program_counter = pc
+            self.I = I
+            self.opcode = opcode
+            self.cycles += executed
+        return reason
+
+    def run_until(self, predicate=None, max_cycles=None, stop_on=STOP_DRAW, batch=1024):
+        """
+        Run until predicate(cpu) holds or max_cycles instructions have been
+        executed. The predicate is checked at every stop_on event and at
+        least every batch instructions.
+        """
+        assert predicate is not None or max_cycles is not None, 'run_until needs a predicate or a budget'
+        end = None if max_cycles is None else self.cycles + max_cycles
+        while end is None or self.cycles < end:
+            n_instructions = batch if end is None else min(batch, end - self.cycles)
+            self.run(n_instructions, stop_on)
+            if predicate is not None and predicate(self):
+                return STOP_PREDICATE
+        return STOP_BUDGET
+
+    def tick_timers(self):
+        """
+        Decrement the delay and sound timers, to be called at 60 Hz.
+        The tone is on for the coming frame while the sound timer is non-zero.
+        """
         if self.delay_timer > 0:
             self.delay_timer -= 1
+        if self.sound is not None:
+            self.sound.update(self.sound_timer > 0)
         if self.sound_timer > 0:
             self.sound_timer -= 1
-            if self.sound_timer == 0:
-                self.sound.play()
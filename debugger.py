@@ -0,0 +1,347 @@
+from __future__ import print_function
+
+import argparse
+import cmd
+from ConfigParser import ConfigParser
+
+from cpu import STOP_BUDGET
+from headless import create_cpu
+
+# Reasons for Debugger.run to return, besides STOP_BUDGET
+STOP_BREAKPOINT = 1
+STOP_WATCHPOINT = 2
+STOP_CONDITION = 3
+
+# Fx opcodes touching memory from I: access and number of bytes after I
+MEMORY_ACCESSES = {
+    0x33: ('w', lambda opcode: 2),
+    0x55: ('w', lambda opcode: (opcode >> 8) & 0xF),
+    0x65: ('r', lambda opcode: (opcode >> 8) & 0xF),
+}
+
+
+class Debugger:
+    """
+    PC breakpoints, memory watchpoints and register conditions for a CPU.
+
+    Attaching shadows the CPU's Fx handler table with one whose LD B, Vx,
+    LD [I], Vx and LD Vx, [I] also look up the watched addresses, and
+    empties the decode cache so that instructions are decoded through it.
+    Use the debugger in place of the CPU as engine: it executes one
+    instruction at a time and pauses before a breakpoint address, or after
+    an instruction that hit a watchpoint or made a condition true. While
+    paused, run() does nothing until resume(). The CPU itself has no
+    checks and runs at full speed again after detach().
+
+    When cycles_per_frame is given, the debugger ticks the timers itself
+    every cycles_per_frame instructions, for use without a Scheduler.
+    """
+    def __init__(self, cpu, cycles_per_frame=None):
+        self.cpu = cpu
+        self.cycles_per_frame = cycles_per_frame
+        self.breakpoints = set()
+        self.watchpoints = {}  # address -> accesses to stop on, 'r', 'w' or 'rw'
+        self.conditions = []  # (name, predicate(cpu))
+        self.paused = False
+        self.hit = None  # (reason, detail) of the last stop
+        self.stopped_at = None  # breakpoint address to step past when resuming
+        self.access = None  # watched (address, access) made by the current instruction
+        self.attach()
+
+    def attach(self):
+        table = dict(type(self.cpu).f_functions)
+        for operation, (access, length) in MEMORY_ACCESSES.items():
+            table[operation] = self.watched(table[operation], access, length)
+        self.cpu.f_functions = table
+        self.cpu.invalidate_decode_cache()
+
+    def detach(self):
+        if 'f_functions' in vars(self.cpu):
+            del self.cpu.f_functions
+            self.cpu.invalidate_decode_cache()
+
+    def watched(self, fun, access, length):
+        watchpoints = self.watchpoints
+
+        def handler(cpu):
+            if watchpoints and cpu is self.cpu:
+                for address in range(cpu.I, cpu.I + length(cpu.opcode) + 1):
+                    if access in watchpoints.get(address, ''):
+                        self.access = (address, access)
+                        break
+            fun(cpu)
+        handler.__name__ = fun.__name__
+        return handler
+
+    def add_breakpoint(self, address):
+        self.breakpoints.add(address)
+
+    def remove_breakpoint(self, address):
+        self.breakpoints.discard(address)
+
+    def watch(self, address, length=1, access='rw'):
+        """
+        Stop after an Fx33, Fx55 or Fx65 reading ('r') or writing ('w')
+        memory[address:address+length]
+        """
+        for a in range(address, address+length):
+            self.watchpoints[a] = access
+
+    def unwatch(self, address, length=1):
+        for a in range(address, address+length):
+            self.watchpoints.pop(a, None)
+
+    def break_when(self, predicate, name=None):
+        """
+        Stop after an instruction leaving predicate(cpu) true
+        """
+        name = name or getattr(predicate, '__name__', 'condition')
+        self.conditions.append((name, predicate))
+        return name
+
+    def watch_register(self, x, value=None):
+        """
+        Stop when Vx changes, or when it changes to value
+        """
+        last = [self.cpu.V_register[x]]
+
+        def changed(cpu):
+            previous = last[0]
+            last[0] = current = cpu.V_register[x]
+            return current != previous and (value is None or current == value)
+        return self.break_when(changed, 'V%X' % x if value is None else 'V%X == 0x%02X' % (x, value))
+
+    def remove_condition(self, name):
+        self.conditions = [(n, predicate) for n, predicate in self.conditions if n != name]
+
+    def run(self, n_instructions):
+        """
+        Execute up to n_instructions unless paused.
+        Return the reason for stopping.
+        """
+        if self.paused:
+            return self.hit[0] if self.hit is not None else STOP_BUDGET
+        return self.execute(n_instructions)
+
+    def resume(self, max_instructions=None):
+        """
+        Leave the pause, running max_instructions right away when given
+        """
+        self.paused = False
+        if max_instructions is not None:
+            return self.execute(max_instructions)
+        return STOP_BUDGET
+
+    def step(self):
+        """
+        Execute one instruction, stepping past a breakpoint at the program
+        counter, and stay paused
+        """
+        reason = self.execute(1)
+        self.paused = True
+        return reason
+
+    def step_over(self, max_instructions=1000000):
+        """
+        Step, running a called subroutine until it returns
+        """
+        cpu = self.cpu
+        pc = cpu.program_counter
+        depth = cpu.stack_pointer
+        is_call = cpu.memory[pc] >> 4 == 0x2
+        reason = self.execute(1)
+        if is_call:
+            for _ in range(max_instructions):
+                if reason != STOP_BUDGET or (cpu.program_counter == pc+2 and cpu.stack_pointer == depth):
+                    break
+                reason = self.execute(1)
+        self.paused = True
+        return reason
+
+    def execute(self, n_instructions):
+        cpu = self.cpu
+        breakpoints = self.breakpoints
+        conditions = self.conditions
+        cycles_per_frame = self.cycles_per_frame
+        keyboard = cpu.keyboard
+        resume_at = self.stopped_at
+        self.stopped_at = None
+        self.hit = None
+        self.access = None  # left by instructions run without the debugger
+        for _ in range(n_instructions):
+            pc = cpu.program_counter
+            if pc in breakpoints and pc != resume_at:
+                self.stopped_at = pc
+                return self.stop(STOP_BREAKPOINT, pc)
+            resume_at = None
+            if keyboard is not None and keyboard.events:
+                keyboard.apply_events(cpu.cycles)
+            cpu.execute_instruction()
+            if cycles_per_frame and cpu.cycles % cycles_per_frame == 0:
+                cpu.tick_timers()
+            if self.access is not None:
+                access = self.access
+                self.access = None
+                return self.stop(STOP_WATCHPOINT, access)
+            if conditions:
+                hits = [name for name, predicate in conditions if predicate(cpu)]
+                if hits:
+                    return self.stop(STOP_CONDITION, hits[0])
+        return STOP_BUDGET
+
+    def stop(self, reason, detail):
+        self.hit = (reason, detail)
+        self.paused = True
+        return reason
+
+    def describe(self, address=None):
+        """
+        Address, opcode and handler name of the instruction at address,
+        the program counter by default
+        """
+        cpu = self.cpu
+        if address is None:
+            address = cpu.program_counter
+        opcode = cpu.memory[address] << 8 | cpu.memory[address+1]
+        saved = cpu.opcode
+        cpu.opcode = opcode
+        try:
+            name = cpu.get_opcode_function().__name__
+        except KeyError:
+            name = '?'
+        cpu.opcode = saved
+        return '0x{:03X}  {:04X}  {}'.format(address, opcode, name)
+
+
+def describe_hit(hit):
+    reason, detail = hit
+    if reason == STOP_BREAKPOINT:
+        return 'breakpoint at 0x{:03X}'.format(detail)
+    if reason == STOP_WATCHPOINT:
+        return 'watchpoint: {} 0x{:03X}'.format('read of' if detail[1] == 'r' else 'write to', detail[0])
+    return 'condition: {}'.format(detail)
+
+
+def parse_number(text):
+    return int(text, 16)
+
+
+class DebuggerShell(cmd.Cmd):
+    """
+    Command line over a Debugger, addresses and values in hexadecimal,
+    instruction counts in decimal
+    """
+    prompt = '(chip8) '
+
+    def __init__(self, debugger):
+        cmd.Cmd.__init__(self)
+        self.debugger = debugger
+        self.debugger.paused = True
+
+    def onecmd(self, line):
+        try:
+            return cmd.Cmd.onecmd(self, line)
+        except (ValueError, IndexError):
+            command = self.parseline(line)[0]
+            print('usage: {}'.format(getattr(self, 'do_' + command).__doc__))
+        except KeyError:
+            # Raised by the dispatch tables, before the program counter moves
+            self.debugger.paused = True
+            print('unknown opcode')
+            print(self.debugger.describe())
+
+    def report(self, reason):
+        if reason != STOP_BUDGET:
+            print(describe_hit(self.debugger.hit))
+        print(self.debugger.describe())
+
+    def do_break(self, arg):
+        """break ADDR: stop before executing ADDR"""
+        self.debugger.add_breakpoint(parse_number(arg))
+
+    def do_delete(self, arg):
+        """delete ADDR: remove the breakpoint at ADDR"""
+        self.debugger.remove_breakpoint(parse_number(arg))
+
+    def do_watch(self, arg):
+        """watch ADDR [LENGTH] [r|w|rw]: stop on Fx33, Fx55 or Fx65 accesses"""
+        args = arg.split()
+        length = parse_number(args[1]) if len(args) > 1 else 1
+        self.debugger.watch(parse_number(args[0]), length, args[2] if len(args) > 2 else 'rw')
+
+    def do_watchreg(self, arg):
+        """watchreg X [VALUE]: stop when VX changes, or changes to VALUE"""
+        args = arg.split()
+        print(self.debugger.watch_register(parse_number(args[0]), parse_number(args[1]) if len(args) > 1 else None))
+
+    def do_step(self, arg):
+        """step [N]: execute N instructions, 1 by default"""
+        reason = STOP_BUDGET
+        for _ in range(int(arg) if arg else 1):
+            reason = self.debugger.step()
+            if reason != STOP_BUDGET:
+                break
+        self.report(reason)
+
+    def do_next(self, arg):
+        """next: step over subroutine calls"""
+        self.report(self.debugger.step_over())
+
+    def do_continue(self, arg):
+        """continue: run until something is hit, or Ctrl-C"""
+        debugger = self.debugger
+        reason = debugger.resume()
+        try:
+            while not debugger.paused:
+                reason = debugger.run(1000)
+        except KeyboardInterrupt:
+            debugger.paused = True
+        self.report(reason)
+
+    def do_regs(self, arg):
+        """regs: print the registers"""
+        cpu = self.debugger.cpu
+        print(' '.join('V{:X}={:02X}'.format(x, v) for x, v in enumerate(cpu.V_register)))
+        print('I={:03X} PC={:03X} SP={} DT={} ST={} cycles={}'.format(
+            cpu.I, cpu.program_counter, cpu.stack_pointer, cpu.delay_timer, cpu.sound_timer, cpu.cycles))
+
+    def do_mem(self, arg):
+        """mem ADDR [LENGTH]: dump memory"""
+        args = arg.split()
+        address = parse_number(args[0])
+        length = parse_number(args[1]) if len(args) > 1 else 16
+        data = self.debugger.cpu.memory[address:address+length]
+        print(' '.join('%02X' % b for b in data))
+
+    def do_screen(self, arg):
+        """screen: print the display"""
+        print(self.debugger.cpu.screen.to_text())
+
+    def do_quit(self, arg):
+        """quit: leave the debugger"""
+        return True
+
+    do_b = do_break
+    do_s = do_step
+    do_n = do_next
+    do_c = do_continue
+    do_q = do_quit
+    do_EOF = do_quit
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Debug a CHIP-8 ROM')
+    parser.add_argument('rom')
+    parser.add_argument('--config', default='config.cfg')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.read(args.config)
+    cpu = create_cpu(config, args.rom, args.seed)
+    shell = DebuggerShell(Debugger(cpu, cpu.cycles_per_frame))
+    shell.cmdloop(shell.debugger.describe())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import multiprocessing
+from ConfigParser import ConfigParser
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+from headless import create_cpu, run_frames
+
+
+class Chip8Env:
+    """
+    reset()/step(action) environment around one headless machine.
+
+    An action is an index into actions, by default no key followed by the
+    keys 0 to F. The key is held for frames_per_step frames, then the
+    display is returned as a height x width array of 0 and 1. reward(cpu)
+    and done(cpu), when given, score the step and end the episode.
+    """
+    def __init__(self, rom_path, config_path='config.cfg', frames_per_step=4, actions=None, seed=None,
+                 reward=None, done=None):
+        config = ConfigParser()
+        config.read(config_path)
+        self.cpu = create_cpu(config, rom_path, seed)
+        self.boot = self.cpu.snapshot()
+        self.frames_per_step = frames_per_step
+        self.actions = tuple(actions) if actions is not None else (None,) + tuple(range(16))
+        self.reward = reward
+        self.done = done
+        self.observation_shape = (self.cpu.screen.height, self.cpu.screen.width)
+
+    def observation(self, out=None):
+        """
+        Display as a uint8 array, written into out when given
+        """
+        screen = self.cpu.screen
+        packed = np.array(screen.rows, dtype='>u8').view(np.uint8).reshape(screen.height, 8)
+        pixels = np.unpackbits(packed, axis=1)[:, 64-screen.width:]
+        if out is None:
+            return pixels
+        out[...] = pixels
+        return out
+
+    def reset(self, out=None):
+        self.cpu.restore(self.boot)
+        return self.observation(out)
+
+    def step(self, action, out=None):
+        cpu = self.cpu
+        cpu.keyboard.key_down = self.actions[action]
+        run_frames(cpu, self.frames_per_step)
+        reward = self.reward(cpu) if self.reward is not None else 0.0
+        done = bool(self.done(cpu)) if self.done is not None else False
+        return self.observation(out), reward, done, {'cycles': cpu.cycles}
+
+
+def vector_worker(connection, buffer, shape, first, env_args):
+    """
+    Host the environments first to first+len(env_args) of a VectorEnv,
+    writing their observations straight into the shared buffer
+    """
+    observations = np.frombuffer(buffer, dtype=np.uint8).reshape(shape)
+    envs = [Chip8Env(*args) for args in env_args]
+    try:
+        while True:
+            command, data = connection.recv()
+            if command == 'reset':
+                for i, env in enumerate(envs):
+                    env.reset(observations[first+i])
+                connection.send(None)
+            elif command == 'step':
+                results = []
+                for i, (env, action) in enumerate(zip(envs, data)):
+                    _, reward, done, _ = env.step(action, observations[first+i])
+                    if done:
+                        env.reset(observations[first+i])
+                    results.append((reward, done))
+                connection.send(results)
+            else:
+                break
+    finally:
+        connection.close()
+
+
+class VectorEnv:
+    """
+    n_envs Chip8Env spread over worker processes.
+
+    Observations live in one shared memory block that workers write
+    into, seen here as the n_envs x height x width array observations:
+    step() only sends the actions and receives the rewards and done flags.
+    Environments are reset as soon as their episode ends. Environment i
+    is seeded with seed + i.
+    """
+    def __init__(self, rom_path, n_envs, processes=None, config_path='config.cfg', frames_per_step=4,
+                 actions=None, seed=0, reward=None, done=None):
+        self.n_envs = n_envs
+        shape = (n_envs,) + Chip8Env(rom_path, config_path).observation_shape
+        self.buffer = RawArray('B', int(np.prod(shape)))
+        self.observations = np.frombuffer(self.buffer, dtype=np.uint8).reshape(shape)
+        processes = min(processes or multiprocessing.cpu_count(), n_envs)
+        self.connections = []
+        self.workers = []
+        first = 0
+        for p in range(processes):
+            count = n_envs // processes + (p < n_envs % processes)
+            env_args = [(rom_path, config_path, frames_per_step, actions, seed + i, reward, done)
+                        for i in range(first, first+count)]
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=vector_worker,
+                                             args=(worker_connection, self.buffer, shape, first, env_args))
+            worker.daemon = True
+            worker.start()
+            worker_connection.close()
+            self.connections.append((connection, first, count))
+            self.workers.append(worker)
+            first += count
+
+    def reset(self):
+        for connection, _, _ in self.connections:
+            connection.send(('reset', None))
+        for connection, _, _ in self.connections:
+            connection.recv()
+        return self.observations
+
+    def step(self, actions):
+        """
+        Step every environment with its action.
+        Return the observations, rewards and done flags as arrays.
+        """
+        for connection, first, count in self.connections:
+            connection.send(('step', list(actions[first:first+count])))
+        rewards = np.zeros(self.n_envs)
+        dones = np.zeros(self.n_envs, dtype=bool)
+        for connection, first, count in self.connections:
+            for i, (reward, done) in enumerate(connection.recv()):
+                rewards[first+i] = reward
+                dones[first+i] = done
+        return self.observations, rewards, dones
+
+    def close(self):
+        for connection, _, _ in self.connections:
+            connection.send(('close', None))
+            connection.close()
+        for worker in self.workers:
+            worker.join()
+        self.connections = []
+        self.workers = []
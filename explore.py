@@ -0,0 +1,233 @@
+from __future__ import print_function
+
+import argparse
+import hashlib
+import heapq
+import multiprocessing
+import struct
+from collections import deque
+from ConfigParser import ConfigParser
+from timeit import default_timer
+
+from headless import create_cpu, run_frames
+
+# I, program counter, stack pointer, delay timer, sound timer, RNG state
+STATE_REGISTERS = struct.Struct('>HHhBBI')
+
+worker_cpu = None
+worker_seen = set()  # digests this worker has already sent a snapshot of
+
+
+def state_digest(cpu):
+    """
+    SHA-1 of the machine state: memory, registers, program counter, stack,
+    timers, RNG state and display. The cycle count, the last opcode and the
+    keys are left out so that equal machines reached by different paths
+    compare equal.
+    """
+    digest = hashlib.sha1(cpu.memory)
+    digest.update(cpu.V_register)
+    digest.update(STATE_REGISTERS.pack(cpu.I, cpu.program_counter, cpu.stack_pointer,
+                                       cpu.delay_timer, cpu.sound_timer, cpu.rng_state))
+    digest.update(struct.pack('>%dH' % cpu.stack_size, *cpu.stack))
+    digest.update(cpu.screen.to_bytes())
+    return digest.digest()
+
+
+class MemoryScore:
+    """
+    Best-first priority: the byte at address, typically a score counter
+    """
+    def __init__(self, address):
+        self.address = address
+
+    def __call__(self, cpu):
+        return cpu.memory[self.address]
+
+
+def init_worker(config_path, rom_path, seed):
+    global worker_cpu
+    config = ConfigParser()
+    config.read(config_path)
+    worker_cpu = create_cpu(config, rom_path, seed)
+    worker_seen.clear()
+
+
+def expand(job):
+    """
+    Restore a snapshot and advance it by one step per action.
+    Return (action, digest, snapshot, score) for every child, without the
+    snapshot when this worker has already returned that state.
+    """
+    snapshot, actions, frames, score = job
+    child = worker_cpu
+    children = []
+    for action in actions:
+        # Restoring the same worker CPU keeps its decode cache warm, unlike clones
+        child.restore(snapshot)
+        child.keyboard.key_down = action
+        run_frames(child, frames)
+        digest = state_digest(child)
+        if digest in worker_seen:
+            children.append((action, digest, None, None))
+        else:
+            worker_seen.add(digest)
+            children.append((action, digest, child.snapshot(), score(child) if score else None))
+    return children
+
+
+class Explorer:
+    """
+    Search over keypad inputs from the boot state of a ROM.
+
+    Every step holds one key, or none, for frames_per_step frames. States
+    are identified by state_digest and expanded once. The frontier is a
+    FIFO for a breadth-first search, or a max-heap on score(cpu) for a
+    best-first one. Nodes are expanded batch_size at a time across
+    worker processes, each restoring the snapshots into its own CPU.
+    """
+    def __init__(self, rom_path, config_path='config.cfg', frames_per_step=6, actions=None, score=None,
+                 seed=None, processes=None, batch_size=64):
+        self.rom_path = rom_path
+        self.config_path = config_path
+        self.frames_per_step = frames_per_step
+        self.actions = tuple(actions) if actions is not None else (None,) + tuple(range(16))
+        self.score = score
+        self.seed = seed
+        self.processes = processes
+        self.batch_size = batch_size
+        self.parents = {}  # digest -> (parent digest, action), None for the root
+        self.depths = {}
+        self.scores = {}
+        self.root = None
+        self.expanded = 0
+        self.duplicates = 0
+        self.seconds = 0.0
+
+    def __len__(self):
+        return len(self.parents)
+
+    @property
+    def states_per_second(self):
+        return len(self) / self.seconds if self.seconds else 0.0
+
+    def path(self, digest):
+        """
+        Actions leading from the boot state to the state with this digest
+        """
+        actions = []
+        while self.parents[digest] is not None:
+            digest, action = self.parents[digest]
+            actions.append(action)
+        return actions[::-1]
+
+    def best(self):
+        """
+        Digest of the highest scoring state found
+        """
+        return max(self.scores, key=lambda digest: (self.scores[digest], -self.depths[digest]))
+
+    def run(self, max_states=None, max_depth=None):
+        """
+        Explore until the frontier is exhausted, max_states distinct states
+        have been found or every state up to max_depth steps has been expanded
+        """
+        start = default_timer()
+        init_worker(self.config_path, self.rom_path, self.seed)
+        self.root = state_digest(worker_cpu)
+        worker_seen.add(self.root)
+        self.parents = {self.root: None}
+        self.depths = {self.root: 0}
+        self.scores = {self.root: self.score(worker_cpu) if self.score else None}
+        frontier = Frontier(self.score is not None)
+        frontier.push(self.scores[self.root], (self.root, worker_cpu.snapshot()))
+        pool = None
+        if self.processes != 1:
+            pool = multiprocessing.Pool(self.processes, init_worker, (self.config_path, self.rom_path, self.seed))
+        expand_all = pool.map if pool is not None else lambda function, jobs: list(map(function, jobs))
+        try:
+            while frontier and (max_states is None or len(self) < max_states):
+                batch = frontier.pop(self.batch_size)
+                if max_depth is not None:
+                    batch = [node for node in batch if self.depths[node[0]] < max_depth]
+                jobs = [(snapshot, self.actions, self.frames_per_step, self.score) for digest, snapshot in batch]
+                for (parent, _), children in zip(batch, expand_all(expand, jobs)):
+                    self.expanded += 1
+                    for action, digest, snapshot, score in children:
+                        if digest in self.parents:
+                            self.duplicates += 1
+                            continue
+                        self.parents[digest] = (parent, action)
+                        self.depths[digest] = self.depths[parent] + 1
+                        self.scores[digest] = score
+                        frontier.push(score, (digest, snapshot))
+        finally:
+            if pool is not None:
+                pool.terminate()
+            self.seconds += default_timer() - start
+        return len(self)
+
+
+class Frontier:
+    """
+    FIFO of nodes, or max-heap on their scores for a best-first search
+    """
+    def __init__(self, by_score):
+        self.by_score = by_score
+        self.nodes = [] if by_score else deque()
+        self.count = 0  # keeps the heap stable among equal scores
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def push(self, score, node):
+        if self.by_score:
+            heapq.heappush(self.nodes, (-score, self.count, node))
+            self.count += 1
+        else:
+            self.nodes.append(node)
+
+    def pop(self, n):
+        n = min(n, len(self.nodes))
+        if self.by_score:
+            return [heapq.heappop(self.nodes)[2] for _ in range(n)]
+        return [self.nodes.popleft() for _ in range(n)]
+
+
+def format_action(action):
+    return '-' if action is None else '%X' % action
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Explore the states a ROM reaches under keypad inputs')
+    parser.add_argument('rom')
+    parser.add_argument('--config', default='config.cfg')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--frames-per-step', type=int, default=6)
+    parser.add_argument('--keys', nargs='+', help="hexadecimal keys to try, '-' for no key, all by default")
+    parser.add_argument('--score-address', type=lambda value: int(value, 0),
+                        help='explore best-first, maximizing the byte at this address')
+    parser.add_argument('--max-states', type=int, default=10000)
+    parser.add_argument('--max-depth', type=int)
+    parser.add_argument('--jobs', type=int, help='worker processes, all cores by default')
+    args = parser.parse_args()
+
+    actions = None
+    if args.keys:
+        actions = [None if key == '-' else int(key, 16) for key in args.keys]
+    score = MemoryScore(args.score_address) if args.score_address is not None else None
+    explorer = Explorer(args.rom, args.config, args.frames_per_step, actions, score, args.seed, args.jobs)
+    explorer.run(args.max_states, args.max_depth)
+    print('states: {}'.format(len(explorer)))
+    print('expanded: {}'.format(explorer.expanded))
+    print('duplicates: {}'.format(explorer.duplicates))
+    print('depth: {}'.format(max(explorer.depths.values())))
+    print('states/s: {:.0f}'.format(explorer.states_per_second))
+    if score is not None:
+        best = explorer.best()
+        print('best score: {}'.format(explorer.scores[best]))
+        print('inputs: {}'.format(' '.join(format_action(action) for action in explorer.path(best))))
+
+
+if __name__ == '__main__':
+    main()
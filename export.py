@@ -0,0 +1,254 @@
+import os
+import struct
+import threading
+import zlib
+from Queue import Full, Queue
+
+from framebuffer import pack_rows
+
+RAW_FRAME = struct.Struct('>I')  # frame number, followed by the packed rows
+
+
+def scale_rows(rows, width, scale):
+    """
+    Rows of a display enlarged scale times in both directions
+    """
+    if scale == 1:
+        return list(rows)
+    scaled = []
+    for row in rows:
+        bits = format(row, '0%db' % width)
+        scaled += [int(''.join(bit*scale for bit in bits), 2)]*scale
+    return scaled
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def encode_png(rows, width, height):
+    """
+    1-bit grayscale PNG of packed rows, lit pixels white
+    """
+    stride = (width+7)//8
+    packed = pack_rows([row << (8*stride - width) for row in rows], 8*stride)
+    scanlines = b''.join(b'\x00' + packed[y*stride:(y+1)*stride] for y in range(height))
+    return (b'\x89PNG\r\n\x1a\n' +
+            png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 1, 0, 0, 0, 0)) +
+            png_chunk(b'IDAT', zlib.compress(scanlines)) +
+            png_chunk(b'IEND', b''))
+
+
+def lzw_encode(pixels, min_code_size):
+    """
+    GIF variant of LZW: variable code width from min_code_size+1 to 12
+    bits, packed least significant bit first
+    """
+    clear = 1 << min_code_size
+    code_size = min_code_size + 1
+    next_code = clear + 2
+    codes = {}
+    out = bytearray()
+    buffer = clear
+    count = code_size
+    prefix = pixels[0]
+    for pixel in pixels[1:]:
+        key = (prefix << 8) | pixel
+        code = codes.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        buffer |= prefix << count
+        count += code_size
+        if next_code < 4096:
+            codes[key] = next_code
+            next_code += 1
+            if next_code > 1 << code_size:
+                code_size += 1
+        else:
+            buffer |= clear << count
+            count += code_size
+            codes = {}
+            next_code = clear + 2
+            code_size = min_code_size + 1
+        while count >= 8:
+            out.append(buffer & 0xFF)
+            buffer >>= 8
+            count -= 8
+        prefix = pixel
+    buffer |= prefix << count
+    count += code_size
+    buffer |= (clear + 1) << count
+    count += code_size
+    while count > 0:
+        out.append(buffer & 0xFF)
+        buffer >>= 8
+        count -= 8
+    return bytes(out)
+
+
+def gif_blocks(data):
+    return b''.join(struct.pack('B', len(data[i:i+255])) + data[i:i+255] for i in range(0, len(data), 255)) + b'\x00'
+
+
+class PNGWriter:
+    """
+    One PNG file per exported frame, named by pattern % frame number
+    """
+    def __init__(self, pattern, width=64, height=32, scale=1):
+        self.pattern = pattern
+        self.width = width
+        self.height = height
+        self.scale = scale
+
+    def write_frame(self, frame, rows):
+        width = self.width*self.scale
+        png = encode_png(scale_rows(rows, self.width, self.scale), width, self.height*self.scale)
+        with open(self.pattern % frame, 'wb') as f:
+            f.write(png)
+
+    def close(self):
+        pass
+
+
+class GIFWriter:
+    """
+    Looping animated GIF of the exported frames, each shown until the
+    next one, frame numbers being 1/60 s apart
+    """
+    frame_rate = 60
+
+    def __init__(self, path, width=64, height=32, scale=1):
+        self.file = open(path, 'wb')
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self.pending = None  # (frame, rows), written once its duration is known
+        self.file.write(b'GIF89a' + struct.pack('<HHBBB', width*scale, height*scale, 0x80, 0, 0) +
+                        b'\x00\x00\x00\xff\xff\xff' +
+                        b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+    def write_frame(self, frame, rows):
+        if self.pending is not None:
+            self.write_image(self.pending[1], frame - self.pending[0])
+        self.pending = (frame, rows)
+
+    def write_image(self, rows, frames):
+        width = self.width*self.scale
+        height = self.height*self.scale
+        bits = ''.join(format(row, '0%db' % width) for row in scale_rows(rows, self.width, self.scale))
+        pixels = bytearray(bits.replace('1', '\x01').replace('0', '\x00').encode('latin-1'))
+        delay = max(int(round(100.0*frames/self.frame_rate)), 1)
+        self.file.write(b'\x21\xf9\x04\x00' + struct.pack('<HBB', delay, 0, 0) +
+                        b'\x2c' + struct.pack('<HHHHB', 0, 0, width, height, 0) +
+                        b'\x02' + gif_blocks(lzw_encode(pixels, 2)))
+
+    def close(self):
+        if self.pending is not None:
+            self.write_image(self.pending[1], 1)
+            self.pending = None
+        self.file.write(b'\x3b')
+        self.file.close()
+
+
+class RawWriter:
+    """
+    Packed frames back to back, each preceded by its frame number
+    """
+    def __init__(self, path, width=64, height=32):
+        self.file = open(path, 'wb')
+        self.width = width
+
+    def write_frame(self, frame, rows):
+        self.file.write(RAW_FRAME.pack(frame) + pack_rows(rows, self.width))
+
+    def close(self):
+        self.file.close()
+
+
+FORMATS = ('png', 'gif', 'raw')
+
+
+def create_writer(kind, path, width=64, height=32, scale=1):
+    """
+    Writer for one of FORMATS. A PNG path without a % pattern is taken as
+    the directory to write the frames into.
+    """
+    if kind == 'png':
+        if '%' not in path:
+            path = os.path.join(path, 'frame%06d.png')
+        return PNGWriter(path, width, height, scale)
+    if kind == 'gif':
+        return GIFWriter(path, width, height, scale)
+    if kind == 'raw':
+        return RawWriter(path, width, height)
+    raise ValueError('unknown export format: %s' % kind)
+
+
+class FrameExporter:
+    """
+    Export frames of a running machine on a background thread.
+
+    Call it with the CPU after every frame, as the on_frame callback of
+    run_frames. Every every-th frame, or with changed_only every frame
+    whose display differs from the last exported one, a copy of the
+    framebuffer rows goes through a bounded queue to a thread that
+    encodes and writes it, so the emulation does not wait on the disk.
+    When the queue is full the frame is dropped and counted, unless
+    block is set.
+    """
+    def __init__(self, writer, every=1, changed_only=False, queue_size=64, block=False):
+        self.writer = writer
+        self.every = every
+        self.changed_only = changed_only
+        self.block = block
+        self.frame = 0
+        self.exported = 0
+        self.dropped = 0
+        self.last_rows = None
+        self.error = None
+        self.queue = Queue(queue_size)
+        self.thread = threading.Thread(target=self.consume)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __call__(self, cpu):
+        self.submit(cpu.screen)
+
+    def submit(self, screen):
+        frame = self.frame
+        self.frame += 1
+        if frame % self.every:
+            return
+        rows = screen.rows
+        if self.changed_only and rows == self.last_rows:
+            return
+        rows = list(rows)
+        try:
+            self.queue.put((frame, rows), self.block)
+        except Full:
+            self.dropped += 1
+            return
+        self.last_rows = rows
+        self.exported += 1
+
+    def consume(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    self.writer.write_frame(*item)
+                except Exception as e:
+                    self.error = e
+
+    def close(self):
+        """
+        Wait for the queued frames to be written and close the writer
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,91 @@
+from binascii import hexlify, unhexlify
+
+
+def pack_rows(rows, width):
+    """
+    Rows packed big-endian, (width+7)//8 bytes each
+    """
+    digits = 2*((width+7)//8)
+    return unhexlify(''.join('%0*x' % (digits, row) for row in rows))
+
+
+def xor_bytes(a, b):
+    return unhexlify('%0*x' % (2*len(a), int(hexlify(a), 16) ^ int(hexlify(b), 16)))
+
+
+class FrameBuffer(object):
+    """
+    Monochrome display packed as one integer per row.
+    The leftmost pixel of a row is its most significant bit.
+    """
+    def __init__(self, _w, _h):
+        self.height = _h
+        self.width = _w
+        self.row_mask = (1 << self.width) - 1
+        self.rows = None
+        self.dirty_rows = 0  # bit y set when row y changed since the last redraw
+        self.clear()
+
+    def clear(self):
+        self.rows = [0]*self.height
+        self.dirty_rows = (1 << self.height) - 1
+
+    def copy(self):
+        """
+        Independent display holding the same pixels, sharing everything else
+        but the methods shadowed on this instance
+        """
+        other = object.__new__(type(self))
+        other.__dict__.update((name, value) for name, value in self.__dict__.items() if not callable(value))
+        other.rows = list(self.rows)
+        return other
+
+    def to_bytes(self):
+        """
+        Rows packed big-endian, (width+7)//8 bytes each
+        """
+        return pack_rows(self.rows, self.width)
+
+    def load_bytes(self, data):
+        """
+        Restore rows packed by to_bytes
+        """
+        size = (self.width+7)//8
+        self.rows = [int(hexlify(data[y*size:(y+1)*size]), 16) for y in range(self.height)]
+        self.dirty_rows = (1 << self.height) - 1
+
+    def to_text(self, on='#', off='.'):
+        return '\n'.join(''.join(on if self.get_pixel(x, y) else off for x in range(self.width))
+                         for y in range(self.height))
+
+    def get_pixel(self, x, y):
+        return (self.rows[y] >> (self.width - 1 - x)) & 1
+
+    def set_pixel(self, x, y, value=1):
+        bit = 1 << (self.width - 1 - x)
+        self.rows[y] = self.rows[y] | bit if value else self.rows[y] & ~bit
+        self.dirty_rows |= 1 << y
+
+    def draw_sprite(self, x, y, sprite):
+        """
+        XOR the sprite bytes onto the rows starting at (x, y), wrapping around
+        the edges. Return True when a lit pixel has been erased.
+        """
+        width = self.width
+        height = self.height
+        mask = self.row_mask
+        rows = self.rows
+        x %= width
+        shift = width - 8
+        collision = 0
+        for byte in sprite:
+            y %= height
+            line = byte << shift
+            line = ((line >> x) | (line << (width - x))) & mask
+            row = rows[y]
+            collision |= row & line
+            rows[y] = row ^ line
+            if line:
+                self.dirty_rows |= 1 << y
+            y += 1
+        return collision != 0
@@ -0,0 +1,204 @@
+from __future__ import print_function
+
+import argparse
+import bisect
+import re
+import struct
+
+from framebuffer import FrameBuffer, pack_rows, xor_bytes
+
+STREAM_MAGIC = b'C8FS'
+STREAM_VERSION = 1
+STREAM_HEADER = struct.Struct('>4sBHHH')  # magic, version, width, height, keyframe interval
+RECORD = struct.Struct('>cH')  # kind, payload length
+# Records: b'K' a keyframe, b'D' the XOR with the previous frame, both
+# run-length encoded, b'S' a count of frames equal to the previous one
+REPEAT = struct.Struct('>H')
+
+ZERO_RUNS = re.compile(b'\x00{2,}')
+
+
+def rle_encode(data):
+    """
+    Run-length encode bytes that are mostly zeros: a token t < 0x80 is
+    followed by t+1 literal bytes, a token t >= 0x80 stands for t-0x7F zeros
+    """
+    out = bytearray()
+    start = 0
+    for match in ZERO_RUNS.finditer(data):
+        append_literals(out, data, start, match.start())
+        n = match.end() - match.start()
+        while n:
+            run = min(n, 128)
+            out.append(0x7F + run)
+            n -= run
+        start = match.end()
+    append_literals(out, data, start, len(data))
+    return bytes(out)
+
+
+def append_literals(out, data, start, end):
+    while start < end:
+        n = min(end - start, 128)
+        out.append(n - 1)
+        out += data[start:start+n]
+        start += n
+
+
+def rle_decode(data):
+    data = bytearray(data)
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        token = data[i]
+        if token < 0x80:
+            out += data[i+1:i+token+2]
+            i += token + 2
+        else:
+            out += bytearray(token - 0x7F)
+            i += 1
+    return bytes(out)
+
+
+class FrameStreamWriter:
+    """
+    Encode a sequence of displays into a frame stream.
+
+    Call write(screen) once per frame, typically right after the frame
+    ran. A frame equal to the previous one only extends a repeat count;
+    a changed one is stored as the XOR with the previous frame, which is
+    mostly zeros and run-length encoded. A keyframe is stored instead
+    when keyframe_interval frames have passed since the last one, which
+    bounds the work needed to seek.
+    """
+    def __init__(self, f, width=64, height=32, keyframe_interval=600):
+        self.file = f
+        self.width = width
+        self.height = height
+        self.keyframe_interval = keyframe_interval
+        self.frames = 0
+        self.last_keyframe = None
+        self.rows = None
+        self.repeats = 0
+        self.file.write(STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION, width, height, keyframe_interval))
+
+    def write(self, screen):
+        self.write_rows(screen.rows)
+
+    def write_rows(self, rows):
+        if rows == self.rows:
+            self.repeats += 1
+            if self.repeats == 0xFFFF:
+                self.flush()
+            self.frames += 1
+            return
+        self.flush()
+        if self.last_keyframe is None or self.frames - self.last_keyframe >= self.keyframe_interval:
+            self.write_record(b'K', rle_encode(pack_rows(rows, self.width)))
+            self.last_keyframe = self.frames
+        else:
+            delta = [row ^ previous for row, previous in zip(rows, self.rows)]
+            self.write_record(b'D', rle_encode(pack_rows(delta, self.width)))
+        self.rows = list(rows)
+        self.frames += 1
+
+    def write_record(self, kind, payload):
+        self.file.write(RECORD.pack(kind, len(payload)) + payload)
+
+    def flush(self):
+        """
+        Write out the pending repeat count
+        """
+        if self.repeats:
+            self.write_record(b'S', REPEAT.pack(self.repeats))
+            self.repeats = 0
+
+    def finish(self):
+        self.flush()
+        return self.frames
+
+
+class FrameStreamReader:
+    """
+    Random access to the frames of a stream.
+
+    Opening only indexes the records. A frame is rebuilt on demand from
+    the closest keyframe, or from the last frame decoded when that is
+    on the way, so reading frames in order costs one delta each.
+    Frames are returned packed as by FrameBuffer.to_bytes.
+    """
+    def __init__(self, data):
+        magic, version, self.width, self.height, self.keyframe_interval = STREAM_HEADER.unpack_from(data)
+        if magic != STREAM_MAGIC or version != STREAM_VERSION:
+            raise ValueError('not a frame stream')
+        self.data = data
+        self.starts = []  # first frame of each record
+        self.records = []  # (kind, payload offset, payload length)
+        self.keyframes = []  # indices of the keyframe records
+        frames = 0
+        offset = STREAM_HEADER.size
+        while offset < len(data):
+            kind, length = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if kind == b'K':
+                self.keyframes.append(len(self.records))
+            self.starts.append(frames)
+            self.records.append((kind, offset, length))
+            frames += REPEAT.unpack_from(data, offset)[0] if kind == b'S' else 1
+            offset += length
+        self.frames = frames
+        self.cached = None  # (record index, packed frame)
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            return cls(f.read())
+
+    def __len__(self):
+        return self.frames
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += self.frames
+        if not 0 <= n < self.frames:
+            raise IndexError('frame out of range')
+        target = bisect.bisect_right(self.starts, n) - 1
+        first = self.keyframes[bisect.bisect_right(self.keyframes, target) - 1]
+        if self.cached is not None and first <= self.cached[0] <= target:
+            first, frame = self.cached
+        else:
+            frame = None
+        for index in range(first if frame is None else first+1, target+1):
+            kind, offset, length = self.records[index]
+            if kind == b'K':
+                frame = rle_decode(self.data[offset:offset+length])
+            elif kind == b'D':
+                frame = xor_bytes(frame, rle_decode(self.data[offset:offset+length]))
+        self.cached = (target, frame)
+        return frame
+
+    def __iter__(self):
+        for n in range(self.frames):
+            yield self[n]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Describe a frame stream or print one of its frames')
+    parser.add_argument('stream')
+    parser.add_argument('--frame', type=int, help='print this frame')
+    args = parser.parse_args()
+
+    reader = FrameStreamReader.open(args.stream)
+    raw = len(reader) * reader.height * ((reader.width+7)//8)
+    print('frames: {}'.format(len(reader)))
+    print('keyframes: {}'.format(len(reader.keyframes)))
+    print('records: {}'.format(len(reader.records)))
+    print('size: {} bytes ({:.1f}x smaller than raw)'.format(len(reader.data), float(raw) / len(reader.data)))
+    if args.frame is not None:
+        screen = FrameBuffer(reader.width, reader.height)
+        screen.load_bytes(reader[args.frame])
+        print(screen.to_text())
+
+
+if __name__ == '__main__':
+    main()
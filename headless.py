@@ -0,0 +1,92 @@
+from __future__ import print_function
+
+import hashlib
+from ConfigParser import ConfigParser
+
+from audio import NullAudio
+from cpu import CPU
+from framebuffer import FrameBuffer
+from keyboard import Keyboard
+from scheduler import Scheduler
+
+
+def create_cpu(config, rom_path=None, seed=None):
+    """
+    CPU wired to an in-memory framebuffer, a keyboard and silent audio
+    """
+    cpu = CPU(config, FrameBuffer(64, 32), Keyboard(), NullAudio())
+    if seed is not None:
+        cpu.set_seed(seed)
+    if rom_path is not None:
+        cpu.load_rom_into_memory(rom_path)
+    return cpu
+
+
+def run_frames(cpu, n_frames, cycles_per_frame=None, on_frame=None):
+    """
+    Run n_frames frames as fast as possible, ticking the timers between
+    frames and calling on_frame(cpu) after each one
+    """
+    scheduler = Scheduler(cpu, cycles_per_frame or cpu.cycles_per_frame)
+    for _ in range(n_frames):
+        scheduler.run_frame()
+        if on_frame is not None:
+            on_frame(cpu)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a CHIP-8 ROM without a display')
+    parser.add_argument('rom')
+    parser.add_argument('--config', default='config.cfg')
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--show', action='store_true', help='print the final display')
+    parser.add_argument('--record-frames', help='write every frame to this frame stream file')
+    parser.add_argument('--export', help='export frames to this file, or directory of PNG files')
+    parser.add_argument('--export-format', default='png', help='png, gif or raw')
+    parser.add_argument('--export-every', type=int, default=1, help='export one frame out of this many')
+    parser.add_argument('--export-changed', action='store_true', help='only export frames that changed')
+    parser.add_argument('--export-scale', type=int, default=1)
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.read(args.config)
+    cpu = create_cpu(config, args.rom, args.seed)
+    width, height = cpu.screen.width, cpu.screen.height
+    callbacks = []
+    stream = None
+    if args.record_frames:
+        from framestream import FrameStreamWriter
+        stream = FrameStreamWriter(open(args.record_frames, 'wb'), width, height)
+        callbacks.append(lambda cpu: stream.write(cpu.screen))
+    exporter = None
+    if args.export:
+        # Only exports pay for the encoder thread, zlib and the queue
+        from export import FORMATS, FrameExporter, create_writer
+        if args.export_format not in FORMATS:
+            parser.error('unknown export format: %s' % args.export_format)
+        writer = create_writer(args.export_format, args.export, width, height, args.export_scale)
+        # Offline, waiting for the encoder beats losing frames
+        exporter = FrameExporter(writer, args.export_every, args.export_changed, block=True)
+        callbacks.append(exporter)
+
+    def on_frame(cpu):
+        for callback in callbacks:
+            callback(cpu)
+    run_frames(cpu, args.frames, on_frame=on_frame if callbacks else None)
+    if stream is not None:
+        stream.finish()
+        stream.file.close()
+    if exporter is not None:
+        exporter.close()
+        print('exported: {} frames'.format(exporter.exported))
+    if args.show:
+        print(cpu.screen.to_text())
+    print('cycles: {} ({} idle)'.format(cpu.cycles, cpu.idle_cycles))
+    print('frame: {}'.format(hashlib.sha1(cpu.screen.to_bytes()).hexdigest()))
+    print('V: {}'.format(' '.join('%02X' % v for v in cpu.V_register)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,14 @@
-class Keyboard:
+from collections import deque
+
+
+class Keyboard(object):
+    """
+    Keypad state as a 16-bit mask, bit k set while key k is held.
+
+    Key changes can be queued with push_event for a given cycle; the CPU
+    splits its batches so that each one is applied exactly at the start of
+    that cycle.
+    """
     def __init__(self):
         self.keymap = {
             'a': 0, 'q': 1, 'w': 2, 'z': 3,
@@ -6,11 +16,89 @@ class Keyboard:
             'c': 8, 'r': 9, 'f': 0xA, 'v': 0xB,
             't': 0xC, 'g': 0xD, 'b': 0xE, 'y': 0xF
         }
-        self.key_down = None
+        self.keys = 0
+        self.events = deque()  # (cycle, key, pressed) in cycle order
+
+    @property
+    def key_down(self):
+        """
+        Lowest held key, None when no key is held
+        """
+        keys = self.keys
+        return (keys & -keys).bit_length() - 1 if keys else None
+
+    @key_down.setter
+    def key_down(self, key):
+        self.keys = 0 if key is None else 1 << key
+
+    def copy(self):
+        other = object.__new__(Keyboard)
+        other.keymap = self.keymap
+        other.keys = self.keys
+        other.events = deque(self.events)
+        return other
+
+    def is_pressed(self, key):
+        return (self.keys >> key) & 1 == 1
+
+    def press(self, key):
+        self.keys |= 1 << key
+
+    def release(self, key):
+        self.keys &= ~(1 << key)
 
     def set_key_down(self, key_id):
-        self.key_down = self.keymap[key_id]
+        self.press(self.keymap[key_id])
 
     def reset_key_state(self):
-        self.key_down = None
+        self.keys = 0
+
+    def push_event(self, cycle, key, pressed):
+        """
+        Queue a key press or release for the given CPU cycle, after the
+        events already queued for that cycle
+        """
+        events = self.events
+        i = len(events)
+        while i and events[i-1][0] > cycle:
+            i -= 1
+        # deque.insert is Python 3.5+: rotate position i to the front instead
+        events.rotate(-i)
+        events.appendleft((cycle, key, pressed))
+        events.rotate(i)
+
+    def push_inputs(self, cycle, inputs, hold):
+        """
+        Queue the (key, pressed) inputs gathered since the last frame for
+        cycle. A key both pressed and released among them is released hold
+        cycles later so that the tap is not lost, unless it is pressed again
+        afterwards and so still held.
+        """
+        pressed = set()
+        delayed = set()  # keys to release hold cycles later
+        for key, down in inputs:
+            if down:
+                self.push_event(cycle, key, True)
+                pressed.add(key)
+                delayed.discard(key)
+            elif key in pressed:
+                delayed.add(key)
+            else:
+                self.push_event(cycle, key, False)
+        for key in sorted(delayed):
+            self.push_event(cycle + hold, key, False)
+
+    def next_event_cycle(self):
+        return self.events[0][0] if self.events else None
 
+    def apply_events(self, cycle):
+        """
+        Apply the queued events due at or before cycle
+        """
+        events = self.events
+        while events and events[0][0] <= cycle:
+            _, key, pressed = events.popleft()
+            if pressed:
+                self.keys |= 1 << key
+            else:
+                self.keys &= ~(1 << key)
@@ -0,0 +1,328 @@
+import numpy as np
+
+from cpu import CPU, xorshift_seed
+
+
+class LockstepCPU:
+    """
+    N CHIP-8 machines held as arrays and stepped together.
+
+    Every step fetches the current instruction of all machines, then applies
+    each opcode family to the machines executing it, following the handlers
+    of cpu.CPU. The display is packed as one uint64 per row, leftmost pixel
+    in the most significant bit, like framebuffer.FrameBuffer. A machine
+    meeting an unknown opcode or an out of range access is marked as
+    faulted and stops advancing.
+    """
+    width = 64
+    height = 32
+
+    def __init__(self, config, n_machines, seed=56):
+        self.n_machines = n_machines
+        self.memory_size = config.getint('CPU', 'memory_size')
+        self.memory_start = config.getint('CPU', 'memory_start')
+        self.register_size = config.getint('CPU', 'register_size')
+        self.stack_size = config.getint('CPU', 'stack_size')
+        self.cycles_per_frame = config.getint('CPU', 'cycles_per_frame')
+        self.lanes = np.arange(n_machines)
+        self.memory = np.zeros((n_machines, self.memory_size), dtype=np.uint8)
+        self.V_register = np.zeros((n_machines, self.register_size), dtype=np.uint8)
+        self.I = np.zeros(n_machines, dtype=np.int32)
+        self.stack = np.zeros((n_machines, self.stack_size), dtype=np.int32)
+        self.stack_pointer = np.zeros(n_machines, dtype=np.int32)
+        self.program_counter = np.full(n_machines, self.memory_start, dtype=np.int32)
+        self.delay_timer = np.zeros(n_machines, dtype=np.int32)
+        self.sound_timer = np.zeros(n_machines, dtype=np.int32)
+        self.rows = np.zeros((n_machines, self.height), dtype=np.uint64)
+        self.keys = np.zeros(n_machines, dtype=np.uint16)  # bit k set while key k is held, like Keyboard
+        self.faulted = np.zeros(n_machines, dtype=bool)
+        self.cycles = 0
+        self.rng_state = np.full(n_machines, xorshift_seed(seed), dtype=np.uint32)
+        self.main_functions = {
+            0x0: self.zero_functions,
+            0x1: self.jump_to_location,
+            0x2: self.call_subroutine_at,
+            0x3: self.skip_next_if_vx_equals_kk,
+            0x4: self.skip_next_if_vx_not_equals_kk,
+            0x5: self.skip_next_if_vx_equals_vy,
+            0x6: self.set_vx_to_kk,
+            0x7: self.add_to_vx,
+            0x8: self.eight_functions,
+            0x9: self.skip_next_if_vx_not_equals_vy,
+            0xA: self.set_i_register,
+            0xB: self.jump_to_location_shift,
+            0xC: self.set_vx_random,
+            0xD: self.display_sprite,
+            0xE: self.e_functions,
+            0xF: self.f_functions
+        }
+        self.memory[:, 0:len(CPU.sprites)] = CPU.sprites
+
+    def load_rom_into_memory(self, filename):
+        with open(filename, 'rb') as f:
+            program_binaries = bytearray(f.read())
+        rom_size = len(program_binaries)
+        assert (rom_size <= self.memory_size - self.memory_start), \
+            'ROM {} is too big to fit in memory ({} bytes)'.format(filename, rom_size)
+        self.memory[:, self.memory_start:self.memory_start+rom_size] = np.frombuffer(program_binaries, np.uint8)
+
+    def framebuffer_bytes(self, machine):
+        """
+        Display of one machine packed like FrameBuffer.to_bytes
+        """
+        return self.rows[machine].astype('>u8').tobytes()
+
+    def fault(self, lanes):
+        self.faulted[lanes] = True
+
+    def step(self):
+        """
+        Execute one instruction on every machine that has not faulted
+        """
+        pc = self.program_counter
+        self.fault(pc > self.memory_size - 2)
+        active = ~self.faulted
+        fetch = np.minimum(pc, self.memory_size - 2)
+        opcode = (self.memory[self.lanes, fetch].astype(np.int32) << 8) | self.memory[self.lanes, fetch+1]
+        kind = opcode >> 12
+        next_pc = pc + 2
+        for k in np.nonzero(np.bincount(kind[active], minlength=16))[0]:
+            lanes = np.nonzero(active & (kind == k))[0]
+            self.main_functions[k](lanes, opcode[lanes], next_pc)
+        self.program_counter = np.where(self.faulted, pc, next_pc).astype(np.int32)
+        self.cycles += 1
+
+    def run(self, n_instructions):
+        for _ in range(n_instructions):
+            self.step()
+
+    def tick_timers(self):
+        np.maximum(self.delay_timer - 1, 0, out=self.delay_timer)
+        np.maximum(self.sound_timer - 1, 0, out=self.sound_timer)
+
+    def run_frames(self, n_frames):
+        for _ in range(n_frames):
+            self.run(self.cycles_per_frame)
+            self.tick_timers()
+
+    def zero_functions(self, lanes, opcode, next_pc):
+        """
+        0x00E0 - CLR, 0x00EE - RET
+        """
+        self.rows[lanes[opcode == 0x00E0]] = 0
+        ret = lanes[opcode == 0x00EE]
+        sp = self.stack_pointer[ret]
+        next_pc[ret] = self.stack[ret, sp % self.stack_size] + 2
+        self.stack_pointer[ret] = sp - 1
+        self.fault(lanes[(opcode != 0x00E0) & (opcode != 0x00EE)])
+
+    def jump_to_location(self, lanes, opcode, next_pc):
+        """
+        0x1nnn - JP addr
+        """
+        next_pc[lanes] = opcode & 0x0FFF
+
+    def call_subroutine_at(self, lanes, opcode, next_pc):
+        """
+        0x2nnn - CALL addr
+        """
+        sp = self.stack_pointer[lanes] + 1
+        overflow = sp >= self.stack_size
+        self.fault(lanes[overflow])
+        lanes, opcode, sp = lanes[~overflow], opcode[~overflow], sp[~overflow]
+        self.stack_pointer[lanes] = sp
+        self.stack[lanes, sp] = self.program_counter[lanes]
+        next_pc[lanes] = opcode & 0x0FFF
+
+    def skip_next_if_vx_equals_kk(self, lanes, opcode, next_pc):
+        """
+        0x3xkk - SE Vx, byte
+        """
+        next_pc[lanes[self.V_register[lanes, (opcode >> 8) & 0xF] == opcode & 0xFF]] += 2
+
+    def skip_next_if_vx_not_equals_kk(self, lanes, opcode, next_pc):
+        """
+        0x4xkk - SNE Vx, byte
+        """
+        next_pc[lanes[self.V_register[lanes, (opcode >> 8) & 0xF] != opcode & 0xFF]] += 2
+
+    def skip_next_if_vx_equals_vy(self, lanes, opcode, next_pc):
+        """
+        0x5xy0 - SE Vx , Vy
+        """
+        V = self.V_register
+        next_pc[lanes[V[lanes, (opcode >> 8) & 0xF] == V[lanes, (opcode >> 4) & 0xF]]] += 2
+
+    def skip_next_if_vx_not_equals_vy(self, lanes, opcode, next_pc):
+        """
+        0x9xy0 - SNE Vx, Vy
+        """
+        V = self.V_register
+        next_pc[lanes[V[lanes, (opcode >> 8) & 0xF] != V[lanes, (opcode >> 4) & 0xF]]] += 2
+
+    def set_vx_to_kk(self, lanes, opcode, next_pc):
+        """
+        0x6xkk - LD Vx, byte
+        """
+        self.V_register[lanes, (opcode >> 8) & 0xF] = opcode & 0xFF
+
+    def add_to_vx(self, lanes, opcode, next_pc):
+        """
+        0x7xkk - ADD Vx, byte
+        """
+        x = (opcode >> 8) & 0xF
+        self.V_register[lanes, x] = (self.V_register[lanes, x] + (opcode & 0xFF)) & 0xFF
+
+    def set_i_register(self, lanes, opcode, next_pc):
+        """
+        0xAnnn - LD I, addr
+        """
+        self.I[lanes] = opcode & 0x0FFF
+
+    def jump_to_location_shift(self, lanes, opcode, next_pc):
+        """
+        0xBnnn - JP V0, addr
+        """
+        next_pc[lanes] = self.V_register[lanes, 0] + (opcode & 0x0FFF)
+
+    def set_vx_random(self, lanes, opcode, next_pc):
+        """
+        0xCxkk - RND Vx, byte
+        """
+        r = self.rng_state[lanes]
+        r ^= r << 13
+        r ^= r >> 17
+        r ^= r << 5
+        self.rng_state[lanes] = r
+        self.V_register[lanes, (opcode >> 8) & 0xF] = (opcode & 0xFF) & (r >> 24)
+
+    def display_sprite(self, lanes, opcode, next_pc):
+        """
+        0xDxyn - DRW Vx , Vy , nibble
+        """
+        V = self.V_register
+        x_pos = (V[lanes, (opcode >> 8) & 0xF] % self.width).astype(np.uint64)
+        y_pos = V[lanes, (opcode >> 4) & 0xF].astype(np.int32)
+        height = opcode & 0xF
+        address = self.I[lanes]
+        collision = np.zeros(len(lanes), dtype=np.uint64)
+        wrap = np.uint64(self.width) - x_pos
+        for y_shift in range(height.max() if len(lanes) else 0):
+            drawing = (height > y_shift) & (address + y_shift < self.memory_size)
+            sprite = self.memory[lanes, np.minimum(address + y_shift, self.memory_size - 1)]
+            line = (sprite.astype(np.uint64) << np.uint64(self.width - 8)) * drawing.astype(np.uint64)
+            line = (line >> x_pos) | np.where(x_pos == 0, np.uint64(0), line << wrap)
+            y = (y_pos + y_shift) % self.height
+            collision |= self.rows[lanes, y] & line
+            self.rows[lanes, y] ^= line
+        V[lanes, 0xF] = collision != 0
+
+    def eight_functions(self, lanes, opcode, next_pc):
+        """
+        0x8xy0 to 0x8xyE - register to register operations
+        """
+        V = self.V_register
+        operations = opcode & 0xF
+        for operation in np.unique(operations):
+            selected = operations == operation
+            l = lanes[selected]
+            x = (opcode[selected] >> 8) & 0xF
+            y = (opcode[selected] >> 4) & 0xF
+            if operation == 0x0:
+                V[l, x] = V[l, y]
+            elif operation == 0x1:
+                V[l, x] = V[l, x] | V[l, y]
+            elif operation == 0x2:
+                V[l, x] = V[l, x] & V[l, y]
+            elif operation == 0x3:
+                V[l, x] = V[l, x] ^ V[l, y]
+            elif operation == 0x4:
+                value = V[l, x].astype(np.int32) + V[l, y]
+                V[l, x] = value & 0xFF
+                V[l, 0xF] = value > 0xFF
+            elif operation == 0x5:
+                value = V[l, x].astype(np.int32) - V[l, y]
+                V[l, 0xF] = value > 0
+                V[l, x] = value & 0xFF
+            elif operation == 0x6:
+                V[l, 0xF] = V[l, x] & 0x1
+                V[l, x] = V[l, x] >> 1
+            elif operation == 0x7:
+                value = V[l, y].astype(np.int32) - V[l, x]
+                V[l, 0xF] = value > 0
+                V[l, x] = value & 0xFF
+            elif operation == 0xE:
+                V[l, 0xF] = V[l, x] >> 7
+                V[l, x] = (V[l, x].astype(np.int32) << 1) & 0xFF
+            else:
+                self.fault(l)
+
+    def is_pressed(self, lanes, key):
+        """
+        Whether each machine holds key, False for values above 0xF
+        """
+        return (key < 16) & ((self.keys[lanes] >> (key & 0xF)) & 1 == 1)
+
+    def lowest_key(self, lanes):
+        """
+        Lowest held key of each machine, -1 when no key is held
+        """
+        keys = self.keys[lanes]
+        key = np.full(len(lanes), -1, dtype=np.int32)
+        for k in range(15, -1, -1):
+            key[(keys >> k) & 1 == 1] = k
+        return key
+
+    def e_functions(self, lanes, opcode, next_pc):
+        """
+        0xEx9E - SKP Vx, 0xExA1 - SKNP Vx
+        """
+        pressed = self.is_pressed(lanes, self.V_register[lanes, (opcode >> 8) & 0xF])
+        next_pc[lanes[(opcode & 0xFF == 0x9E) & pressed]] += 2
+        next_pc[lanes[(opcode & 0xFF == 0xA1) & ~pressed]] += 2
+        self.fault(lanes[(opcode & 0xFF != 0x9E) & (opcode & 0xFF != 0xA1)])
+
+    def f_functions(self, lanes, opcode, next_pc):
+        """
+        0xFx07 to 0xFx65 - timers, keyboard, I and memory transfers
+        """
+        V = self.V_register
+        operations = opcode & 0xFF
+        for operation in np.unique(operations):
+            selected = operations == operation
+            l = lanes[selected]
+            x = (opcode[selected] >> 8) & 0xF
+            if operation == 0x07:
+                V[l, x] = self.delay_timer[l]
+            elif operation == 0x0A:
+                key = self.lowest_key(l)
+                waiting = key < 0
+                next_pc[l[waiting]] = self.program_counter[l[waiting]]
+                V[l[~waiting], x[~waiting]] = key[~waiting]
+            elif operation == 0x15:
+                self.delay_timer[l] = V[l, x]
+            elif operation == 0x18:
+                self.sound_timer[l] = V[l, x]
+            elif operation == 0x1E:
+                self.I[l] = (self.I[l] + V[l, x]) & 0xFFF
+            elif operation == 0x29:
+                self.I[l] = 5*V[l, x].astype(np.int32)
+            elif operation in (0x33, 0x55, 0x65):
+                last = 2 if operation == 0x33 else x
+                overflow = self.I[l] + last >= self.memory_size
+                self.fault(l[overflow])
+                l, x, address = l[~overflow], x[~overflow], self.I[l[~overflow]]
+                if operation == 0x33:
+                    value = V[l, x]
+                    self.memory[l, address] = value // 100
+                    self.memory[l, address+1] = (value // 10) % 10
+                    self.memory[l, address+2] = value % 10
+                else:
+                    for v in range(0, x.max()+1 if len(l) else 0):
+                        moving = l[x >= v]
+                        if operation == 0x55:
+                            self.memory[moving, address[x >= v]+v] = V[moving, v]
+                        else:
+                            V[moving, v] = self.memory[moving, address[x >= v]+v]
+            else:
+                self.fault(l)
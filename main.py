@@ -1,40 +1,66 @@
 import sys
 from ConfigParser import ConfigParser
 import pygame
+from audio import ToneAudio
 from cpu import CPU
 from screen import Screen
 from keyboard import Keyboard
+from scheduler import Scheduler
+from replay import InputRecorder
+from profiler import Profiler
 
 config = ConfigParser()
 config.read('config.cfg')
 scale_factor = config.getint('SCREEN', 'scale_factor')
+dirty_rects = config.getboolean('SCREEN', 'dirty_rects')
 size = width, height = 64*scale_factor, 32*scale_factor
+# A 512 sample mixer buffer keeps the tone within about a frame of the sound timer
+pygame.mixer.pre_init(44100, -16, 1, 512)
 pygame.init()
-pygame.mixer.init()
 
 app_screen = pygame.display.set_mode(size, pygame.DOUBLEBUF)
 pygame.display.set_caption('Chip8 Emulator')
 
-sound = pygame.mixer.Sound("Buzzer_short.ogg")
-screen = Screen(width, height, scale_factor)
+sound = ToneAudio(config.getint('SOUND', 'frequency'), config.getfloat('SOUND', 'volume'))
+screen = Screen(64, 32, scale_factor)
 keyboard = Keyboard()
 cpu = CPU(config, screen, keyboard, sound)
 cpu.load_rom_into_memory(config.get('ROM', 'path'))
+recorder = None
+if config.has_option('ROM', 'record_input'):
+    recorder = InputRecorder(cpu, config.get('ROM', 'path'), 56)
+profiler = None
+if config.has_option('CPU', 'profile') and config.getboolean('CPU', 'profile'):
+    profiler = Profiler(cpu)
 
-run_loop = True
-while run_loop:
-    pygame.time.wait(cpu.clock_freq)
-    cpu.execute_instruction()
-    cpu.screen.redraw(app_screen)
-    pygame.display.flip()
 
+def handle_frame():
+    changed = cpu.screen.redraw(app_screen)
+    if changed:
+        if dirty_rects:
+            pygame.display.update(changed)
+        else:
+            pygame.display.flip()
+
+    inputs = []
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
-            run_loop = False
-            sys.exit()
-        if event.type == pygame.KEYDOWN:
-            if pygame.key.name(event.key) in keyboard.keymap.keys():
-                keyboard.set_key_down(pygame.key.name(event.key))
-        if event.type == pygame.KEYUP:
-            if pygame.key.name(event.key) in keyboard.keymap.keys():
-                keyboard.reset_key_state()
+            return False
+        if event.type in (pygame.KEYDOWN, pygame.KEYUP):
+            key = keyboard.keymap.get(pygame.key.name(event.key))
+            if key is not None:
+                inputs.append((key, event.type == pygame.KEYDOWN))
+    # A key tapped between two frames stays down for one frame
+    keyboard.push_inputs(cpu.cycles, inputs, cpu.cycles_per_frame)
+    keyboard.apply_events(cpu.cycles)
+    if recorder is not None:
+        recorder.poll()
+
+
+scheduler = Scheduler(cpu, cpu.cycles_per_frame, engine=profiler)
+scheduler.run(handle_frame)
+if profiler is not None:
+    print(profiler.report())
+if recorder is not None:
+    recorder.finish().save(config.get('ROM', 'record_input'))
+sys.exit()
@@ -0,0 +1,169 @@
+from __future__ import print_function
+
+import argparse
+import array
+import json
+from ConfigParser import ConfigParser
+from timeit import default_timer
+
+from headless import create_cpu
+from scheduler import Scheduler
+
+
+class Profiler:
+    """
+    Execution engine counting executed instructions per handler and per
+    address.
+
+    Instructions go one at a time through the CPU handlers, as in
+    CPU.execute_instruction, with array-backed counters incremented on the
+    way and the time spent in display_sprite accumulated. The screen redraw
+    is timed by shadowing Screen.redraw on the instance until detach();
+    copies of the screen do not inherit it. Handlers missing from the
+    CPU's tables, like those of a Debugger, are counted under their name.
+    Use it in place of the CPU as the engine of a Scheduler: the CPU itself
+    is not modified, so nothing is paid when profiling is off.
+    """
+    def __init__(self, cpu, clock=default_timer):
+        self.cpu = cpu
+        self.clock = clock
+        tables = (cpu.zero_functions, cpu.main_functions, cpu.eight_functions, cpu.e_functions, cpu.f_functions)
+        handlers = [fun for table in tables for fun in table.values()]
+        self.handler_names = [fun.__name__ for fun in handlers]
+        self.handler_ids = dict((fun, i) for i, fun in enumerate(handlers))
+        self.sprite_id = self.handler_ids[cpu.main_functions[0xD]]
+        self.handler_counts = array.array('L', [0]*len(handlers))
+        self.address_counts = array.array('L', [0]*cpu.memory_size)
+        self.sprite_time = 0.0
+        self.redraw_time = 0.0
+        self.redraw_count = 0
+        if hasattr(cpu.screen, 'redraw'):
+            cpu.screen.redraw = self.timed_redraw
+
+    def detach(self):
+        """
+        Stop timing the screen redraw
+        """
+        screen = self.cpu.screen
+        if screen is not None and 'redraw' in vars(screen):
+            del screen.redraw
+
+    def timed_redraw(self, background):
+        start = self.clock()
+        rects = type(self.cpu.screen).redraw(self.cpu.screen, background)
+        self.redraw_time += self.clock() - start
+        self.redraw_count += 1
+        return rects
+
+    def run(self, n_instructions):
+        cpu = self.cpu
+        handler_ids = self.handler_ids
+        handler_counts = self.handler_counts
+        address_counts = self.address_counts
+        sprite_id = self.sprite_id
+        clock = self.clock
+        keyboard = cpu.keyboard
+        for _ in range(n_instructions):
+            if keyboard is not None and keyboard.events:
+                keyboard.apply_events(cpu.cycles)
+            pc = cpu.program_counter
+            entry = cpu.decode_cache[pc]
+            if entry is None:
+                entry = cpu.decode_instruction(pc)
+            cpu.opcode, fun = entry
+            handler_id = handler_ids.get(fun)
+            if handler_id is None:
+                handler_id = self.add_handler(fun)
+            handler_counts[handler_id] += 1
+            address_counts[pc] += 1
+            if handler_id == sprite_id:
+                start = clock()
+                fun(cpu)
+                self.sprite_time += clock() - start
+            else:
+                fun(cpu)
+            cpu.program_counter += 2
+            cpu.cycles += 1
+        return n_instructions
+
+    def add_handler(self, fun):
+        name = fun.__name__
+        if name in self.handler_names:
+            handler_id = self.handler_names.index(name)
+        else:
+            handler_id = len(self.handler_names)
+            self.handler_names.append(name)
+            self.handler_counts.append(0)
+        self.handler_ids[fun] = handler_id
+        return handler_id
+
+    def reset(self):
+        self.handler_counts = array.array('L', [0]*len(self.handler_names))
+        self.address_counts = array.array('L', [0]*self.cpu.memory_size)
+        self.sprite_time = 0.0
+        self.redraw_time = 0.0
+        self.redraw_count = 0
+
+    def handlers(self):
+        """
+        (handler name, executions) of the executed handlers, most executed first
+        """
+        counts = [(name, count) for name, count in zip(self.handler_names, self.handler_counts) if count]
+        return sorted(counts, key=lambda item: (-item[1], item[0]))
+
+    def hot_spots(self, n=10):
+        """
+        (address, executions, opcode) of the n most executed addresses
+        """
+        memory = self.cpu.memory
+        counts = self.address_counts
+        addresses = sorted((a for a in range(len(counts)) if counts[a]), key=lambda a: (-counts[a], a))[:n]
+        return [(a, counts[a], memory[a] << 8 | memory[a+1]) for a in addresses]
+
+    def to_dict(self, n=10):
+        return {
+            'instructions': sum(self.handler_counts),
+            'handlers': self.handlers(),
+            'hot_spots': self.hot_spots(n),
+            'sprite_time': self.sprite_time,
+            'redraw_time': self.redraw_time,
+            'redraw_count': self.redraw_count,
+        }
+
+    def report(self, n=10):
+        total = sum(self.handler_counts) or 1
+        lines = ['{:>12} instructions'.format(sum(self.handler_counts)), '', 'handlers:']
+        lines += ['{:>12} {:6.2f}%  {}'.format(count, 100.0*count/total, name) for name, count in self.handlers()]
+        lines += ['', 'hot spots:']
+        lines += ['{:>12} {:6.2f}%  0x{:03X}  {:04X}'.format(count, 100.0*count/total, address, opcode)
+                  for address, count, opcode in self.hot_spots(n)]
+        lines += ['', 'display_sprite: {:.6f} s'.format(self.sprite_time),
+                  'Screen.redraw: {:.6f} s over {} calls'.format(self.redraw_time, self.redraw_count)]
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile a CHIP-8 ROM run without a display')
+    parser.add_argument('rom')
+    parser.add_argument('--config', default='config.cfg')
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--top', type=int, default=10, help='number of hot spots to report')
+    parser.add_argument('--json', help='also write the report as JSON to this file')
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.read(args.config)
+    cpu = create_cpu(config, args.rom, args.seed)
+    profiler = Profiler(cpu)
+    scheduler = Scheduler(cpu, cpu.cycles_per_frame, engine=profiler)
+    for _ in range(args.frames):
+        scheduler.run_frame()
+    print(profiler.report(args.top))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(profiler.to_dict(args.top), f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
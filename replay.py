@@ -0,0 +1,126 @@
+from __future__ import print_function
+
+import argparse
+import hashlib
+import struct
+from ConfigParser import ConfigParser
+
+from headless import create_cpu
+
+LOG_MAGIC = b'C8IN'
+LOG_VERSION = 1
+# magic, version, seed, cycles per frame, end cycle, ROM SHA-1, final state SHA-1, number of events
+LOG_HEADER = struct.Struct('>4sBqHQ20s20sI')
+LOG_EVENT = struct.Struct('>QH')  # cycle, pressed keys mask
+
+
+def key_mask(keyboard):
+    return keyboard.keys
+
+
+def set_key_mask(keyboard, keys):
+    keyboard.keys = keys
+
+
+class InputLog:
+    def __init__(self, seed, cycles_per_frame, rom_sha1, events=None, end_cycle=0, final_sha1=b'\x00'*20):
+        self.seed = seed
+        self.cycles_per_frame = cycles_per_frame
+        self.rom_sha1 = rom_sha1
+        self.events = events if events is not None else []  # (cycle, keys) in cycle order
+        self.end_cycle = end_cycle
+        self.final_sha1 = final_sha1
+
+    def to_bytes(self):
+        header = LOG_HEADER.pack(LOG_MAGIC, LOG_VERSION, self.seed, self.cycles_per_frame, self.end_cycle,
+                                 self.rom_sha1, self.final_sha1, len(self.events))
+        return header + b''.join(LOG_EVENT.pack(cycle, keys) for cycle, keys in self.events)
+
+    @classmethod
+    def from_bytes(cls, data):
+        (magic, version, seed, cycles_per_frame, end_cycle,
+         rom_sha1, final_sha1, n_events) = LOG_HEADER.unpack_from(data)
+        assert (magic == LOG_MAGIC and version == LOG_VERSION), 'Not a version {} input log'.format(LOG_VERSION)
+        events = [LOG_EVENT.unpack_from(data, LOG_HEADER.size + i*LOG_EVENT.size) for i in range(n_events)]
+        return cls(seed, cycles_per_frame, rom_sha1, events, end_cycle, final_sha1)
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+def rom_digest(rom_path):
+    with open(rom_path, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+
+class InputRecorder:
+    """
+    Records the keyboard state of a run started at cycle 0.
+    Call poll() whenever the keyboard may have changed, at least once per
+    frame, and finish() at the end of the run.
+    """
+    def __init__(self, cpu, rom_path, seed):
+        assert (cpu.cycles == 0), 'Input recording has to start at boot'
+        cpu.set_seed(seed)
+        self.cpu = cpu
+        self.log = InputLog(seed, cpu.cycles_per_frame, rom_digest(rom_path))
+        self.keys = 0
+
+    def poll(self):
+        keys = key_mask(self.cpu.keyboard)
+        if keys != self.keys:
+            self.log.events.append((self.cpu.cycles, keys))
+            self.keys = keys
+
+    def finish(self):
+        self.log.end_cycle = self.cpu.cycles
+        self.log.final_sha1 = hashlib.sha1(self.cpu.snapshot()).digest()
+        return self.log
+
+
+def replay(config, rom_path, log):
+    """
+    Run the recorded session headlessly at full speed.
+    Return the CPU and whether it ended in the recorded state.
+    """
+    assert (rom_digest(rom_path) == log.rom_sha1), 'Input log was recorded with another ROM'
+    cpu = create_cpu(config, rom_path, log.seed)
+    events = iter(log.events + [(log.end_cycle + 1, None)])
+    next_cycle, keys = next(events)
+    frame_end = log.cycles_per_frame
+    while True:
+        while next_cycle <= cpu.cycles:
+            set_key_mask(cpu.keyboard, keys)
+            next_cycle, keys = next(events)
+        if cpu.cycles >= log.end_cycle:
+            break
+        cpu.run(min(frame_end, next_cycle, log.end_cycle) - cpu.cycles)
+        if cpu.cycles == frame_end:
+            cpu.tick_timers()
+            frame_end += log.cycles_per_frame
+    return cpu, hashlib.sha1(cpu.snapshot()).digest() == log.final_sha1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded input log without a display')
+    parser.add_argument('rom')
+    parser.add_argument('log')
+    parser.add_argument('--config', default='config.cfg')
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.read(args.config)
+    cpu, identical = replay(config, args.rom, InputLog.load(args.log))
+    print('cycles: {}'.format(cpu.cycles))
+    print('frame: {}'.format(hashlib.sha1(cpu.screen.to_bytes()).hexdigest()))
+    print('final state: {}'.format('identical' if identical else 'DIVERGED'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import re
+import struct
+from collections import deque
+
+from framebuffer import xor_bytes
+
+RUN_HEADER = struct.Struct('>HH')  # zero bytes skipped, literal bytes following
+NON_ZERO_RUNS = re.compile(b'[^\x00]+(?:\x00{1,4}[^\x00]+)*')
+
+
+def encode_delta(keyframe, state):
+    """
+    XOR state against keyframe and run-length encode the zero bytes away
+    """
+    runs = []
+    end = 0
+    for run in NON_ZERO_RUNS.finditer(xor_bytes(keyframe, state)):
+        runs.append(RUN_HEADER.pack(run.start() - end, run.end() - run.start()))
+        runs.append(run.group())
+        end = run.end()
+    return b''.join(runs)
+
+
+def decode_delta(keyframe, delta):
+    difference = bytearray(len(keyframe))
+    position = 0
+    offset = 0
+    while offset < len(delta):
+        skip, length = RUN_HEADER.unpack_from(delta, offset)
+        offset += RUN_HEADER.size
+        position += skip
+        difference[position:position+length] = delta[offset:offset+length]
+        position += length
+        offset += length
+    return xor_bytes(keyframe, bytes(difference))
+
+
+class RewindBuffer:
+    """
+    History of the machine state recorded once per frame within a fixed
+    memory budget.
+
+    Every keyframe_interval-th state is kept whole as a CPU.snapshot; the
+    states in between are kept as run-length encoded XOR deltas against
+    their keyframe, so any recorded state is one delta away. When the
+    budget is exceeded the oldest keyframe goes, along with its deltas.
+    """
+    def __init__(self, cpu, capacity=4*1024*1024, keyframe_interval=60):
+        self.cpu = cpu
+        self.capacity = capacity
+        self.keyframe_interval = keyframe_interval
+        self.groups = deque()  # [keyframe, [deltas]], oldest first
+        self.size = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def record(self):
+        state = self.cpu.snapshot()
+        if (not self.groups or len(self.groups[-1][1]) + 1 >= self.keyframe_interval
+                or len(state) != len(self.groups[-1][0])):
+            self.groups.append([state, []])
+            self.size += len(state)
+        else:
+            delta = encode_delta(self.groups[-1][0], state)
+            self.groups[-1][1].append(delta)
+            self.size += len(delta)
+        self.count += 1
+        while self.size > self.capacity and len(self.groups) > 1:
+            keyframe, deltas = self.groups.popleft()
+            self.size -= len(keyframe) + sum(len(delta) for delta in deltas)
+            self.count -= 1 + len(deltas)
+
+    def state(self, index):
+        """
+        Snapshot of the recorded frame index, oldest first; negative indexes
+        count from the latest frame
+        """
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('frame {} is not in the rewind buffer'.format(index))
+        for keyframe, deltas in self.groups:
+            if index <= len(deltas):
+                return keyframe if index == 0 else decode_delta(keyframe, deltas[index-1])
+            index -= 1 + len(deltas)
+
+    def rewind(self, n_frames=1):
+        """
+        Drop the n_frames latest records and restore the CPU to the state
+        recorded just before them
+        """
+        if not 0 <= n_frames < self.count:
+            raise IndexError('only {} frames to rewind'.format(self.count - 1))
+        for _ in range(n_frames):
+            keyframe, deltas = self.groups[-1]
+            if deltas:
+                self.size -= len(deltas.pop())
+            else:
+                self.size -= len(keyframe)
+                self.groups.pop()
+            self.count -= 1
+        self.cpu.restore(self.state(-1))
@@ -0,0 +1,51 @@
+import time
+from timeit import default_timer
+
+
+class Scheduler:
+    """
+    Paces the emulation in frames of 1/60 s.
+
+    Every frame executes cycles_per_frame instructions, ticks the timers
+    once and calls the frame callback to poll input and render, then sleeps
+    until the next frame is due. Deadlines are absolute so sleep overshoot
+    does not accumulate; when the host falls more than max_lag seconds
+    behind, the schedule restarts from now instead of running a burst of
+    catch-up frames.
+    """
+    frame_rate = 60
+    max_lag = 0.25
+
+    def __init__(self, cpu, cycles_per_frame, engine=None, clock=default_timer, sleep=time.sleep):
+        self.cpu = cpu
+        self.cycles_per_frame = cycles_per_frame
+        self.engine = engine if engine is not None else cpu  # anything with run(n_instructions)
+        self.clock = clock
+        self.sleep = sleep
+        self.frame_period = 1.0 / self.frame_rate
+        self.frame_count = 0
+
+    def run_frame(self):
+        self.engine.run(self.cycles_per_frame)
+        self.cpu.tick_timers()
+        self.frame_count += 1
+
+    def run(self, on_frame=None, n_frames=None):
+        """
+        Run frames in real time until on_frame returns False or n_frames
+        frames have been run
+        """
+        deadline = self.clock()
+        frames = 0
+        while n_frames is None or frames < n_frames:
+            self.run_frame()
+            frames += 1
+            if on_frame is not None and on_frame() is False:
+                break
+            deadline += self.frame_period
+            delay = deadline - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+            elif delay < -self.max_lag:
+                deadline = self.clock()
+        return frames
@@ -1,24 +1,52 @@
 import numpy as np
-from pygame.surfarray import make_surface
+import pygame
+from pygame.surfarray import blit_array
 
+from framebuffer import FrameBuffer
 
-class Screen:
+
+class Screen(FrameBuffer):
     def __init__(self, _w, _h, _scale):
-        self.height = _h
-        self.width = _w
         self.scale = _scale
-        white_pixel = make_surface(np.ones((self.scale, self.scale), dtype=int)*255)
-        black_pixel = make_surface(np.zeros((self.scale, self.scale), dtype=int))
-        self.surface_pixels = {0: black_pixel, 1: white_pixel}
-        self.pixels_matrix = None
-        self.to_redraw = None
-        self.clear()
+        self.frame_surface = pygame.Surface((_w, _h))
+        self.scaled_surface = pygame.Surface((_w*self.scale, _h*self.scale))
+        self.white = self.frame_surface.map_rgb((255, 255, 255))
+        FrameBuffer.__init__(self, _w, _h)
+
+    def pixels_array(self):
+        """
+        Copy of the display as a width x height array of 0 and 1.
+        Writing to it does not change the display, use set_pixel.
+        """
+        packed = np.array(self.rows, dtype='>u8').view(np.uint8).reshape(self.height, 8)
+        return np.unpackbits(packed, axis=1)[:, 64-self.width:].T.astype(int)
 
-    def clear(self):
-        self.pixels_matrix = np.zeros((self.width, self.height), dtype=int)
-        self.to_redraw = [(i, j) for j in range(self.height) for i in range(self.width)]
+    def dirty_rects(self):
+        """
+        Screen areas covering the dirty rows, one per run of consecutive rows
+        """
+        rects = []
+        y = 0
+        while y < self.height:
+            if self.dirty_rows >> y & 1:
+                first = y
+                while y < self.height and self.dirty_rows >> y & 1:
+                    y += 1
+                rects.append(pygame.Rect(0, first*self.scale, self.width*self.scale, (y-first)*self.scale))
+            y += 1
+        return rects
 
     def redraw(self, background):
-        for pos in self.to_redraw:
-            background.blit(self.surface_pixels[self.pixels_matrix[pos]], (pos[0]*self.scale, pos[1]*self.scale))
-        self.to_redraw = []
+        """
+        Render the display onto background with a single scaled blit.
+        Return the areas that changed, empty when there is nothing to present.
+        """
+        if not self.dirty_rows:
+            return []
+        rects = self.dirty_rects()
+        blit_array(self.frame_surface, self.pixels_array()*self.white)
+        pygame.transform.scale(self.frame_surface, self.scaled_surface.get_size(), self.scaled_surface)
+        for rect in rects:
+            background.blit(self.scaled_surface, rect, rect)
+        self.dirty_rows = 0
+        return rects
@@ -0,0 +1,399 @@
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import select
+import socket
+import struct
+from binascii import hexlify
+from ConfigParser import ConfigParser
+from timeit import default_timer
+
+from batch import find_roms
+from framebuffer import pack_rows
+from headless import create_cpu
+from scheduler import Scheduler
+
+# Every message is a type byte and a payload length, then the payload.
+# Client: b'H' with the name of the ROM to run, then b'K' key events.
+# Server: b'F' frame deltas, b'E' an error message before closing.
+HEADER = struct.Struct('>cH')
+FRAME = struct.Struct('>IQ')  # frame number, mask of the rows that follow
+KEY = struct.Struct('>BB')  # key, pressed
+
+
+def pack_message(kind, payload=b''):
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+def split_messages(buffer):
+    """
+    Remove the complete messages at the start of the bytearray buffer and
+    return them as (type, payload)
+    """
+    messages = []
+    offset = 0
+    while len(buffer) - offset >= HEADER.size:
+        kind, length = HEADER.unpack_from(buffer, offset)
+        end = offset + HEADER.size + length
+        if len(buffer) < end:
+            break
+        messages.append((kind, bytes(buffer[offset+HEADER.size:end])))
+        offset = end
+    del buffer[:offset]
+    return messages
+
+
+def encode_frame(screen, frame, sent_rows):
+    """
+    Frame delta with the rows of screen that differ from sent_rows, which
+    is brought up to date, or None when no row changed. Only the rows
+    marked dirty by display_sprite and clear_display are compared.
+    """
+    rows = screen.rows
+    dirty = screen.dirty_rows
+    mask = 0
+    changed = []
+    for y in range(screen.height):
+        if (dirty >> y) & 1 and rows[y] != sent_rows[y]:
+            mask |= 1 << y
+            sent_rows[y] = rows[y]
+            changed.append(rows[y])
+    screen.dirty_rows = 0
+    if not mask:
+        return None
+    return FRAME.pack(frame, mask) + pack_rows(changed, screen.width)
+
+
+def decode_frame(payload, rows, width=64):
+    """
+    Apply a frame delta to the client's copy of the rows.
+    Return the frame number.
+    """
+    frame, mask = FRAME.unpack_from(payload)
+    size = (width+7)//8
+    offset = FRAME.size
+    for y in range(len(rows)):
+        if (mask >> y) & 1:
+            rows[y] = int(hexlify(payload[offset:offset+size]), 16)
+            offset += size
+    return frame
+
+
+def session_worker(connection, config_path):
+    """
+    Host sessions in a worker process. Every request is answered with
+    (session id, delta, error) for the sessions it touched; a session
+    whose machine raised is given the error and forgotten. Stepping an
+    unknown session, one whose open failed, gives an error too.
+    """
+    config = ConfigParser()
+    config.read(config_path)
+    sessions = {}  # id -> (scheduler, rows sent to the client)
+    try:
+        while True:
+            command, data = connection.recv()
+            if command == 'open':
+                session_id, rom_path, seed = data
+                try:
+                    cpu = create_cpu(config, rom_path, seed)
+                    sent = [None]*cpu.screen.height
+                    sessions[session_id] = (Scheduler(cpu, cpu.cycles_per_frame), sent)
+                    result = (session_id, encode_frame(cpu.screen, 0, sent), None)
+                except Exception as e:
+                    result = (session_id, None, '{}: {}'.format(type(e).__name__, e))
+                connection.send((command, [result]))
+            elif command == 'step':
+                results = []
+                for session_id, n_frames, inputs in data:
+                    try:
+                        scheduler, sent = sessions[session_id]
+                        cpu = scheduler.cpu
+                        cpu.keyboard.push_inputs(cpu.cycles, inputs, cpu.cycles_per_frame)
+                        for _ in range(n_frames):
+                            scheduler.run_frame()
+                        results.append((session_id, encode_frame(cpu.screen, scheduler.frame_count, sent), None))
+                    except Exception as e:
+                        sessions.pop(session_id, None)
+                        results.append((session_id, None, '{}: {}'.format(type(e).__name__, e)))
+                connection.send((command, results))
+            elif command == 'close':
+                sessions.pop(data, None)
+            else:
+                break
+    finally:
+        connection.close()
+
+
+class Session:
+    def __init__(self, session_id, client):
+        self.id = session_id
+        self.client = client
+        self.incoming = bytearray()
+        self.outgoing = bytearray()
+        self.worker = None  # index of the hosting worker, once the ROM is chosen
+        self.inputs = []  # (key, pressed) received since the last step
+        self.deadline = None
+
+
+class SessionServer:
+    """
+    Many headless sessions served over a Unix or TCP socket.
+
+    A client names a ROM, then sends key events and receives a frame delta
+    whenever the display changed. Each session keeps its own 60 Hz
+    schedule with absolute deadlines, like Scheduler. The machines live in
+    worker processes; the select() loop here only moves messages, so it
+    stays responsive however busy the workers are. A worker is sent one
+    step request at a time for all its due sessions, which catch up on
+    missed frames, up to max_lag seconds worth, in the next one. When a
+    worker process dies, its sessions are ended and it gets no new ones.
+    """
+    frame_rate = 60
+    max_lag = 0.25
+
+    def __init__(self, roms, config_path='config.cfg', processes=None, seed=None, clock=default_timer):
+        self.roms = roms  # name -> path
+        self.seed = seed
+        self.clock = clock
+        self.frame_period = 1.0 / self.frame_rate
+        self.listener = None
+        self.address = None
+        self.sessions = {}  # id -> Session
+        self.next_id = 0
+        self.workers = []
+        self.connections = []  # None for a worker that died
+        self.busy = []  # whether a step request is outstanding, per worker
+        self.loads = []  # sessions per worker
+        for _ in range(processes or multiprocessing.cpu_count()):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=session_worker, args=(worker_connection, config_path))
+            worker.daemon = True
+            worker.start()
+            worker_connection.close()
+            self.workers.append(worker)
+            self.connections.append(connection)
+            self.busy.append(False)
+            self.loads.append(0)
+
+    def listen(self, address, backlog=128):
+        """
+        Listen on a Unix socket path or a (host, port) pair.
+        Return the bound address.
+        """
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(backlog)
+        self.listener.setblocking(False)
+        self.address = self.listener.getsockname()
+        return self.address
+
+    def serve_forever(self):
+        while True:
+            self.poll()
+
+    def poll(self, timeout=None):
+        """
+        Wait for socket or worker activity until the next session is due,
+        or timeout seconds at most, handle it and step the due sessions
+        """
+        wait = self.next_wait(self.clock())
+        if timeout is not None:
+            wait = timeout if wait is None else min(wait, timeout)
+        clients = dict((session.client, session) for session in self.sessions.values())
+        readers = [self.listener] + list(clients) + [c for c in self.connections if c is not None]
+        writers = [client for client, session in clients.items() if session.outgoing]
+        readable, writable, _ = select.select(readers, writers, [], wait)
+        for ready in readable:
+            if ready is self.listener:
+                self.accept()
+            elif ready in clients:
+                if clients[ready].id in self.sessions:
+                    self.receive(clients[ready])
+            elif ready in self.connections:
+                self.collect(self.connections.index(ready))
+        for client in writable:
+            session = clients[client]
+            if session.id in self.sessions:
+                self.send(session)
+        self.step_due(self.clock())
+
+    def next_wait(self, now):
+        deadlines = [session.deadline for session in self.sessions.values()
+                     if session.worker is not None and not self.busy[session.worker]]
+        return max(min(deadlines) - now, 0) if deadlines else None
+
+    def accept(self):
+        try:
+            client, _ = self.listener.accept()
+        except socket.error:
+            return
+        client.setblocking(False)
+        self.sessions[self.next_id] = Session(self.next_id, client)
+        self.next_id += 1
+
+    def receive(self, session):
+        try:
+            data = session.client.recv(4096)
+        except socket.error:
+            data = b''
+        if not data:
+            self.drop(session)
+            return
+        session.incoming += data
+        for kind, payload in split_messages(session.incoming):
+            if kind == b'H' and session.worker is None:
+                self.open(session, payload.decode('utf-8'))
+            elif kind == b'K' and session.worker is not None and len(payload) == KEY.size:
+                key, pressed = KEY.unpack(payload)
+                session.inputs.append((key & 0xF, bool(pressed)))
+            else:
+                self.fail(session, 'unexpected message')
+            if session.id not in self.sessions:
+                return
+
+    def open(self, session, name):
+        if name not in self.roms:
+            self.fail(session, 'unknown ROM: %s' % name)
+            return
+        workers = [w for w, connection in enumerate(self.connections) if connection is not None]
+        if not workers:
+            self.fail(session, 'no worker available')
+            return
+        worker = min(workers, key=lambda w: self.loads[w])
+        seed = self.seed + session.id if self.seed is not None else None
+        self.loads[worker] += 1
+        session.worker = worker
+        session.deadline = self.clock() + self.frame_period
+        self.send_to_worker(worker, ('open', (session.id, self.roms[name], seed)))
+
+    def fail(self, session, message):
+        try:
+            session.client.sendall(bytes(session.outgoing) + pack_message(b'E', message.encode('utf-8')))
+        except socket.error:
+            pass
+        self.drop(session)
+
+    def drop(self, session):
+        session.client.close()
+        del self.sessions[session.id]
+        if session.worker is not None:
+            self.loads[session.worker] -= 1
+            self.send_to_worker(session.worker, ('close', session.id))
+
+    def send(self, session):
+        try:
+            sent = session.client.send(session.outgoing)
+        except socket.error:
+            self.drop(session)
+            return
+        del session.outgoing[:sent]
+
+    def send_to_worker(self, worker, message):
+        try:
+            self.connections[worker].send(message)
+        except (IOError, OSError):
+            self.lose_worker(worker)
+
+    def lose_worker(self, worker):
+        """
+        End the sessions of a worker process that died and stop using it
+        """
+        self.connections[worker].close()
+        self.connections[worker] = None
+        self.busy[worker] = True  # never stepped again
+        for session in list(self.sessions.values()):
+            if session.worker == worker:
+                session.worker = None  # nothing left to close on the worker
+                self.fail(session, 'worker process died')
+        self.loads[worker] = 0
+
+    def collect(self, worker):
+        try:
+            command, results = self.connections[worker].recv()
+        except EOFError:
+            self.lose_worker(worker)
+            return
+        if command == 'step':
+            self.busy[worker] = False
+        for session_id, delta, error in results:
+            session = self.sessions.get(session_id)
+            if session is None:
+                continue
+            if error is not None:
+                self.fail(session, error)
+            elif delta is not None:
+                session.outgoing += pack_message(b'F', delta)
+
+    def step_due(self, now):
+        batches = [[] for _ in self.workers]
+        for session in self.sessions.values():
+            if session.worker is None or self.busy[session.worker] or session.deadline > now:
+                continue
+            late = now - session.deadline
+            if late > self.max_lag:
+                n_frames = 1
+                session.deadline = now + self.frame_period
+            else:
+                n_frames = int(late / self.frame_period) + 1
+                session.deadline += n_frames*self.frame_period
+            batches[session.worker].append((session.id, n_frames, session.inputs))
+            session.inputs = []
+        for worker, batch in enumerate(batches):
+            if batch:
+                self.busy[worker] = True
+                self.send_to_worker(worker, ('step', batch))
+
+    def close(self):
+        for session in list(self.sessions.values()):
+            if session.id in self.sessions:
+                self.drop(session)
+        for connection in self.connections:
+            if connection is None:
+                continue
+            try:
+                connection.send(('stop', None))
+            except (IOError, OSError):
+                pass
+            connection.close()
+        for worker in self.workers:
+            worker.join()
+        self.connections = []
+        self.workers = []
+        if self.listener is not None:
+            # A closed socket has no family on Python 2
+            unix = self.listener.family == socket.AF_UNIX
+            self.listener.close()
+            if unix:
+                os.remove(self.address)
+            self.listener = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve headless CHIP-8 sessions over a socket')
+    parser.add_argument('roms', nargs='+', help='ROM files or directories of ROMs, served by file name')
+    parser.add_argument('--config', default='config.cfg')
+    parser.add_argument('--unix', help='Unix socket path to listen on instead of TCP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8088)
+    parser.add_argument('--seed', type=int, help='seed of the first session, incremented for each new one')
+    parser.add_argument('--jobs', type=int, help='worker processes, all cores by default')
+    args = parser.parse_args()
+
+    roms = dict((os.path.basename(path), path) for path in find_roms(args.roms))
+    server = SessionServer(roms, args.config, args.jobs, args.seed)
+    try:
+        print('listening on {}'.format(server.listen(args.unix or (args.host, args.port))))
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
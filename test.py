@@ -1,17 +1,92 @@
+import os
 import pytest
 from ConfigParser import ConfigParser
 from random import randint, seed
 import numpy as np
 
-from cpu import CPU
+from cpu import CPU, xorshift32, xorshift_seed
 from screen import Screen
 from keyboard import Keyboard
 
+
+@pytest.fixture(scope='function')
+def config():
+    config = ConfigParser()
+    config.read('config.cfg')
+    return config
+
+
+class CountingSound:
+    def __init__(self):
+        self.active = False
+        self.played = 0
+
+    def update(self, active):
+        if active and not self.active:
+            self.played += 1
+        self.active = active
+
+
+def make_cpu(config, program, keys=0):
+    """
+    CPU with a screen and a keyboard holding keys, program loaded at 0x200
+    """
+    screen = Screen(64, 32, config.getint('SCREEN', 'scale_factor'))
+    cpu = CPU(config, screen, Keyboard(), CountingSound())
+    cpu.keyboard.keys = keys
+    cpu.memory[0x200:0x200+len(program)] = program
+    cpu.invalidate_decode_cache()
+    return cpu
+
+
+def random_program(s, with_random=True):
+    """
+    Straight-line ALU, memory and draw instructions looping back to 0x200
+    through a subroutine call, with random skips in between
+    """
+    seed(s)
+    program = []
+    while len(program) < 120:
+        x, y, kk = randint(0, 0xF), randint(0, 0xF), randint(0, 0xFF)
+        kind = randint(0, 9)
+        if kind == 0:
+            program += [0x6000 | x << 8 | kk, 0x7000 | x << 8 | kk]
+        elif kind == 1:
+            program.append(0x8000 | x << 8 | y << 4 | [0, 1, 2, 3, 4, 5, 6, 7, 0xE][randint(0, 8)])
+        elif kind == 2:
+            program += [0xA400 | kk, [0xF033, 0xF055, 0xF065][randint(0, 2)] | x << 8]
+        elif kind == 3:
+            program += [0xF01E | x << 8, 0xF029 | x << 8, (0xC000 if with_random else 0x6000) | x << 8 | kk]
+        elif kind == 4:
+            program.append([0x3000 | x << 8 | kk, 0x4000 | x << 8 | kk,
+                            0x5000 | x << 8 | y << 4, 0x9000 | x << 8 | y << 4,
+                            0xE09E | x << 8, 0xE0A1 | x << 8][randint(0, 5)])
+        elif kind == 5:
+            program += [0xA000 | randint(0, 0x4F), 0xD000 | x << 8 | y << 4 | randint(0, 15)]
+        elif kind == 6:
+            program += [0xF015 | x << 8, 0xF007 | y << 8, 0xF018 | x << 8]
+        else:
+            program.append(0x6000 | x << 8 | kk)
+    program += [0x2200 + 2*len(program) + 4, 0x1200, 0x00E0, 0x00EE]
+    return bytearray(b for op in program for b in (op >> 8, op & 0xFF))
+
+
+def running_cpu(config):
+    from headless import create_cpu
+    cpu = create_cpu(config)
+    program = random_program(3, with_random=False)
+    cpu.memory[0x200:0x200+len(program)] = program
+    cpu.invalidate_decode_cache()
+    cpu.keyboard.key_down = 7
+    for _ in range(50):
+        cpu.run(9)
+        cpu.tick_timers()
+    return cpu
+
+
 class TestCPUBasic:
     @pytest.fixture(scope='function')
-    def cpu(self):
-        config = ConfigParser()
-        config.read('config.cfg')
+    def cpu(self, config):
         return CPU(config, None, None, None)
 
     def test_return_from_subroutine(self, cpu):
@@ -179,9 +254,7 @@ class TestCPUBasic:
             for x in range(0x0, 0xF):
                 cpu.V_register[:] = blanck_v
                 for val in range(0x0, 0xFF):
-                    seed(s)
-                    ref_rnd = randint(0x0, 0xFF)
-                    outval = ref_rnd & val
+                    outval = (xorshift32(xorshift_seed(s)) >> 24) & val
                     cpu.opcode = 0xC000 | (x << 8) | val
                     cpu.set_seed(s)
                     cpu.set_vx_random()
@@ -191,6 +264,21 @@ class TestCPUBasic:
                         else:
                             assert(cpu.V_register[v] == 0)
 
+    def test_random_per_instance(self, config, cpu):
+        other = CPU(config, None, Keyboard(), None)
+        cpu.opcode = other.opcode = 0xC0FF
+        cpu.set_seed(5)
+        other.set_seed(5)
+        values = []
+        for _ in range(4096):
+            cpu.set_vx_random()
+            values.append(cpu.V_register[0])
+        for value in values:
+            seed(0)
+            other.set_vx_random()
+            assert(other.V_register[0] == value)
+        assert(len(set(values)) == 0x100)
+
     def test_set_vx_to_vy(self, cpu):
         """
         0x8xy0 - LD Vx, Vy
@@ -488,9 +576,7 @@ class TestCPUBasic:
 
 class TestCPUKeyboard:
     @pytest.fixture(scope='function')
-    def cpu(self):
-        config = ConfigParser()
-        config.read('config.cfg')
+    def cpu(self, config):
         keyboard = Keyboard()
         return CPU(config, None, keyboard, None)
 
@@ -541,27 +627,65 @@ class TestCPUKeyboard:
                 assert(cpu.program_counter == 2)
                 assert(cpu.V_register[0] == key)
 
+    def test_several_keys_held(self, cpu):
+        cpu.keyboard.press(3)
+        cpu.keyboard.press(9)
+        cpu.keyboard.release(3)
+        for key in range(0x0, 0xF+1):
+            cpu.opcode = 0xE09E
+            cpu.V_register[0] = key
+            cpu.program_counter = 0
+            cpu.skip_next_if_key_pressed()
+            assert(cpu.program_counter == (2 if key == 9 else 0))
+        cpu.keyboard.press(5)
+        cpu.opcode = 0xF00A
+        cpu.wait_for_key_pressed()
+        assert(cpu.V_register[0] == 5)
+        assert(cpu.keyboard.key_down == 5)
+
+    def test_queued_events(self, cpu):
+        keyboard = cpu.keyboard
+        keyboard.push_event(10, 1, True)
+        keyboard.push_event(20, 2, True)
+        keyboard.push_event(15, 1, False)
+        assert(keyboard.next_event_cycle() == 10)
+        other = keyboard.copy()
+        keyboard.apply_events(19)
+        assert((keyboard.keys, keyboard.next_event_cycle()) == (0, 20))
+        keyboard.apply_events(20)
+        assert((keyboard.keys, keyboard.next_event_cycle()) == (1 << 2, None))
+        assert((other.keys, len(other.events)) == (0, 3))
+
+    def test_push_inputs_keeps_taps(self, cpu):
+        keyboard = cpu.keyboard
+        keyboard.push_inputs(100, [(3, True), (4, False), (3, False), (5, True)], 9)
+        assert(list(keyboard.events) == [(100, 3, True), (100, 4, False), (100, 5, True), (109, 3, False)])
+        keyboard.events.clear()
+        keyboard.push_inputs(200, [(6, True), (6, False), (6, True), (7, True), (7, False), (7, True), (7, False)], 9)
+        assert(list(keyboard.events) == [(200, 6, True), (200, 6, True), (200, 7, True), (200, 7, True),
+                                          (209, 7, False)])
+        keyboard.apply_events(209)
+        assert(keyboard.keys == 1 << 6)
+
 class TestCPUScreen:
     @pytest.fixture(scope='function')
-    def cpu(self):
-        config = ConfigParser()
-        config.read('config.cfg')
+    def cpu(self, config):
         width, height = 64, 32
         screen = Screen(width, height, config.getint('SCREEN', 'scale_factor'))
         return CPU(config, screen, None, None)
 
     def test_clear_display(self, cpu):
-            cpu.screen.pixels_matrix = np.ones((cpu.screen.width, cpu.screen.height), dtype=int)
+            cpu.screen.rows = [cpu.screen.row_mask]*cpu.screen.height
             cpu.clear_display()
-            assert(np.array_equal(cpu.screen.pixels_matrix, np.zeros((cpu.screen.width, cpu.screen.height), dtype=int)))
+            assert(np.array_equal(cpu.screen.pixels_array(), np.zeros((cpu.screen.width, cpu.screen.height), dtype=int)))
 
     def test_display_sprite(self, cpu):
         """
         0xDxyn - DRW Vx , Vy , nibble
         """
         cpu.opcode = 0xD000 | (0 << 8) | (1 << 4) | 4
-        cpu.screen.pixels_matrix[63, 1] = 1
-        cpu.screen.pixels_matrix[63, 2] = 1
+        cpu.screen.set_pixel(63, 1)
+        cpu.screen.set_pixel(63, 2)
         cpu.V_register[0] = 62
         cpu.V_register[1] = 31
         cpu.V_register[0xF] = 0
@@ -574,5 +698,1221 @@ class TestCPUScreen:
         target = np.zeros((cpu.screen.width, cpu.screen.height), dtype=int)
         target[0:2, 0:3] = 1
         target[63, 0] = 1
-        assert(np.array_equal(cpu.screen.pixels_matrix, target))
+        assert(np.array_equal(cpu.screen.pixels_array(), target))
         assert(cpu.V_register[0xF] == 1)
+
+class TestCPUDecodeCache:
+    @pytest.fixture(scope='function')
+    def cpu(self, config):
+        return CPU(config, None, None, None)
+
+    def test_execute_instruction_uses_cache(self, cpu):
+        cpu.memory[0x200:0x204] = bytearray([0x60, 0x12, 0x70, 0x01])
+        cpu.execute_instruction()
+        cpu.execute_instruction()
+        assert(cpu.V_register[0] == 0x13)
+        assert(cpu.decode_cache[0x200] == (0x6012, CPU.main_functions[0x6]))
+        assert(cpu.decode_cache[0x202] == (0x7001, CPU.main_functions[0x7]))
+
+    def test_self_modifying_code(self, cpu):
+        """
+        Fx55 overwrites an instruction that has already been decoded
+        """
+        program = [0x60, 0x75,  # 0x200: LD V0, 0x75
+                   0x61, 0x05,  # 0x202: LD V1, 0x05
+                   0x65, 0x00,  # 0x204: LD V5, 0x00
+                   0xA2, 0x0C,  # 0x206: LD I, 0x20C
+                   0x12, 0x0C,  # 0x208: JP 0x20C
+                   0x00, 0x00,
+                   0x75, 0x01,  # 0x20C: ADD V5, 0x01
+                   0xF1, 0x55,  # 0x20E: LD [I], V1
+                   0x12, 0x0C]  # 0x210: JP 0x20C
+        cpu.memory[0x200:0x200+len(program)] = bytearray(program)
+        for _ in range(7):
+            cpu.execute_instruction()
+        assert(cpu.V_register[5] == 1)
+        assert(cpu.decode_cache[0x20C] is None)
+        cpu.execute_instruction()
+        cpu.execute_instruction()
+        assert(cpu.V_register[5] == 6)
+
+    def test_load_rom_invalidates_cache(self, cpu, tmpdir):
+        cpu.memory[0x200:0x202] = bytearray([0x60, 0x12])
+        cpu.execute_instruction()
+        rom = tmpdir.join('rom.ch8')
+        rom.write_binary(bytes(bytearray([0x61, 0x34])))
+        cpu.load_rom_into_memory(str(rom))
+        cpu.program_counter = 0x200
+        cpu.execute_instruction()
+        assert(cpu.V_register[1] == 0x34)
+
+class TestFrameBuffer:
+    @pytest.fixture(scope='function')
+    def framebuffer(self):
+        from framebuffer import FrameBuffer
+        return FrameBuffer(64, 32)
+
+    def test_clear(self, framebuffer):
+        framebuffer.rows[3] = 0xFF
+        framebuffer.dirty_rows = 0
+        framebuffer.clear()
+        assert(framebuffer.rows == [0]*32)
+        assert(framebuffer.dirty_rows == (1 << 32) - 1)
+
+    def test_draw_sprite_wraps_around(self, framebuffer):
+        framebuffer.dirty_rows = 0
+        collision = framebuffer.draw_sprite(60, 31, bytearray([0b10011001, 0b11110000]))
+        assert(not collision)
+        assert(framebuffer.rows[31] == (0b1001 << 60) | 0b1001)
+        assert(framebuffer.rows[0] == 0b1111)
+        assert(framebuffer.dirty_rows == (1 << 31) | 1)
+        for x, bit in zip([60, 61, 62, 63, 0, 1, 2, 3], [1, 0, 0, 1, 1, 0, 0, 1]):
+            assert(framebuffer.get_pixel(x, 31) == bit)
+
+    def test_draw_sprite_collision(self, framebuffer):
+        framebuffer.draw_sprite(130, 5, bytearray([0b00000001]))
+        assert(framebuffer.get_pixel(9, 5) == 1)
+        framebuffer.dirty_rows = 0
+        assert(framebuffer.draw_sprite(2, 4, bytearray([0, 0b10000000])) is False)
+        assert(framebuffer.dirty_rows == 1 << 5)
+        assert(framebuffer.draw_sprite(2, 5, bytearray([0b11000001])) is True)
+        assert(framebuffer.rows[5] == 1 << 60)
+
+
+class TestScreenRedraw:
+    @pytest.fixture(scope='function')
+    def screen(self):
+        return Screen(64, 32, 10)
+
+    def test_redraw_only_dirty_rows(self, screen):
+        import pygame
+        background = pygame.Surface((640, 320))
+        assert(len(screen.redraw(background)) == 1)
+        assert(screen.redraw(background) == [])
+        screen.draw_sprite(62, 10, bytearray([0xFF, 0x00, 0x81]))
+        rects = screen.redraw(background)
+        assert(rects == [pygame.Rect(0, 100, 640, 10), pygame.Rect(0, 120, 640, 10)])
+        assert(background.get_at((635, 105))[:3] == (255, 255, 255))
+        assert(background.get_at((15, 105))[:3] == (255, 255, 255))
+        assert(background.get_at((65, 105))[:3] == (0, 0, 0))
+        assert(background.get_at((55, 125))[:3] == (255, 255, 255))
+        assert(background.get_at((65, 125))[:3] == (0, 0, 0))
+
+
+class TestBlockTranslator:
+    def test_check_against_interpreter(self, config):
+        from translator import BlockTranslator
+        for s in range(5):
+            cpu = make_cpu(config, random_program(s), 1 << 5)
+            translator = BlockTranslator(cpu)
+            assert(translator.check(3000) == 3000)
+            assert(len(translator.blocks) > 0)
+
+    def test_run_matches_interpreter(self, config):
+        from translator import BlockTranslator
+        program = random_program(7)
+        reference = make_cpu(config, program, 1 << 5)
+        cpu = make_cpu(config, program, 1 << 5)
+        reference.set_seed(3)
+        for _ in range(2500):
+            reference.execute_instruction()
+        cpu.set_seed(3)
+        assert(BlockTranslator(cpu).run(2500) == 2500)
+        assert(cpu.memory == reference.memory)
+        assert(cpu.V_register == reference.V_register)
+        assert((cpu.I, cpu.program_counter, cpu.delay_timer, cpu.sound_timer) ==
+               (reference.I, reference.program_counter, reference.delay_timer, reference.sound_timer))
+        assert(cpu.screen.rows == reference.screen.rows)
+        assert(cpu.sound.played == reference.sound.played)
+        assert((cpu.cycles, cpu.opcode) == (reference.cycles, reference.opcode))
+
+    def test_write_invalidates_block(self, config):
+        from translator import BlockTranslator
+        program = bytearray([0x60, 0x75,  # 0x200: LD V0, 0x75
+                             0x61, 0x05,  # 0x202: LD V1, 0x05
+                             0xA2, 0x08,  # 0x204: LD I, 0x208
+                             0x75, 0x01,  # 0x206: ADD V5, 0x01
+                             0x75, 0x01,  # 0x208: ADD V5, 0x01
+                             0xF1, 0x55,  # 0x20A: LD [I], V1
+                             0x12, 0x06])  # 0x20C: JP 0x206
+        cpu = make_cpu(config, program, 1 << 5)
+        translator = BlockTranslator(cpu)
+        translator.run(6)
+        assert(cpu.V_register[5] == 2)
+        assert(0x200 not in translator.blocks)
+        translator.run(4)
+        assert(cpu.V_register[5] == 8)
+
+
+class TestScheduler:
+    @pytest.fixture(scope='function')
+    def cpu(self, config):
+        cpu = CPU(config, None, None, CountingSound())
+        cpu.memory[0x200:0x204] = bytearray([0x70, 0x01, 0x12, 0x00])  # ADD V0, 1; JP 0x200
+        return cpu
+
+    def test_tick_timers(self, cpu):
+        cpu.delay_timer = 2
+        cpu.sound_timer = 2
+        cpu.tick_timers()
+        assert((cpu.delay_timer, cpu.sound_timer, cpu.sound.played, cpu.sound.active) == (1, 1, 1, True))
+        cpu.tick_timers()
+        assert((cpu.delay_timer, cpu.sound_timer, cpu.sound.active) == (0, 0, True))
+        cpu.tick_timers()
+        assert((cpu.delay_timer, cpu.sound_timer, cpu.sound.played, cpu.sound.active) == (0, 0, 1, False))
+
+    def test_timers_tick_once_per_frame(self, cpu):
+        from scheduler import Scheduler
+        cpu.delay_timer = 10
+        scheduler = Scheduler(cpu, 20)
+        for _ in range(3):
+            scheduler.run_frame()
+        assert(cpu.delay_timer == 7)
+        assert(cpu.V_register[0] == 30)
+        assert(scheduler.frame_count == 3)
+
+    def test_run_compensates_drift(self, cpu):
+        from scheduler import Scheduler
+        now = [0.0]
+        sleeps = []
+
+        def sleep(delay):
+            sleeps.append(delay)
+            now[0] += delay + 0.002  # sleeps always overshoot
+
+        scheduler = Scheduler(cpu, 10, clock=lambda: now[0], sleep=sleep)
+        assert(scheduler.run(n_frames=60) == 60)
+        assert(abs(now[0] - 1.002) < 1e-9)
+        assert(all(abs(delay - (1.0/60 - 0.002)) < 1e-9 for delay in sleeps[1:]))
+
+    def test_run_stops_when_callback_returns_false(self, cpu):
+        from scheduler import Scheduler
+        frames = []
+
+        def on_frame():
+            frames.append(cpu.V_register[0])
+            return len(frames) < 4
+        scheduler = Scheduler(cpu, 2, clock=lambda: 0.0, sleep=lambda delay: None)
+        assert(scheduler.run(on_frame) == 4)
+        assert(frames == [1, 2, 3, 4])
+
+
+class TestCPURun:
+    def test_run_matches_execute_instruction(self, config):
+        from cpu import STOP_BUDGET
+        for s in range(4):
+            program = random_program(s)
+            reference = make_cpu(config, program)
+            cpu = make_cpu(config, program)
+            reference.keyboard.key_down = cpu.keyboard.key_down = s
+            reference.set_seed(s)
+            for _ in range(3000):
+                reference.execute_instruction()
+            cpu.set_seed(s)
+            for _ in range(3):
+                assert(cpu.run(1000) == STOP_BUDGET)
+            assert(cpu.cycles == reference.cycles == 3000)
+            assert(cpu.memory == reference.memory)
+            assert(cpu.V_register == reference.V_register)
+            assert((cpu.I, cpu.program_counter, cpu.stack_pointer, cpu.opcode, cpu.delay_timer) ==
+                   (reference.I, reference.program_counter, reference.stack_pointer, reference.opcode,
+                    reference.delay_timer))
+            assert(cpu.screen.rows == reference.screen.rows)
+
+    def test_run_stops_on_events(self, config):
+        from cpu import STOP_BUDGET, STOP_DRAW, STOP_KEY_WAIT, STOP_SOUND
+        program = bytearray([0x60, 0x03,  # 0x200: LD V0, 3
+                             0xF0, 0x18,  # 0x202: LD ST, V0
+                             0xD0, 0x05,  # 0x204: DRW V0, V0, 5
+                             0xF1, 0x0A,  # 0x206: LD V1, K
+                             0x12, 0x00])  # 0x208: JP 0x200
+        cpu = make_cpu(config, program)
+        stop_on = STOP_DRAW | STOP_KEY_WAIT | STOP_SOUND
+        assert(cpu.run(100, stop_on) == STOP_SOUND)
+        assert((cpu.cycles, cpu.program_counter, cpu.sound_timer) == (2, 0x204, 3))
+        assert(cpu.run(100, stop_on) == STOP_DRAW)
+        assert((cpu.cycles, cpu.program_counter) == (3, 0x206))
+        assert(cpu.run(100, stop_on) == STOP_KEY_WAIT)
+        assert(cpu.run(100, stop_on) == STOP_KEY_WAIT)
+        assert((cpu.cycles, cpu.program_counter) == (5, 0x206))
+        assert(cpu.run(10, STOP_DRAW) == STOP_BUDGET)
+        assert((cpu.cycles, cpu.program_counter) == (15, 0x206))
+        cpu.keyboard.key_down = 0xA
+        assert(cpu.run(3, stop_on) == STOP_BUDGET)
+        assert((cpu.V_register[1], cpu.program_counter) == (0xA, 0x202))
+
+    def test_run_skips_idle_loops(self, config):
+        program = bytearray([0x60, 0x05,  # 0x200: LD V0, 5
+                             0xF0, 0x15,  # 0x202: LD DT, V0
+                             0xF1, 0x07,  # 0x204: LD V1, DT
+                             0x31, 0x00,  # 0x206: SE V1, 0
+                             0x12, 0x04,  # 0x208: JP 0x204
+                             0xF3, 0x0A,  # 0x20A: LD V3, K
+                             0xE2, 0x9E,  # 0x20C: SKP V2
+                             0x12, 0x0C,  # 0x20E: JP 0x20C
+                             0xC4, 0xFF,  # 0x210: RND V4, 0xFF
+                             0x12, 0x10])  # 0x212: JP 0x210
+        reference = make_cpu(config, program)
+        cpu = make_cpu(config, program)
+        idle = {}
+        for frame in range(30):
+            if frame in (10, 20):
+                reference.keyboard.key_down = cpu.keyboard.key_down = 2 - frame // 10
+            for _ in range(100):
+                reference.execute_instruction()
+            reference.tick_timers()
+            cpu.run(100)
+            cpu.tick_timers()
+            assert(cpu.cycles == reference.cycles)
+            assert(cpu.V_register == reference.V_register)
+            assert((cpu.program_counter, cpu.delay_timer, cpu.rng_state) ==
+                   (reference.program_counter, reference.delay_timer, reference.rng_state))
+            idle[frame] = cpu.idle_cycles
+        assert(idle[4] > 4*90)
+        assert(idle[9] - idle[5] == 4*99)
+        assert(idle[19] - idle[10] > 9*90)
+        assert(idle[29] == idle[20])
+        idle_cycles = cpu.idle_cycles
+        cpu.run(1000)
+        assert(cpu.idle_cycles == idle_cycles)
+
+    @pytest.mark.parametrize('engine', ['CPU', 'BlockTranslator', 'Profiler', 'Debugger'])
+    def test_run_applies_key_events_at_their_cycle(self, config, engine):
+        from debugger import Debugger
+        from profiler import Profiler
+        from translator import BlockTranslator
+        program = bytearray([0xE1, 0x9E,  # 0x200: SKP V1
+                             0x12, 0x00,  # 0x202: JP 0x200
+                             0xF2, 0x0A,  # 0x204: LD V2, K
+                             0x73, 0x01,  # 0x206: ADD V3, 1
+                             0x73, 0x01,  # 0x208: ADD V3, 1
+                             0x12, 0x06])  # 0x20A: JP 0x206
+        cpu = make_cpu(config, program)
+        cpu.V_register[1] = 4
+        cpu.keyboard.push_event(37, 4, True)
+        cpu.keyboard.push_event(39, 4, False)
+        cpu.keyboard.push_event(90, 7, True)
+        cpu.keyboard.push_event(101, 7, False)
+        engines = {'CPU': lambda cpu: cpu, 'BlockTranslator': BlockTranslator,
+                   'Profiler': Profiler, 'Debugger': Debugger}
+        engines[engine](cpu).run(200)
+        # The loop sees key 4 at cycle 38, the wait ends at cycle 90
+        assert((cpu.cycles, cpu.opcode) == (200, 0x7301))
+        assert((cpu.V_register[2], cpu.V_register[3]) == (7, (200 - 91) // 3 * 2 + 1))
+        assert((cpu.keyboard.keys, len(cpu.keyboard.events)) == (0, 0))
+
+    def test_run_until(self, config):
+        from cpu import STOP_BUDGET, STOP_PREDICATE
+        cpu = make_cpu(config, bytearray([0x70, 0x01, 0x12, 0x00]))
+        assert(cpu.run_until(lambda c: c.V_register[0] >= 100, batch=16) == STOP_PREDICATE)
+        assert(cpu.cycles == 208)
+        assert(cpu.run_until(lambda c: False, max_cycles=50, batch=16) == STOP_BUDGET)
+        assert(cpu.cycles == 258)
+
+
+class TestHeadless:
+    def test_run_frames(self, config, tmpdir):
+        from headless import create_cpu, run_frames
+        rom = tmpdir.join('rom.ch8')
+        rom.write_binary(bytes(bytearray([0x60, 0x3C,  # LD V0, 60
+                                          0xF0, 0x15,  # LD DT, V0
+                                          0xA0, 0x00,  # LD I, 0
+                                          0xD1, 0x15,  # DRW V1, V1, 5
+                                          0x12, 0x08])))  # JP 0x208
+        cpu = create_cpu(config, str(rom), seed=1)
+        run_frames(cpu, 10, cycles_per_frame=8)
+        assert(cpu.cycles == 80)
+        assert(cpu.delay_timer == 50)
+        assert(cpu.screen.to_text().split('\n')[0] == '####' + '.'*60)
+        assert(cpu.screen.to_bytes()[:8] == b'\xF0' + b'\x00'*7)
+
+    def test_minimal_imports(self):
+        import subprocess
+        import sys
+        loaded = subprocess.check_output([sys.executable, '-c', 'import sys, headless; print(sorted(sys.modules))'])
+        for module in ('argparse', 'export', 'framestream', 'rewind', 'threading', 'Queue', 'zlib',
+                       'numpy', 'pygame'):
+            assert("'%s'" % module not in loaded.decode('ascii'))
+
+
+class TestBatch:
+    def test_read_input_script(self, tmpdir):
+        from batch import read_input_script
+        script = tmpdir.join('keys.txt')
+        script.write('# press 5 then release\n10 5\n\n12 -\n20 a  # A\n')
+        assert(read_input_script(str(script)) == {10: 5, 12: None, 20: 0xA})
+
+    def test_run_batch(self, tmpdir):
+        from batch import run_batch, find_roms
+        tmpdir.join('add.ch8').write_binary(bytes(bytearray([0x70, 0x01, 0x12, 0x00])))
+        tmpdir.join('rnd.ch8').write_binary(bytes(bytearray([0xC0, 0xFF, 0x12, 0x00])))
+        tmpdir.join('bad.ch8').write_binary(bytes(bytearray([0x00, 0x00])))
+        jobs = [(rom, seed, None, 5, None) for rom in find_roms([str(tmpdir)]) for seed in (1, 2)]
+        jobs.append((str(tmpdir.join('add.ch8')), 1, None, None, 7))
+        records = list(run_batch(jobs, processes=2))
+        assert([os.path.basename(r['rom']) for r in records] ==
+               ['add.ch8']*2 + ['bad.ch8']*2 + ['rnd.ch8']*2 + ['add.ch8'])
+        assert(records[0]['V'] == '%02X' % 23 + '00'*15)
+        assert(records[0]['cycles'] == 45 and records[0]['frames'] == 5)
+        assert(records[2]['error'].startswith('KeyError'))
+        assert(records[4]['V'] != records[5]['V'])
+        assert(records[6]['cycles'] == 7 and records[6]['frames'] == 0)
+
+
+class TestLockstepCPU:
+    def test_matches_cpu(self, config):
+        from lockstep import LockstepCPU
+        machines = LockstepCPU(config, 6)
+        cpus = []
+        for m in range(6):
+            program = random_program(m)
+            machines.memory[m, 0x200:0x200+len(program)] = np.frombuffer(bytes(program), np.uint8)
+            machines.keys[m] = 1 << m if m % 3 else 0
+            cpu = make_cpu(config, program)
+            cpu.keyboard.key_down = m if m % 3 else None
+            cpus.append(cpu)
+        for frame in range(200):
+            machines.run(9)
+            machines.tick_timers()
+            for cpu in cpus:
+                cpu.run(9)
+                cpu.tick_timers()
+        assert(not machines.faulted.any())
+        for m, cpu in enumerate(cpus):
+            assert(machines.memory[m].tobytes() == bytes(cpu.memory))
+            assert(machines.V_register[m].tobytes() == bytes(cpu.V_register))
+            assert(machines.I[m] == cpu.I)
+            assert(machines.program_counter[m] == cpu.program_counter)
+            assert(machines.stack_pointer[m] == cpu.stack_pointer)
+            assert(machines.stack[m].tolist() == cpu.stack.tolist())
+            assert(machines.delay_timer[m] == cpu.delay_timer)
+            assert(machines.sound_timer[m] == cpu.sound_timer)
+            assert(machines.rng_state[m] == cpu.rng_state)
+            assert(machines.framebuffer_bytes(m) == cpu.screen.to_bytes())
+
+    def test_several_keys_held(self, config):
+        from lockstep import LockstepCPU
+        program = bytearray([0x60, 0x07,  # 0x200: LD V0, 7
+                             0xE0, 0x9E,  # 0x202: SKP V0
+                             0x71, 0x01,  # 0x204: ADD V1, 1
+                             0xE0, 0xA1,  # 0x206: SKNP V0
+                             0x72, 0x01,  # 0x208: ADD V2, 1
+                             0xF3, 0x0A,  # 0x20A: LD V3, K
+                             0x12, 0x00])  # 0x20C: JP 0x200
+        masks = [1 << 5 | 1 << 7, 1 << 2 | 1 << 7, 0xFFFF, 1 << 3 | 1 << 12, 1 << 15]
+        machines = LockstepCPU(config, len(masks))
+        machines.memory[:, 0x200:0x200+len(program)] = np.frombuffer(bytes(program), np.uint8)
+        machines.keys[:] = masks
+        machines.run(70)
+        for m, keys in enumerate(masks):
+            cpu = make_cpu(config, program)
+            cpu.keyboard.keys = keys
+            cpu.run(70)
+            assert(machines.V_register[m].tobytes() == bytes(cpu.V_register))
+            assert(machines.program_counter[m] == cpu.program_counter)
+        assert(machines.V_register[:, 3].tolist() == [5, 2, 0, 3, 15])
+
+    def test_fault_on_unknown_opcode(self, config, tmpdir):
+        from lockstep import LockstepCPU
+        rom = tmpdir.join('rom.ch8')
+        rom.write_binary(bytes(bytearray([0x70, 0x01, 0x3F, 0x00, 0x00, 0x00, 0x12, 0x00])))
+        machines = LockstepCPU(config, 3)
+        machines.load_rom_into_memory(str(rom))
+        machines.V_register[1, 0xF] = 1
+        machines.run(10)
+        assert(machines.faulted.tolist() == [False, True, False])
+        assert(machines.program_counter.tolist() == [0x202, 0x204, 0x202])
+        assert(machines.V_register[:, 0].tolist() == [4, 1, 4])
+
+
+class TestSnapshot:
+    @staticmethod
+    def state(cpu):
+        return (bytes(cpu.memory), bytes(cpu.V_register), cpu.I, cpu.program_counter, cpu.stack_pointer,
+                cpu.stack.tolist(), cpu.delay_timer, cpu.sound_timer, cpu.opcode, cpu.cycles,
+                cpu.keyboard.key_down, cpu.screen.rows)
+
+    def test_restore_into_other_cpu(self, config):
+        from headless import create_cpu
+        cpu = running_cpu(config)
+        data = cpu.snapshot()
+        assert(len(data) < 4096 + 512)
+        other = create_cpu(config)
+        other.restore(data)
+        assert(self.state(other) == self.state(cpu))
+        for machine in (cpu, other):
+            for _ in range(50):
+                machine.run(9)
+                machine.tick_timers()
+        assert(self.state(other) == self.state(cpu))
+
+    def test_restore_drops_queued_key_events(self, config):
+        cpu = running_cpu(config)
+        data = cpu.snapshot()
+        cpu.keyboard.push_event(cpu.cycles + 5, 3, True)
+        cpu.run(9)
+        cpu.keyboard.push_event(cpu.cycles + 5, 4, True)
+        cpu.restore(data)
+        assert(not cpu.keyboard.events)
+        cpu.run(20)
+        assert(cpu.keyboard.keys == 1 << 7)
+
+    def test_restore_keeps_decode_cache(self, config):
+        cpu = running_cpu(config)
+        data = cpu.snapshot()
+        decode_cache = cpu.decode_cache
+        decoded = list(decode_cache)
+        assert(any(decoded))
+        cpu.run(9)
+        cpu.restore(data)
+        # Memory is unchanged, so nothing has to be decoded again
+        assert(cpu.decode_cache is decode_cache)
+        assert(all(entry is not None for entry, before in zip(cpu.decode_cache, decoded) if before is not None))
+
+    def test_save_and_load_file(self, config, tmpdir):
+        from headless import create_cpu
+        cpu = running_cpu(config)
+        path = str(tmpdir.join('state.c8s'))
+        cpu.save_snapshot(path)
+        other = create_cpu(config)
+        other.load_snapshot(path)
+        assert(self.state(other) == self.state(cpu))
+
+    def test_restore_rejects_other_data(self, config):
+        cpu = running_cpu(config)
+        with pytest.raises(AssertionError):
+            cpu.restore(b'XXXX' + cpu.snapshot()[4:])
+
+
+class TestRewind:
+    @pytest.fixture(scope='function')
+    def cpu(self, config):
+        cpu = running_cpu(config)
+        return cpu
+
+    def test_encode_delta(self):
+        from rewind import encode_delta, decode_delta
+        keyframe = bytes(bytearray(range(256))*4)
+        state = bytearray(keyframe)
+        state[3] ^= 0xFF
+        state[5] ^= 0x01
+        state[700:720] = bytearray(20)
+        delta = encode_delta(keyframe, bytes(state))
+        assert(len(delta) < 40)
+        assert(decode_delta(keyframe, delta) == bytes(state))
+        assert(encode_delta(keyframe, keyframe) == b'')
+
+    def test_rewind(self, cpu):
+        from rewind import RewindBuffer
+        history = RewindBuffer(cpu, keyframe_interval=16)
+        states = []
+        for _ in range(100):
+            cpu.run(9)
+            cpu.tick_timers()
+            history.record()
+            states.append(cpu.snapshot())
+        assert(len(history) == 100)
+        assert(history.size < 100*len(states[0]) // 4)
+        assert(all(history.state(i) == states[i] for i in range(100)))
+        history.rewind(37)
+        assert(len(history) == 63)
+        assert(cpu.snapshot() == states[62])
+        history.rewind()
+        assert(cpu.snapshot() == states[61])
+        cpu.run(9)
+        history.record()
+        assert(history.state(-1) == cpu.snapshot())
+        with pytest.raises(IndexError):
+            history.rewind(len(history))
+
+    def test_capacity(self, cpu):
+        from rewind import RewindBuffer
+        history = RewindBuffer(cpu, capacity=3*len(cpu.snapshot()), keyframe_interval=10)
+        for _ in range(200):
+            cpu.run(9)
+            history.record()
+        assert(history.size <= history.capacity)
+        assert(0 < len(history) < 200)
+        assert(history.state(-1) == cpu.snapshot())
+
+
+class TestReplay:
+    @pytest.fixture(scope='function')
+    def rom(self, tmpdir):
+        program = bytearray([0xE1, 0x9E,  # 0x200: SKP V1
+                             0x12, 0x08,  # 0x202: JP 0x208
+                             0xC2, 0xFF,  # 0x204: RND V2, 0xFF
+                             0x71, 0x01,  # 0x206: ADD V1, 1
+                             0xF0, 0x07,  # 0x208: LD V0, DT
+                             0x30, 0x00,  # 0x20A: SE V0, 0
+                             0x12, 0x00,  # 0x20C: JP 0x200
+                             0xA0, 0x00,  # 0x20E: LD I, 0
+                             0xD2, 0x15,  # 0x210: DRW V2, V1, 5
+                             0x63, 0x03,  # 0x212: LD V3, 3
+                             0xF3, 0x15,  # 0x214: LD DT, V3
+                             0x12, 0x00])  # 0x216: JP 0x200
+        rom = tmpdir.join('rom.ch8')
+        rom.write_binary(bytes(program))
+        return str(rom)
+
+    def test_record_and_replay(self, config, rom, tmpdir):
+        from headless import create_cpu
+        from scheduler import Scheduler
+        from replay import InputRecorder, InputLog, replay
+        cpu = create_cpu(config, rom)
+        recorder = InputRecorder(cpu, rom, 1234)
+        presses = {3: 0, 10: 1, 11: None, 40: 2, 41: 2, 90: 3, 200: None}
+        scheduler = Scheduler(cpu, cpu.cycles_per_frame)
+        for frame in range(300):
+            if frame in presses:
+                cpu.keyboard.key_down = presses[frame]
+            recorder.poll()
+            scheduler.run_frame()
+        path = str(tmpdir.join('session.c8i'))
+        recorder.finish().save(path)
+        log = InputLog.load(path)
+        assert(len(log.events) == 6)
+        assert(log.end_cycle == 300*cpu.cycles_per_frame)
+
+        replayed, identical = replay(config, rom, log)
+        assert(identical)
+        assert(replayed.snapshot() == cpu.snapshot())
+
+        log.events = log.events[1:]
+        assert(not replay(config, rom, log)[1])
+
+
+class TestProfiler:
+    def test_counts(self, config):
+        from profiler import Profiler
+        from scheduler import Scheduler
+        program = random_program(2)
+        reference = make_cpu(config, program)
+        cpu = make_cpu(config, program)
+        profiler = Profiler(cpu)
+        scheduler = Scheduler(cpu, 9, engine=profiler)
+        for _ in range(100):
+            scheduler.run_frame()
+            reference.run(9)
+            reference.tick_timers()
+        assert(cpu.snapshot() == reference.snapshot())
+        assert(sum(profiler.address_counts) == sum(profiler.handler_counts) == 900)
+        handlers = dict(profiler.handlers())
+        assert(handlers['call_subroutine_at'] == handlers['jump_to_location'] == profiler.address_counts[0x200 + 2*120])
+        assert(profiler.hot_spots(1)[0][1] == max(profiler.address_counts))
+        assert(profiler.sprite_time > 0)
+        assert('display_sprite' in profiler.report())
+
+    def test_redraw_timing(self, config):
+        import pygame
+        from profiler import Profiler
+        cpu = make_cpu(config, bytearray([0x12, 0x00]))
+        profiler = Profiler(cpu)
+        background = pygame.Surface((640, 320))
+        assert(len(cpu.screen.redraw(background)) == 1)
+        assert(cpu.screen.redraw(background) == [])
+        assert(profiler.redraw_count == 2 and profiler.redraw_time > 0)
+        cpu.clone().screen.redraw(background)
+        assert(profiler.redraw_count == 2)
+        profiler.detach()
+        cpu.screen.redraw(background)
+        assert(profiler.redraw_count == 2)
+
+    def test_without_screen(self, config):
+        from profiler import Profiler
+        cpu = CPU(config, None, Keyboard(), CountingSound())
+        cpu.memory[0x200:0x204] = bytearray([0x70, 0x01, 0x12, 0x00])  # ADD V0, 1; JP 0x200
+        profiler = Profiler(cpu)
+        assert(profiler.run(10) == 10)
+        profiler.detach()
+        assert(cpu.V_register[0] == 5)
+
+    def test_counts_debugger_handlers(self, config):
+        from debugger import Debugger
+        from profiler import Profiler
+        program = bytearray([0xA3, 0x00,  # 0x200: LD I, 0x300
+                             0xF1, 0x55,  # 0x202: LD [I], V1
+                             0x12, 0x02])  # 0x204: JP 0x202
+        cpu = make_cpu(config, program)
+        profiler = Profiler(cpu)
+        Debugger(cpu)
+        profiler.run(9)
+        assert(dict(profiler.handlers())['write_vx_in_memory'] == 4)
+        assert(len(set(profiler.handler_names)) == len(profiler.handler_names))
+
+
+class TestBenchmark:
+    def test_roms_agree_across_engines(self, config):
+        from benchmark import ROMS, ENGINES, load_program
+        from scheduler import Scheduler
+        for program in ROMS.values():
+            snapshots = set()
+            for engine in ENGINES.values():
+                cpu = load_program(config, program)
+                scheduler = Scheduler(cpu, 100, engine=engine(cpu))
+                for _ in range(5):
+                    scheduler.run_frame()
+                snapshots.add((bytes(cpu.memory), bytes(cpu.V_register), cpu.I, cpu.program_counter,
+                               cpu.delay_timer, tuple(cpu.screen.rows)))
+            assert(len(snapshots) == 1)
+
+    def test_run_benchmarks(self, config):
+        import json
+        from benchmark import ROMS, ENGINES, run_benchmarks, report
+        results = json.loads(json.dumps(run_benchmarks(config, frames=2, cycles_per_frame=10, micro_calls=10)))
+        assert(sorted(results['roms']) == sorted(ROMS))
+        assert(all(sorted(engines) == sorted(ENGINES) for engines in results['roms'].values()))
+        assert(results['roms']['alu']['run']['instructions'] == 20)
+        assert(results['micro']['display_sprite']['calls_per_second'] > 0)
+        assert(results['micro']['CPU.restore']['calls_per_second'] > 0)
+        assert(results['micro']['CPU.clone']['calls_per_second'] > 0)
+        assert('idle/translator' in report(results, results))
+
+
+class TestClone:
+    @pytest.fixture(scope='function')
+    def cpu(self, config):
+        return running_cpu(config)
+
+    def test_clone_is_independent(self, cpu):
+        state = cpu.snapshot()
+        other = cpu.clone()
+        assert(other.snapshot() == state)
+        assert(other.main_functions is cpu.main_functions)
+        other.keyboard.key_down = 2
+        for _ in range(30):
+            other.run(9)
+            other.tick_timers()
+        assert(cpu.snapshot() == state)
+        assert(other.snapshot() != state)
+        branch = cpu.clone()
+        for machine in (cpu, branch):
+            for _ in range(30):
+                machine.run(9)
+                machine.tick_timers()
+        assert(branch.snapshot() == cpu.snapshot())
+
+    def test_clone_of_self_modifying_code(self, cpu):
+        cpu.memory[0x300:0x304] = bytearray([0x70, 0x01, 0x13, 0x00])  # ADD V0, 1; JP 0x300
+        cpu.invalidate_decode_cache(0x300, 0x304)
+        cpu.program_counter = 0x300
+        cpu.run(10)
+        other = cpu.clone()
+        assert(other.decode_cache is cpu.decode_cache)
+        other.memory[0x300:0x302] = bytearray([0x71, 0x01])  # ADD V1, 1
+        other.invalidate_decode_cache(0x300, 0x302)
+        assert(other.decode_cache is not cpu.decode_cache)
+        v = (cpu.V_register[0], cpu.V_register[1])
+        for machine in (cpu, other):
+            machine.run(10)
+        assert((cpu.V_register[0], cpu.V_register[1]) == ((v[0] + 5) & 0xFF, v[1]))
+        assert((other.V_register[0], other.V_register[1]) == (v[0], (v[1] + 5) & 0xFF))
+
+    def test_clone_drops_debugger_tables(self, cpu):
+        from debugger import Debugger
+        Debugger(cpu).watch(0x000, 0x1000)
+        cpu.run(9)
+        other = cpu.clone()
+        assert('f_functions' not in vars(other) and other.decode_cache is not cpu.decode_cache)
+        other.run(900)
+        f_entries = [entry for entry in other.decode_cache if entry is not None and entry[0] >> 12 == 0xF]
+        assert(f_entries)
+        assert(all(fun is CPU.f_functions[opcode & 0xFF] for opcode, fun in f_entries))
+
+    def test_clone_shares_what_it_can(self, cpu):
+        other = cpu.clone()
+        assert(other.decode_cache is cpu.decode_cache)
+        assert(other.screen.rows is not cpu.screen.rows and other.keyboard is not cpu.keyboard)
+        assert(other.memory is not cpu.memory and other.memory == cpu.memory)
+        assert(other.sound is cpu.sound)
+
+
+class TestExplore:
+    @pytest.fixture(scope='function')
+    def rom(self, tmpdir):
+        program = bytearray([0xF1, 0x0A,  # 0x200: LD V1, K
+                             0x62, 0x03,  # 0x202: LD V2, 3
+                             0x82, 0x12,  # 0x204: AND V2, V1
+                             0xF2, 0x29,  # 0x206: LD F, V2
+                             0x00, 0xE0,  # 0x208: CLS
+                             0xD0, 0x05,  # 0x20A: DRW V0, V0, 5
+                             0x73, 0x01,  # 0x20C: ADD V3, 1
+                             0x43, 0x03,  # 0x20E: SNE V3, 3
+                             0x63, 0x00,  # 0x210: LD V3, 0
+                             0x12, 0x00])  # 0x212: JP 0x200
+        rom = tmpdir.join('rom.ch8')
+        rom.write_binary(bytes(program))
+        return str(rom)
+
+    def test_state_digest(self, config, rom):
+        from headless import create_cpu
+        from explore import state_digest
+        cpu = create_cpu(config, rom)
+        digest = state_digest(cpu)
+        other = cpu.clone()
+        other.cycles += 100
+        other.keyboard.key_down = 3
+        assert(state_digest(other) == digest)
+        other.screen.draw_sprite(0, 0, bytearray([1]))
+        assert(state_digest(other) != digest)
+
+    def test_breadth_first(self, config, rom):
+        from headless import create_cpu, run_frames
+        from explore import Explorer, state_digest
+        explorer = Explorer(rom, frames_per_step=1, actions=[None, 1, 2, 6], processes=1, batch_size=4)
+        assert(explorer.run() == len(explorer.parents))
+        assert(explorer.expanded == len(explorer))
+        assert(explorer.duplicates == 4*len(explorer) - (len(explorer) - 1))
+        parallel = Explorer(rom, frames_per_step=1, actions=[None, 1, 2, 6], processes=2, batch_size=4)
+        parallel.run()
+        assert(set(parallel.parents) == set(explorer.parents))
+        for digest in explorer.parents:
+            cpu = create_cpu(config, rom)
+            for action in explorer.path(digest):
+                cpu.keyboard.key_down = action
+                run_frames(cpu, 1)
+            assert(state_digest(cpu) == digest)
+            assert(len(explorer.path(digest)) == explorer.depths[digest])
+
+    def test_best_first(self, rom):
+        from explore import Explorer
+        explorer = Explorer(rom, frames_per_step=1, actions=[None, 1, 2, 6], score=lambda cpu: cpu.V_register[2],
+                            processes=1, batch_size=1)
+        explorer.run(max_states=5)
+        best = explorer.best()
+        assert(explorer.scores[best] == 2)
+        assert(explorer.path(best) == [2])
+        explorer = Explorer(rom, frames_per_step=1, processes=1)
+        assert(explorer.run(max_depth=1) == 17)
+        assert(max(explorer.depths.values()) == 1)
+
+
+class TestEnv:
+    @pytest.fixture(scope='function')
+    def rom(self, tmpdir):
+        program = bytearray([0xF1, 0x0A,  # 0x200: LD V1, K
+                             0xF1, 0x29,  # 0x202: LD F, V1
+                             0x00, 0xE0,  # 0x204: CLS
+                             0x72, 0x01,  # 0x206: ADD V2, 1
+                             0xD0, 0x25,  # 0x208: DRW V0, V2, 5
+                             0x63, 0x01,  # 0x20A: LD V3, 1
+                             0xF3, 0x15,  # 0x20C: LD DT, V3
+                             0xF4, 0x07,  # 0x20E: LD V4, DT
+                             0x34, 0x00,  # 0x210: SE V4, 0
+                             0x12, 0x0E,  # 0x212: JP 0x20E
+                             0x12, 0x00])  # 0x214: JP 0x200
+        rom = tmpdir.join('rom.ch8')
+        rom.write_binary(bytes(program))
+        return str(rom)
+
+    @staticmethod
+    def done(cpu):
+        return cpu.V_register[2] >= 2
+
+    def test_step_and_reset(self, rom):
+        from env import Chip8Env
+        env = Chip8Env(rom, frames_per_step=1, reward=lambda cpu: cpu.V_register[1], done=self.done)
+        observation = env.reset()
+        assert(observation.shape == (32, 64) and not observation.any())
+        observation, reward, done, info = env.step(9)
+        assert((reward, done) == (8, False))
+        assert(observation[1:6, :4].tolist() == [[1, 1, 1, 1], [1, 0, 0, 1], [1, 1, 1, 1], [1, 0, 0, 1], [1, 1, 1, 1]])
+        assert(observation.sum() == 16)
+        assert(env.step(0)[1:3] == (8, False))
+        assert(env.step(0)[0].sum() == 16)
+        assert(env.step(2)[2] is True)
+        assert(not env.reset().any())
+        out = np.ones((32, 64), dtype=np.uint8)
+        assert(env.step(2, out)[0] is out and out.sum() == 8)
+
+    def test_vector_env(self, rom):
+        from env import Chip8Env, VectorEnv
+        vector = VectorEnv(rom, 5, processes=2, frames_per_step=1, done=self.done)
+        try:
+            assert(not vector.reset().any())
+            singles = [Chip8Env(rom, frames_per_step=1, seed=i, done=self.done) for i in range(5)]
+            n_done = 0
+            for step in range(6):
+                actions = [(step + i) % 3 for i in range(5)]
+                observations, rewards, dones = vector.step(actions)
+                assert(observations is vector.observations)
+                n_done += dones.sum()
+                for i, env in enumerate(singles):
+                    expected, _, done, _ = env.step(actions[i])
+                    if done:
+                        expected = env.reset()
+                    assert(dones[i] == done)
+                    assert(np.array_equal(observations[i], expected))
+            assert(n_done > 0)
+        finally:
+            vector.close()
+
+
+class TestAudio:
+    def test_square_wave(self):
+        from audio import square_wave
+        samples = square_wave(441, 44100, volume=0.5, duration=0.01)
+        assert(samples.typecode == 'h')
+        assert(len(samples) == 400)
+        assert(samples[:100].tolist() == [16383]*50 + [-16383]*50)
+        assert(samples[:100] == samples[300:])
+        stereo = square_wave(441, 44100, channels=2, duration=0.01)
+        assert(len(stereo) == 800 and stereo[0] == stereo[1])
+
+    def test_headless_audio_follows_sound_timer(self, config):
+        from headless import create_cpu
+        cpu = create_cpu(config)
+        cpu.sound_timer = 1
+        cpu.tick_timers()
+        assert(cpu.sound.active)
+        cpu.tick_timers()
+        assert(not cpu.sound.active)
+
+
+class TestServer:
+    @pytest.fixture(scope='function')
+    def server(self, tmpdir):
+        from server import SessionServer
+        program = bytearray([0xF1, 0x0A,  # 0x200: LD V1, K
+                             0xF1, 0x29,  # 0x202: LD F, V1
+                             0x00, 0xE0,  # 0x204: CLS
+                             0xD0, 0x05,  # 0x206: DRW V0, V0, 5
+                             0x12, 0x00])  # 0x208: JP 0x200
+        rom = tmpdir.join('digits.ch8')
+        rom.write_binary(bytes(program))
+        crash = tmpdir.join('crash.ch8')
+        crash.write_binary(bytes(bytearray([0x01, 0x23])))  # 0x200: SYS 0x123, not supported
+        server = SessionServer({'digits': str(rom), 'crash': str(crash)}, processes=1)
+        server.listen(str(tmpdir.join('server.sock')))
+        yield server
+        server.close()
+        assert(not tmpdir.join('server.sock').check())
+
+    def connect(self, server, name):
+        import socket
+        from server import pack_message
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(server.address)
+        client.sendall(pack_message(b'H', name.encode('utf-8')))
+        client.setblocking(False)
+        return client
+
+    def receive(self, server, client, count=1):
+        import socket
+        from server import split_messages
+        buffer = bytearray()
+        messages = []
+        for _ in range(200):
+            server.poll(0.01)
+            try:
+                data = client.recv(4096)
+            except socket.error:
+                continue
+            if not data:
+                break
+            buffer += data
+            messages += split_messages(buffer)
+            if len(messages) >= count:
+                break
+        return messages
+
+    def test_frame_deltas(self, server):
+        from server import KEY, decode_frame, pack_message
+        client = self.connect(server, 'digits')
+        rows = [None]*32
+        [(kind, payload)] = self.receive(server, client)
+        assert(kind == b'F')
+        assert(decode_frame(payload, rows) == 0)
+        assert(rows == [0]*32)
+        client.sendall(pack_message(b'K', KEY.pack(1, 1)) + pack_message(b'K', KEY.pack(1, 0)))
+        [(kind, payload)] = self.receive(server, client)
+        assert(kind == b'F')
+        assert(len(payload) == 12 + 5*8)
+        assert(decode_frame(payload, rows) > 0)
+        assert([row >> 56 for row in rows[:6]] == [0x20, 0x60, 0x20, 0x20, 0x70, 0])
+        assert(self.receive(server, client) == [])
+        client.close()
+        for _ in range(10):
+            server.poll(0.01)
+        assert(not server.sessions and server.loads == [0])
+
+    def test_failing_session_is_dropped_alone(self, server):
+        from server import KEY, decode_frame, pack_message
+        healthy = self.connect(server, 'digits')
+        assert(self.receive(server, healthy)[0][0] == b'F')
+        failing = self.connect(server, 'crash')
+        messages = self.receive(server, failing, 2)
+        assert([kind for kind, _ in messages] == [b'F', b'E'])
+        assert(messages[1][1].startswith(b'KeyError'))
+        assert(len(server.sessions) == 1 and server.loads == [1])
+        healthy.sendall(pack_message(b'K', KEY.pack(2, 1)))
+        [(kind, payload)] = self.receive(server, healthy)
+        rows = [0]*32
+        decode_frame(payload, rows)
+        assert(rows[0] >> 56 == 0xF0)
+        healthy.close()
+        failing.close()
+
+    def test_step_after_failed_open(self, tmpdir):
+        import multiprocessing
+        import threading
+        from server import session_worker
+        rom = tmpdir.join('big.ch8')
+        rom.write_binary(b'\x00'*4000)
+        connection, worker_connection = multiprocessing.Pipe()
+        thread = threading.Thread(target=session_worker, args=(worker_connection, 'config.cfg'))
+        thread.start()
+        connection.send(('open', (0, str(rom), None)))
+        connection.send(('step', [(0, 1, [])]))
+        [(_, delta, error)] = connection.recv()[1]
+        assert(delta is None and error.startswith('AssertionError'))
+        [(_, delta, error)] = connection.recv()[1]
+        assert(delta is None and error.startswith('KeyError'))
+        connection.send(('stop', None))
+        thread.join()
+
+    def test_dead_worker_ends_its_sessions(self, server):
+        client = self.connect(server, 'digits')
+        assert(self.receive(server, client)[0][0] == b'F')
+        server.workers[0].terminate()
+        server.workers[0].join()
+        assert(self.receive(server, client) == [(b'E', b'worker process died')])
+        assert(not server.sessions and server.connections == [None])
+        client = self.connect(server, 'digits')
+        assert(self.receive(server, client) == [(b'E', b'no worker available')])
+
+    def test_unknown_rom(self, server):
+        client = self.connect(server, 'missing')
+        [(kind, payload)] = self.receive(server, client)
+        assert((kind, payload) == (b'E', b'unknown ROM: missing'))
+        assert(not server.sessions)
+
+
+class TestFrameStream:
+    def test_rle(self):
+        from framestream import rle_decode, rle_encode
+        for data in [b'', b'\x00', b'\x01\x00\x02', b'\x00'*300, bytes(bytearray(range(256))*2),
+                     b'\x05\x00\x00\x07' + b'\x00'*129 + b'\x09']:
+            assert(rle_decode(rle_encode(data)) == data)
+        assert(len(rle_encode(b'\x00'*256)) == 2)
+
+    def test_stream_round_trip(self, config):
+        import io
+        from benchmark import ROMS, load_program
+        from framestream import FrameStreamReader, FrameStreamWriter
+        from headless import run_frames
+        cpu = load_program(config, ROMS['draw'])
+        frames = []
+        f = io.BytesIO()
+        writer = FrameStreamWriter(f, keyframe_interval=7)
+
+        def on_frame(cpu):
+            writer.write(cpu.screen)
+            frames.append(cpu.screen.to_bytes())
+        run_frames(cpu, 30, 5, on_frame)
+        cpu.memory[0x300:0x302] = bytearray([0x13, 0x00])  # 0x300: JP 0x300
+        cpu.invalidate_decode_cache()
+        cpu.program_counter = 0x300
+        run_frames(cpu, 20, 5, on_frame)
+        assert(writer.finish() == 50)
+        reader = FrameStreamReader(f.getvalue())
+        assert(len(reader) == 50)
+        assert(list(reader) == frames)
+        for n in [49, 3, 17, 16, 40, 0, -1]:
+            assert(reader[n] == frames[n])
+        assert(len(reader.keyframes) == 5)
+        assert(reader.records[-1][0] == b'S')
+        assert(len(f.getvalue()) < len(frames)*len(frames[0]) // 4)
+        with pytest.raises(IndexError):
+            reader[50]
+
+
+class TestExport:
+    class ListWriter:
+        def __init__(self, gate=None):
+            import threading
+            self.frames = []
+            self.gate = gate
+            self.writing = threading.Event()
+            self.closed = False
+
+        def write_frame(self, frame, rows):
+            self.writing.set()
+            if self.gate is not None:
+                self.gate.wait()
+            self.frames.append((frame, rows))
+
+        def close(self):
+            self.closed = True
+
+    def screen(self, rows):
+        from framebuffer import FrameBuffer
+        screen = FrameBuffer(64, 32)
+        screen.rows = list(rows)
+        return screen
+
+    def test_every_and_changed_only(self):
+        from export import FrameExporter
+        frames = [[n // 4]*32 for n in range(20)]
+        writer = self.ListWriter()
+        exporter = FrameExporter(writer, every=2, changed_only=True)
+        for rows in frames:
+            exporter.submit(self.screen(rows))
+        exporter.close()
+        assert(writer.closed)
+        assert([frame for frame, _ in writer.frames] == [0, 4, 8, 12, 16])
+        assert(all(rows == frames[frame] for frame, rows in writer.frames))
+
+    def test_full_queue_drops_frames(self):
+        import threading
+        from export import FrameExporter
+        gate = threading.Event()
+        writer = self.ListWriter(gate)
+        exporter = FrameExporter(writer, queue_size=2)
+        exporter.submit(self.screen([0]*32))
+        # The writer holds frame 0, so the queue takes two frames and drops the rest
+        assert(writer.writing.wait(5))
+        for n in range(1, 10):
+            exporter.submit(self.screen([n]*32))
+        gate.set()
+        exporter.close()
+        assert((exporter.exported, exporter.dropped) == (3, 7))
+        assert([frame for frame, _ in writer.frames] == [0, 1, 2])
+
+    def test_writers(self, tmpdir):
+        import random
+        import pygame
+        from export import RAW_FRAME, FrameExporter, create_writer
+        rng = random.Random(3)
+        frames = [[rng.getrandbits(64) for _ in range(32)] for _ in range(3)]
+        for kind, path in [('png', str(tmpdir)), ('gif', str(tmpdir.join('frames.gif'))),
+                           ('raw', str(tmpdir.join('frames.raw')))]:
+            exporter = FrameExporter(create_writer(kind, path, scale=2 if kind == 'gif' else 1))
+            for rows in frames:
+                exporter.submit(self.screen(rows))
+            exporter.close()
+        for path, scale in [(tmpdir.join('frame000000.png'), 1), (tmpdir.join('frames.gif'), 2)]:
+            image = pygame.image.load(str(path))
+            assert(image.get_size() == (64*scale, 32*scale))
+            assert(all((image.get_at((x*scale, y*scale))[0] > 0) == bool((frames[0][y] >> (63-x)) & 1)
+                       for x in range(64) for y in range(32)))
+        assert(tmpdir.join('frame000002.png').check())
+        raw = tmpdir.join('frames.raw').read_binary()
+        size = RAW_FRAME.size + 32*8
+        assert(len(raw) == 3*size)
+        assert(RAW_FRAME.unpack_from(raw, 2*size) == (2,))
+        assert(raw[2*size+RAW_FRAME.size:] == self.screen(frames[2]).to_bytes())
+
+
+class TestDebugger:
+    @pytest.fixture(scope='function')
+    def cpu(self, config):
+        from headless import create_cpu
+        cpu = create_cpu(config, seed=1)
+        program = bytearray([0xA3, 0x00,  # 0x200: LD I, 0x300
+                             0x22, 0x10,  # 0x202: CALL 0x210
+                             0xF2, 0x55,  # 0x204: LD [I], V2
+                             0xF1, 0x65,  # 0x206: LD V1, [I]
+                             0x12, 0x02,  # 0x208: JP 0x202
+                             0x00, 0x00,
+                             0x00, 0x00,
+                             0x00, 0x00,
+                             0x70, 0x01,  # 0x210: ADD V0, 1
+                             0x72, 0x02,  # 0x212: ADD V2, 2
+                             0x00, 0xEE])  # 0x214: RET
+        cpu.memory[0x200:0x200+len(program)] = program
+        cpu.invalidate_decode_cache()
+        return cpu
+
+    def test_breakpoints(self, cpu):
+        from debugger import Debugger, STOP_BREAKPOINT
+        from cpu import STOP_BUDGET
+        debugger = Debugger(cpu)
+        debugger.add_breakpoint(0x212)
+        assert(debugger.run(100) == STOP_BREAKPOINT)
+        assert((cpu.program_counter, cpu.cycles, debugger.hit) == (0x212, 3, (STOP_BREAKPOINT, 0x212)))
+        assert(debugger.run(100) == STOP_BREAKPOINT and cpu.cycles == 3)
+        assert(debugger.resume(100) == STOP_BREAKPOINT)
+        assert((cpu.program_counter, cpu.cycles) == (0x212, 10))
+        debugger.remove_breakpoint(0x212)
+        debugger.resume()
+        assert(debugger.run(10) == STOP_BUDGET and cpu.cycles == 20)
+        assert(debugger.describe(0x204) == '0x204  F255  write_vx_in_memory')
+
+    def test_watchpoints(self, cpu):
+        from debugger import Debugger, STOP_WATCHPOINT
+        debugger = Debugger(cpu)
+        debugger.watch(0x301, access='r')
+        assert(debugger.run(100) == STOP_WATCHPOINT)
+        assert((cpu.program_counter, debugger.hit) == (0x208, (STOP_WATCHPOINT, (0x301, 'r'))))
+        debugger.unwatch(0x301)
+        debugger.watch(0x302, access='w')
+        assert(debugger.resume(100) == STOP_WATCHPOINT)
+        assert((cpu.program_counter, debugger.hit) == (0x206, (STOP_WATCHPOINT, (0x302, 'w'))))
+        assert(cpu.memory[0x302] == 4)
+
+    def test_watchpoint_hit_outside_execute_is_ignored(self, cpu):
+        from debugger import Debugger
+        from cpu import STOP_BUDGET
+        debugger = Debugger(cpu)
+        debugger.watch(0x302, access='w')
+        cpu.run(6)
+        assert(cpu.program_counter == 0x206)
+        assert(debugger.step() == STOP_BUDGET)
+        assert(cpu.program_counter == 0x208)
+
+    def test_register_conditions(self, cpu):
+        from debugger import Debugger, STOP_CONDITION
+        debugger = Debugger(cpu)
+        name = debugger.watch_register(2, 6)
+        assert(debugger.run(100) == STOP_CONDITION)
+        assert((debugger.hit, cpu.V_register[2], cpu.program_counter) == ((STOP_CONDITION, name), 6, 0x214))
+        debugger.remove_condition(name)
+        debugger.watch_register(0)
+        assert(debugger.resume(100) == STOP_CONDITION)
+        assert((cpu.V_register[0], cpu.program_counter) == (4, 0x212))
+
+    def test_step_and_step_over(self, cpu):
+        from debugger import Debugger
+        debugger = Debugger(cpu)
+        debugger.step()
+        assert(cpu.program_counter == 0x202 and debugger.paused)
+        debugger.step_over()
+        assert((cpu.program_counter, cpu.cycles, cpu.V_register[0]) == (0x204, 5, 1))
+        debugger.step()
+        assert(cpu.program_counter == 0x206)
+        debugger.add_breakpoint(0x214)
+        debugger.step()
+        debugger.step()
+        debugger.step_over()
+        assert(cpu.program_counter == 0x214)
+
+    def test_detach_restores_dispatch(self, cpu):
+        from cpu import CPU
+        from debugger import Debugger
+        reference = cpu.clone()
+        debugger = Debugger(cpu)
+        debugger.watch(0x300, 16)
+        assert(cpu.f_functions is not CPU.f_functions)
+        debugger.detach()
+        assert(cpu.f_functions is CPU.f_functions and debugger.run(50) == 0)
+        assert(cpu.decode_cache[0x204][1] is CPU.f_functions[0x55])
+        reference.run(50)
+        assert((cpu.V_register, cpu.program_counter) == (reference.V_register, reference.program_counter))
+
+    def test_shell_survives_bad_arguments(self, cpu, capsys):
+        from debugger import Debugger, DebuggerShell
+        shell = DebuggerShell(Debugger(cpu))
+        for line in ('break', 'break xyz', 'mem', 'step ten'):
+            assert(not shell.onecmd(line))
+            assert(capsys.readouterr()[0].startswith('usage: '))
+        shell.onecmd('step 10')
+        assert(cpu.cycles == 10)
+        capsys.readouterr()
+        pc = cpu.program_counter
+        cpu.memory[pc:pc+2] = bytearray([0x01, 0x23])  # SYS 0x123, not supported
+        cpu.invalidate_decode_cache(pc, pc+2)
+        for line in ('step', 'continue'):
+            assert(not shell.onecmd(line))
+            assert(capsys.readouterr()[0] == 'unknown opcode\n0x{:03X}  0123  ?\n'.format(pc))
+            assert(shell.debugger.paused and cpu.program_counter == pc)
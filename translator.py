@@ -0,0 +1,310 @@
+class Block:
+    def __init__(self, start, end, length, opcode, function, source):
+        self.start = start
+        self.end = end  # first address after the block
+        self.length = length  # number of instructions
+        self.opcode = opcode  # of the last instruction
+        self.function = function
+        self.source = source
+
+
+class BlockTranslator:
+    """
+    Execution engine compiling straight-line CHIP-8 code into Python functions.
+
+    A block starts at any address and runs until the first jump, call,
+    return, skip, draw, key access or memory write. It is compiled once with
+    the V registers and I held in local variables, then cached by its start
+    address until the program writes over it.
+    """
+    max_block_length = 32
+    jump_functions = ('return_from_subroutine', 'jump_to_location', 'call_subroutine_at',
+                      'skip_next_if_vx_equals_kk', 'skip_next_if_vx_not_equals_kk',
+                      'skip_next_if_vx_equals_vy', 'skip_next_if_vx_not_equals_vy',
+                      'jump_to_location_shift')
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.blocks = {}
+        self.covering = {}  # address -> start of the blocks covering it
+        cpu.invalidation_hooks.append(self.invalidate)
+
+    def invalidate(self, start=0, end=None):
+        if end is None:
+            end = self.cpu.memory_size
+        if end - start > len(self.covering):
+            stale = set(s for a, starts in self.covering.items() if start <= a < end for s in starts)
+        else:
+            stale = set(s for a in range(start, end) for s in self.covering.get(a, ()))
+        for block_start in stale:
+            block = self.blocks.pop(block_start)
+            for address in range(block.start, block.end):
+                starts = self.covering[address]
+                starts.discard(block_start)
+                if not starts:
+                    del self.covering[address]
+
+    def decode(self, address):
+        cpu = self.cpu
+        saved_opcode = cpu.opcode
+        try:
+            opcode = cpu.memory[address] << 8 | cpu.memory[address+1]
+            cpu.opcode = opcode
+            return opcode, cpu.get_opcode_function().__name__
+        except (IndexError, KeyError):
+            return None, None
+        finally:
+            cpu.opcode = saved_opcode
+
+    def translate(self, start):
+        """
+        Compile the block starting at start, or return None when the first
+        instruction has to go through the interpreter.
+        """
+        body = []
+        read = set()
+        written = set()
+        i_state = {'read': False, 'written': False}
+        address = start
+        length = 0
+        last_opcode = None
+        next_pc = None
+        emit = body.append
+
+        def use(*registers):
+            read.update(registers)
+
+        def set_(*registers):
+            read.update(registers)
+            written.update(registers)
+
+        while length < self.max_block_length:
+            opcode, name = self.decode(address)
+            if opcode is None:
+                break
+            length += 1
+            last_opcode = opcode
+            x = (opcode >> 8) & 0xF
+            y = (opcode >> 4) & 0xF
+            kk = opcode & 0x00FF
+            nnn = opcode & 0x0FFF
+            vx = 'v%d' % x
+            vy = 'v%d' % y
+            if name == 'clear_display':
+                emit('cpu.clear_display()')
+            elif name == 'set_vx_to_kk':
+                set_(x)
+                emit('%s = %d' % (vx, kk))
+            elif name == 'add_to_vx':
+                set_(x)
+                emit('%s = (%s + %d) & 0xFF' % (vx, vx, kk))
+            elif name == 'set_vx_to_vy':
+                use(y)
+                set_(x)
+                emit('%s = %s' % (vx, vy))
+            elif name in ('set_vx_to_vx_or_vy', 'set_vx_to_vx_and_vy', 'set_vx_to_vx_xor_vy'):
+                use(y)
+                set_(x)
+                operator = {1: '|', 2: '&', 3: '^'}[opcode & 0xF]
+                emit('%s %s= %s' % (vx, operator, vy))
+            elif name == 'set_vx_to_vx_plus_vy':
+                use(y)
+                set_(x, 0xF)
+                emit('t = %s + %s' % (vx, vy))
+                emit('%s = t & 0xFF' % vx)
+                emit('v15 = 1 if t > 0xFF else 0')
+            elif name in ('set_vx_to_vx_minus_vy', 'set_vx_to_vy_minus_vx'):
+                use(y)
+                set_(x, 0xF)
+                if name == 'set_vx_to_vx_minus_vy':
+                    emit('t = %s - %s' % (vx, vy))
+                else:
+                    emit('t = %s - %s' % (vy, vx))
+                emit('v15 = 1 if t > 0 else 0')
+                emit('%s = t & 0xFF' % vx)
+            elif name == 'set_vx_to_vx_shr':
+                set_(x, 0xF)
+                emit('v15 = %s & 0x1' % vx)
+                emit('%s = %s >> 1' % (vx, vx))
+            elif name == 'set_vx_to_vx_shl':
+                set_(x, 0xF)
+                emit('v15 = %s >> 7' % vx)
+                emit('%s = (%s << 1) & 0xFF' % (vx, vx))
+            elif name == 'set_i_register':
+                i_state['written'] = True
+                emit('i = %d' % nnn)
+            elif name == 'set_vx_random':
+                set_(x)
+                emit('r = cpu.rng_state')
+                emit('r ^= (r << 13) & 0xFFFFFFFF')
+                emit('r ^= r >> 17')
+                emit('r ^= (r << 5) & 0xFFFFFFFF')
+                emit('cpu.rng_state = r')
+                emit('%s = %d & (r >> 24)' % (vx, kk))
+            elif name == 'set_vx_dt_value':
+                set_(x)
+                emit('%s = cpu.delay_timer' % vx)
+            elif name == 'set_dt_to_vx':
+                use(x)
+                emit('cpu.delay_timer = %s' % vx)
+            elif name == 'set_st_to_vx':
+                use(x)
+                emit('cpu.sound_timer = %s' % vx)
+            elif name == 'add_to_i':
+                use(x)
+                i_state['read'] = i_state['written'] = True
+                emit('i = (i + %s) & 0xFFF' % vx)
+            elif name == 'set_i_to_vx_sprite':
+                use(x)
+                i_state['written'] = True
+                emit('i = 5*%s' % vx)
+            elif name == 'read_vx_from_memory':
+                set_(*range(x+1))
+                i_state['read'] = True
+                for v in range(x+1):
+                    emit('v%d = memory[i+%d]' % (v, v))
+            elif name in self.jump_functions:
+                if name == 'return_from_subroutine':
+                    emit('sp = cpu.stack_pointer')
+                    emit('next_pc = cpu.stack[sp] + 2')
+                    emit('cpu.stack_pointer = sp - 1')
+                elif name == 'jump_to_location':
+                    emit('next_pc = %d' % nnn)
+                elif name == 'call_subroutine_at':
+                    emit('sp = cpu.stack_pointer + 1')
+                    emit('cpu.stack_pointer = sp')
+                    emit('cpu.stack[sp] = %d' % address)
+                    emit('next_pc = %d' % nnn)
+                elif name == 'jump_to_location_shift':
+                    use(0)
+                    emit('next_pc = v0 + %d' % nnn)
+                else:
+                    if name in ('skip_next_if_vx_equals_kk', 'skip_next_if_vx_not_equals_kk'):
+                        use(x)
+                        right = '%d' % kk
+                    else:
+                        use(x, y)
+                        right = vy
+                    operator = '==' if name.startswith('skip_next_if_vx_equals') else '!='
+                    emit('next_pc = %d if %s %s %s else %d' % (address+4, vx, operator, right, address+2))
+                next_pc = 'next_pc'
+                break
+            else:
+                # Instructions touching the screen, the keyboard or memory
+                # go through their CPU handler with the state written back
+                body += self.flush(written, i_state['written'])
+                written.clear()
+                i_state['written'] = False
+                emit('cpu.program_counter = %d' % address)
+                emit('cpu.opcode = %d' % opcode)
+                emit('cpu.%s()' % name)
+                next_pc = 'cpu.program_counter + 2'
+                break
+            address += 2
+
+        if length == 0:
+            return None
+        end = start + 2*length
+        if next_pc is None:
+            next_pc = '%d' % end
+
+        lines = ['v%d = V[%d]' % (v, v) for v in sorted(read)]
+        if i_state['read']:
+            lines.append('i = cpu.I')
+        lines += body
+        lines += self.flush(written, i_state['written'])
+        lines.append('return %s' % next_pc)
+        source = 'def block(cpu, V, memory):\n' + ''.join('    %s\n' % line for line in lines)
+
+        namespace = {}
+        exec(compile(source, '<block 0x%03X>' % start, 'exec'), namespace)
+        block = Block(start, end, length, last_opcode, namespace['block'], source)
+        self.blocks[start] = block
+        for a in range(start, end):
+            self.covering.setdefault(a, set()).add(start)
+        return block
+
+    @staticmethod
+    def flush(written, i_written):
+        lines = ['V[%d] = v%d' % (v, v) for v in sorted(written)]
+        if i_written:
+            lines.append('cpu.I = i')
+        return lines
+
+    def run(self, n_instructions):
+        """
+        Execute n_instructions, falling back to the interpreter for the
+        instructions that cannot be compiled and for the last partial block.
+        Like CPU.run, key events queued on the keyboard split the blocks so
+        that each one is applied exactly at its cycle.
+        """
+        cpu = self.cpu
+        keyboard = cpu.keyboard
+        blocks = self.blocks
+        start = cpu.cycles
+        end = start + n_instructions
+        while cpu.cycles < end:
+            budget = end
+            if keyboard is not None and keyboard.events:
+                keyboard.apply_events(cpu.cycles)
+                next_cycle = keyboard.next_event_cycle()
+                if next_cycle is not None:
+                    budget = min(end, next_cycle)
+            block = blocks.get(cpu.program_counter)
+            if block is None:
+                block = self.translate(cpu.program_counter)
+            if block is None or block.length > budget - cpu.cycles:
+                cpu.execute_instruction()
+            else:
+                cpu.program_counter = block.function(cpu, cpu.V_register, cpu.memory)
+                cpu.opcode = block.opcode
+                cpu.cycles += block.length
+        return cpu.cycles - start
+
+    def capture_state(self):
+        cpu = self.cpu
+        screen = None
+        if cpu.screen is not None:
+            screen = (list(cpu.screen.rows), cpu.screen.dirty_rows)
+        return (bytes(cpu.memory), bytes(cpu.V_register), cpu.I, cpu.program_counter,
+                cpu.stack_pointer, cpu.stack.tolist(), cpu.delay_timer, cpu.sound_timer,
+                screen, cpu.rng_state)
+
+    def restore_state(self, state):
+        cpu = self.cpu
+        (memory, registers, cpu.I, cpu.program_counter, cpu.stack_pointer, stack,
+         cpu.delay_timer, cpu.sound_timer, screen, cpu.rng_state) = state
+        if cpu.memory != memory:
+            cpu.memory[:] = memory
+            cpu.invalidate_decode_cache()
+        cpu.V_register[:] = registers
+        cpu.stack[:] = type(cpu.stack)(cpu.stack.typecode, stack)
+        if screen is not None:
+            cpu.screen.rows = list(screen[0])
+            cpu.screen.dirty_rows = screen[1]
+
+    def check(self, n_instructions):
+        """
+        Run n_instructions, executing every block twice: once compiled and
+        once through CPU.execute_instruction. Raise an AssertionError at the
+        first block whose compiled version diverges from the interpreter.
+        """
+        cpu = self.cpu
+        executed = 0
+        while executed < n_instructions:
+            block = self.blocks.get(cpu.program_counter) or self.translate(cpu.program_counter)
+            if block is None or block.length > n_instructions - executed:
+                cpu.execute_instruction()
+                executed += 1
+                continue
+            before = self.capture_state()
+            cpu.program_counter = block.function(cpu, cpu.V_register, cpu.memory)
+            compiled = self.capture_state()
+            self.restore_state(before)
+            for _ in range(block.length):
+                cpu.execute_instruction()
+            interpreted = self.capture_state()
+            assert compiled == interpreted, \
+                'Block at 0x{:03X} diverges from the interpreter:\n{}'.format(block.start, block.source)
+            executed += block.length
+        return executed